@@ -80,15 +80,9 @@ class differential_roi_manager(object):
 #manuscript says 200, June 15 abc_cov was done with 50
     SIM.distance_mm=141.7
 
-    UMAT_nm = flex.mat3_double()
-    mersenne_twister = flex.mersenne_twister(seed=0)
-    scitbx.random.set_random_seed(1234)
-    rand_norm = scitbx.random.normal_distribution(mean=0, sigma=SIM.mosaic_spread_deg * math.pi/180.)
-    g = scitbx.random.variate(rand_norm)
-    mosaic_rotation = g(SIM.mosaic_domains)
-    for m in mosaic_rotation:
-      site = col(mersenne_twister.random_double_point_on_sphere())
-      UMAT_nm.append( site.axis_and_angle_as_r3_rotation_matrix(m,deg=False) )
+    # same rotations as drawing them here (axes seed 0, angles seed 1234), memoised per rank
+    from LS49.sim.mosaic_domains import mosaic_domains
+    UMAT_nm = mosaic_domains.umats(SIM.mosaic_spread_deg, SIM.mosaic_domains, seed=(0,1234))
     SIM.set_mosaic_blocks(UMAT_nm)
     self.UMAT_nm = UMAT_nm # delete later
 
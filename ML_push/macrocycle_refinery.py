@@ -46,7 +46,14 @@ class MPI_Run(upstream_base_script):
 
     assert self.params.starting_model.algorithm!="to_file", \
            "run new_global__fdp_refinery.py first, to generate starting model"
-    if self.mpi_helper.rank == 0:
+    if self.params.starting_model.store is not None:
+        # every rank attaches to the memory-mapped static fcalc table
+        from LS49.ML_push.static_fcalc_store import build_static_fcalc_store
+        store = build_static_fcalc_store(self.params.starting_model.store,
+          comm=self.mpi_helper.comm, nproc=self.params.starting_model.nproc)
+        transmitted_info = dict(HKL_lookup = store.HKL_lookup(),
+        static_fcalcs = store, model_intensities = store.model_intensities())
+    elif self.mpi_helper.rank == 0:
         with (open(self.params.starting_model.filename,"rb")) as inp:
           HKL_lookup = pickle.load(inp)
           static_fcalcs = pickle.load(inp)
@@ -56,7 +63,8 @@ class MPI_Run(upstream_base_script):
         static_fcalcs = static_fcalcs, model_intensities = model_intensities)
     else:
         transmitted_info = None
-    transmitted_info = self.mpi_helper.comm.bcast(transmitted_info, root = 0)
+    if self.params.starting_model.store is None:
+        transmitted_info = self.mpi_helper.comm.bcast(transmitted_info, root = 0)
     self.mpi_helper.comm.barrier()
     # macrocycle 1 ---------------------------------------------------------
     # generate model_intensities table based on initial conditions
@@ -23,38 +23,60 @@ Fe_oxidized_model = local_data.get("Fe_oxidized_model")
 Fe_reduced_model = local_data.get("Fe_reduced_model")
 Fe_metallic_model = local_data.get("Fe_metallic_model")
 
-def get_static_fcalcs_with_HKL_lookup():
+_static_fcalc_context = []
+STATIC_FCALC_PARAMETERS = dict(algorithm="fft") # gen_fmodel_with_complex.from_parameters
+
+def static_fcalc_parameters():
+    """The fmodel parameters (params2) of every static fcalc channel"""
+    from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex import gen_fmodel_with_complex
+    return gen_fmodel_with_complex().from_parameters(**STATIC_FCALC_PARAMETERS).params2
+
+def static_fcalc_context(C2_structures=None):
+    """C2 structures, Miller indices and bulk solvent common to every static fcalc channel;
+    set up once per process.  C2_structures (whole, non-Fe) default to get_C2_structures()"""
+    if len(_static_fcalc_context) > 0: return _static_fcalc_context[0]
     from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex import get_C2_structures, gen_fmodel_with_complex
-    C2_structures = get_C2_structures()
+    if C2_structures is None: C2_structures = get_C2_structures()
 
     energy = 7070.0
     GF_whole7070 = gen_fmodel_with_complex.from_structure(C2_structures[0],energy
-                   ).from_parameters(algorithm="fft")
+                   ).from_parameters(**STATIC_FCALC_PARAMETERS)
     GF_whole7070 = GF_whole7070.as_P1_primitive()
     f_container7070 = GF_whole7070.get_fmodel()
     Fmodel_whole7070 = f_container7070.f_model
     Fmodel_indices = Fmodel_whole7070.indices() # common structure defines the indices
     F_bulk = f_container7070.fmodel.arrays.core.data.f_bulk
     F_bulk.reshape(flex.grid((Fmodel_indices.size(),1))) # in-place reshape, non-standard
+    _static_fcalc_context.append(dict(C2_structures = C2_structures,
+      Fmodel_indices = Fmodel_indices, F_bulk = F_bulk))
+    return _static_fcalc_context[0]
+
+def static_fcalc_channel(incr):
+    """Column incr of the static fcalc table, F(bulk) + F(non-Fe atoms) at 7070.5 + incr eV"""
+    from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex import gen_fmodel_with_complex
+    context = static_fcalc_context()
+    Fmodel_indices = context["Fmodel_indices"]
+    energy = 7070.5 + incr
+
+    GF_non_Fe = gen_fmodel_with_complex.from_structure(context["C2_structures"][1],energy
+                ).from_parameters(**STATIC_FCALC_PARAMETERS)
+    GF_non_Fe = GF_non_Fe.as_P1_primitive()
+    f_container = GF_non_Fe.get_fmodel()
+    Fcalc_non_Fe = f_container.fmodel.f_calc().data()
+    Fcalc_non_Fe.reshape(flex.grid((Fmodel_indices.size(),1))) # in-place reshape, non-standard
+    return context["F_bulk"] + Fcalc_non_Fe
+
+def get_static_fcalcs_with_HKL_lookup():
+    Fmodel_indices = static_fcalc_context()["Fmodel_indices"]
 
     result = flex.complex_double(flex.grid((Fmodel_indices.size(),100)))
 
     # common structure to represent the wavelength-dependent non-Fe diffraction (bulk+atoms)
     for incr in range(100):
-      energy = 7070.5 + incr
+      result.matrix_paste_block_in_place(static_fcalc_channel(incr),0,incr)
 
-      GF_non_Fe = gen_fmodel_with_complex.from_structure(C2_structures[1],energy
-                  ).from_parameters(algorithm="fft")
-      GF_non_Fe = GF_non_Fe.as_P1_primitive()
-      f_container = GF_non_Fe.get_fmodel()
-      Fcalc_non_Fe = f_container.fmodel.f_calc().data()
-      Fcalc_non_Fe.reshape(flex.grid((Fmodel_indices.size(),1))) # in-place reshape, non-standard
-
-      result.matrix_paste_block_in_place((F_bulk + Fcalc_non_Fe),0,incr)
-
-    HKL_lookup = {}
-    for iw in range(len(Fmodel_indices)):
-      HKL_lookup[Fmodel_indices[iw]] = iw
+    from LS49.utils.miller_lookup import miller_lookup
+    HKL_lookup = miller_lookup(Fmodel_indices)
 
     # result holds a table of complex double structure factors.  Rows are Miller indices H.
     # columns are F_H(energy, 100 channels) for F(bulk) + F(non-Fe atoms). Thus this is
@@ -66,6 +88,15 @@ distance_mm = 141.7
 pixel_sz_mm = 0.11
 mos_rotation_deg = 0.05
 
+def spot_rows(HKL_lookup,millers):
+  """Table rows of a list of P1 Miller indices; KeyError if any is absent"""
+  if not hasattr(HKL_lookup,"rows"): # dict from an old starting model
+    return [HKL_lookup[miller] for miller in millers]
+  rows = HKL_lookup.rows(millers)
+  if (rows < 0).any():
+    raise KeyError(millers[list(rows).index(-1)])
+  return [int(row) for row in rows]
+
 def get_items(myrank,N_total,N_stride,cohort=0):
   abc_glob = os.environ["ABC_GLOB"]
   for key in range(cohort*N_total, (cohort+1)*N_total):
@@ -115,10 +146,10 @@ class fit_one_image_multispot:
       self.x.append(list_of_images[ispot].bkgrd_a[2])
     self.x.append(1.)
     self.roi_model_pixels = []
+    rows = spot_rows(HKL_lookup,[spot.simtbx_P1_miller for spot in list_of_images])
     for ispot in range(self.n_spots):
       intensity = list_of_images[ispot].simtbx_intensity_7122
-      this_P1_Miller_index = list_of_images[ispot].simtbx_P1_miller
-      lookup_idx = HKL_lookup[this_P1_Miller_index]
+      lookup_idx = rows[ispot]
       energy_dependent_intensity = model_intensities.matrix_copy_block(
         i_row=lookup_idx,i_column=0,n_rows=1,n_columns=100)
       rescale_factor = energy_dependent_intensity.as_1d() / intensity
@@ -190,13 +221,11 @@ class rank_0_fit_all_f:
     self.params = params
     self.n = 400
     self.x = flex.double(self.n)    #lay out the parameters.
-    for incr in range(100):
-      energy = 7070.5 + incr
-      wavelength = 12398.425/energy
-      newfp,newfdp = FE1_model.fp_fdp_at_wavelength(angstroms=wavelength)
-      self.x[incr]=newfp; self.x[incr+100]=newfdp
-      newfp,newfdp = FE2_model.fp_fdp_at_wavelength(angstroms=wavelength)
-      self.x[incr+200]=newfp; self.x[incr+300]=newfdp
+    wavelengths = [12398.425/(7070.5 + incr) for incr in range(100)]
+    for offset, model in [(0, FE1_model), (200, FE2_model)]:
+      newfp,newfdp = model.fp_fdp_at_wavelengths(wavelengths)
+      for incr in range(100):
+        self.x[offset+incr]=newfp[incr]; self.x[offset+incr+100]=newfdp[incr]
 
   def reinitialize(self, logical_rank, comm_size, per_rank_items, per_rank_keys, per_rank_G,
                    HKL_lookup, static_fcalcs, model_intensities,force_recompute=False):
@@ -215,6 +244,14 @@ class rank_0_fit_all_f:
       self.starting_params_cached = True
     self.iteration = 0
     self.macrocycle = None
+    # table rows of every spot, resolved once per image
+    self.per_rank_rows = []
+    for this_image in (self.per_rank_items or []):
+      millers = [this_spot.simtbx_P1_miller for this_spot in this_image]
+      # negative control test point here:
+      if self.params.LLG_evaluator.spoilHKL:
+        millers = [(m[0],m[1],m[2]+1) for m in millers]
+      self.per_rank_rows.append(spot_rows(HKL_lookup,millers))
   def set_macrocycle(self, value, FE1_starting_params=None, FE2_starting_params=None):
     # allows macrocycler to set the initial values as of cycle 1
     self.macrocycle = value
@@ -284,22 +321,38 @@ class rank_0_fit_all_f:
     #assert self.model_intensities_reinitialized_for_debug_iteration_1
     if not self.model_intensities_reinitialized_for_debug_iteration_1:
       # recalculate model intensities for each target evaluation
-      if self.logical_rank == 0 or self.comm_size==1:
-
+      if self.params.model_intensities.method == "distributed" and self.comm_size > 1:
         FE1 = george_sherrell_star(fp = self.x[0:100],fdp = self.x[100:200])
         FE2 = george_sherrell_star(fp = self.x[200:300],fdp = self.x[300:400])
         from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex \
-           import get_intensity_structure
-        self.model_intensities = get_intensity_structure(
-           self.static_fcalcs,FE1_model=FE1,FE2_model=FE2)
-
-        transmitted_info = self.model_intensities
+           import get_intensity_structure_distributed
+        from libtbx.mpi4py import MPI
+        self.model_intensities = get_intensity_structure_distributed(
+           self.static_fcalcs,FE1_model=FE1,FE2_model=FE2,comm=MPI.COMM_WORLD,
+           nproc=self.params.model_intensities.nproc)
       else:
-        transmitted_info = None
-      from libtbx.mpi4py import MPI
-      comm = MPI.COMM_WORLD
-      self.model_intensities = comm.bcast(transmitted_info, root = 0)
-      comm.barrier()
+        import time
+        start = time.time()
+        if self.logical_rank == 0 or self.comm_size==1:
+
+          FE1 = george_sherrell_star(fp = self.x[0:100],fdp = self.x[100:200])
+          FE2 = george_sherrell_star(fp = self.x[200:300],fdp = self.x[300:400])
+          from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex \
+             import get_intensity_structure
+          self.model_intensities = get_intensity_structure(
+             self.static_fcalcs,FE1_model=FE1,FE2_model=FE2)
+
+          transmitted_info = self.model_intensities
+        else:
+          transmitted_info = None
+        from libtbx.mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        self.model_intensities = comm.bcast(transmitted_info, root = 0)
+        comm.barrier()
+        # every other rank idles while rank 0 computes
+        idle = comm.reduce(time.time() - start if self.logical_rank != 0 else 0., MPI.MAX, 0)
+        if self.logical_rank == 0 and self.comm_size > 1:
+          print("intensity structure in rank 0: other ranks idle up to %.2fs"%idle)
 
     this_rank_N_images = len(self.per_rank_keys)
     for i_image in range(this_rank_N_images):
@@ -308,12 +361,8 @@ class rank_0_fit_all_f:
       this_G = self.per_rank_G[i_image]
       for i_spot in range(this_image_N_spots):
         this_spot = this_image[i_spot]
-        miller_index = this_spot.simtbx_P1_miller
         this_ref_intensity = this_spot.simtbx_intensity_7122
-        # negative control test point here:
-        if self.params.LLG_evaluator.spoilHKL:
-          miller_index = (miller_index[0],miller_index[1],miller_index[2]+1)
-        lookup_idx = self.HKL_lookup[miller_index]
+        lookup_idx = self.per_rank_rows[i_image][i_spot]
         energy_dependent_intensity = self.model_intensities.matrix_copy_block(
                       i_row=lookup_idx,i_column=0,n_rows=1,n_columns=100)
         energy_dependent_derivatives = self.model_intensities.matrix_copy_block(
@@ -446,7 +495,22 @@ class MPI_Run(object):
     from scitbx.lbfgs.tst_mpi_split_evaluator import run_mpi as simple_tester
     simple_tester()
 
-    if self.params.starting_model.algorithm=="to_file":
+    if self.params.starting_model.store is not None:
+      from LS49.ML_push.static_fcalc_store import build_static_fcalc_store
+      store = build_static_fcalc_store(self.params.starting_model.store,
+        comm=self.mpi_helper.comm, nproc=self.params.starting_model.nproc)
+      if self.params.starting_model.algorithm=="to_file":
+        if self.mpi_helper.rank == 0 and store.model_intensities() is None:
+          from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex \
+             import get_intensity_structure
+          store.save_model_intensities(get_intensity_structure(
+             store,FE1_model=Fe_oxidized_model,FE2_model=Fe_reduced_model))
+        return
+      assert store.model_intensities() is not None, \
+             "run with starting_model.algorithm=to_file first, to store the starting intensities"
+      transmitted_info = dict(HKL_lookup = store.HKL_lookup(),
+        static_fcalcs = store, model_intensities = store.model_intensities())
+    elif self.params.starting_model.algorithm=="to_file":
       if self.mpi_helper.rank == 0:
         HKL_lookup,static_fcalcs = get_static_fcalcs_with_HKL_lookup()
         from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex \
@@ -469,7 +533,7 @@ class MPI_Run(object):
         static_fcalcs = static_fcalcs, model_intensities = model_intensities)
       else:
         transmitted_info = None
-    transmitted_info = self.mpi_helper.comm.bcast(transmitted_info, root = 0)
+      transmitted_info = self.mpi_helper.comm.bcast(transmitted_info, root = 0)
     self.mpi_helper.comm.barrier()
 
     # -----------------------------------------------------------------------
@@ -33,6 +33,14 @@ starting_model{
   filename = new_global_fdp_big_data.pickle
       .type = path
       .help = write out
+  store = None
+      .type = path
+      .help = If given, root directory of the memory-mapped static fcalc store (LS49.ML_push.static_fcalc_store).
+      .help = to_file builds the store in parallel over all ranks, together with the starting intensities,
+      .help = instead of writing filename; from_file attaches every rank to the store.
+  nproc = 1
+      .type = int(value_min=1)
+      .help = Local processes per rank for building the store
   preset
     .help = Starting assumptions about the state of FE1 and FE2 scatterers
     .help = If FE1 is set to Fe_oxidized_model and FE2 is set to Fe_reduced_model then the
@@ -47,6 +55,17 @@ starting_model{
       .type = choice
   }
 }
+model_intensities{
+  method = *rank_0 distributed
+    .type = choice
+    .help = How the energy-dependent intensities are recalculated at each LBFGS iteration.
+    .help = rank_0 computes all 100 energy channels in rank 0 and broadcasts the table,
+    .help = distributed deals the channels out to all ranks and assembles them with allgather
+  nproc = 1
+    .type = int(value_min=1)
+    .help = For distributed, number of local processes per rank to share the channels
+    .help = Forked, so only used under MPI if FORK_UNDER_MPI=1 is exported (see utils/fork_pool.py)
+}
 LLG_evaluator{
   max_calls = 10
     .type = int
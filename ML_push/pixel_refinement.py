@@ -23,7 +23,7 @@ Fe_oxidized_model = local_data.get("Fe_oxidized_model")
 Fe_reduced_model = local_data.get("Fe_reduced_model")
 Fe_metallic_model = local_data.get("Fe_metallic_model")
 
-from LS49.ML_push.new_global_fdp_refinery import get_items
+from LS49.ML_push.new_global_fdp_refinery import get_items, spot_rows
 from LS49.ML_push.differential_roi_manager import differential_roi_manager
 from LS49.ML_push.shoebox_troubleshoot import pprint
 
@@ -94,6 +94,7 @@ class fit_one_image_multispot:
     updated_models4 = self.DRM.get_incremented_rotation_models(rotxyz)
     self.roi_model_pixels = []
     self.new_calc2_dict_last_round = []
+    ROIs = []
     for ispot,spot in enumerate(self.list_of_images):
 
       M = self.DRM.data["miller_index"] # from dials integration pickle
@@ -101,19 +102,20 @@ class fit_one_image_multispot:
       idx = M.first_index(S)
       shoe = self.DRM.data["shoebox"][idx]
       B = shoe.bbox
-      ROI = ((B[0],B[1]),(B[2],B[3]))
-      new_calc2_dict = self.DRM.perform_one_simulation_optimized(model="Amat",ROI=ROI,models4 = updated_models4)
-
+      ROIs.append(((B[0],B[1]),(B[2],B[3])))
+      self.new_calc2_dict_last_round.append( # need this after lbfgs when results are written out
+        self.DRM.perform_one_simulation_optimized(model="Amat",ROI=ROIs[ispot],models4 = updated_models4))
+    # resolve the table rows of all spots of the image at once, not per spot
+    lookup_rows = spot_rows(self.HKL_lookup,[D["miller"] for D in self.new_calc2_dict_last_round])
+    for ispot,new_calc2_dict in enumerate(self.new_calc2_dict_last_round):
       intensity = new_calc2_dict["intensity"]
-      this_P1_Miller_index = new_calc2_dict["miller"]
-      #print("NEW",this_P1_Miller_index);pprint (new_calc2_dict["roi_pixels"])
-      lookup_idx = self.HKL_lookup[this_P1_Miller_index]
+      #print("NEW",new_calc2_dict["miller"]);pprint (new_calc2_dict["roi_pixels"])
+      lookup_idx = lookup_rows[ispot]
       energy_dependent_intensity = self.model_intensities.matrix_copy_block(
         i_row=lookup_idx,i_column=0,n_rows=1,n_columns=100)
       rescale_factor = energy_dependent_intensity.as_1d() / intensity
       channels = new_calc2_dict["channels"]
       self.roi_model_pixels.append(rescale_factor[0] * channels[0])
-      self.new_calc2_dict_last_round.append(new_calc2_dict) # need this after lbfgs when results are written out
 
       for ichannel in range(1,len(channels)):
         # rescale_factor[51] always == 1, equivalent to simtbx_intensity_7122
@@ -137,12 +139,7 @@ class fit_one_image_multispot:
     # derivatives:
     self.roi_dxyz = dict(Amat_dx = [],Amat_dy = [], Amat_dz = [])
     for ispot,spot in enumerate(self.list_of_images):
-      M = self.DRM.data["miller_index"] # from dials integration pickle
-      S = (spot.orig_idx_C2_setting) # happens to be the coarse ground truth spot
-      idx = M.first_index(S)
-      shoe = self.DRM.data["shoebox"][idx]
-      B = shoe.bbox
-      ROI = ((B[0],B[1]),(B[2],B[3]))
+      ROI = ROIs[ispot]
 
       for modelkey in self.roi_dxyz:
         if modelkey == "Amat_dx": continue # don't consider rotX as it is parallel to the beam and well determined
@@ -151,8 +148,10 @@ class fit_one_image_multispot:
         new_dxyz_dict = self.DRM.perform_one_simulation_optimized(model=modelkey,ROI=ROI,models4 = updated_models4)
 
         intensity = new_dxyz_dict["intensity"]
-        this_P1_Miller_index = new_dxyz_dict["miller"]
-        lookup_idx = self.HKL_lookup[this_P1_Miller_index]
+        if new_dxyz_dict["miller"] == self.new_calc2_dict_last_round[ispot]["miller"]:
+          lookup_idx = lookup_rows[ispot] # the same spot, already resolved
+        else:
+          lookup_idx = spot_rows(self.HKL_lookup,[new_dxyz_dict["miller"]])[0]
         energy_dependent_intensity = self.model_intensities.matrix_copy_block(
         i_row=lookup_idx,i_column=0,n_rows=1,n_columns=100)
         rescale_factor = energy_dependent_intensity.as_1d() / intensity
@@ -0,0 +1,169 @@
+from __future__ import division, print_function
+import os
+import json
+import numpy as np
+from scitbx.array_family import flex
+
+"""Memory-mapped store of the static fcalc table used in fdp refinement.
+
+The complex Nhkl x 100 table F(bulk) + F(non-Fe atoms) of get_static_fcalcs_with_HKL_lookup
+takes 100 FFT structure factor calculations in series, and was then pickled into the
+starting-model file, unpickled by rank 0 and broadcast to every rank.  Here the channels
+are computed in parallel (round-robin over MPI ranks, and optionally over forked local
+processes) straight into a numpy memmap, in a directory named by a hash of everything
+the table depends on:
+
+  <root>/<key>/indices.npy           int32 (Nhkl,3) P1 Miller indices
+  <root>/<key>/fcalc.npy             complex128 (100,Nhkl), one contiguous row per channel
+  <root>/<key>/model_intensities.npy optional float64 (Nhkl,500) starting intensities
+  <root>/<key>/meta.json             written last; its presence marks the store complete
+
+Later runs and macrocycles attach to the store read-only; the operating system shares
+the pages between the ranks of a node, and nothing is recomputed or unpickled.
+static_fcalc_store behaves like the flex table as far as get_intensity_structure is
+concerned (focus, matrix_copy_block).
+"""
+
+N_CHANNELS = 100
+VERSION = 1
+
+def model_key(params2=None):
+  """Hash of the inputs of the static table: PDB text, Henke f', f'', channel energies
+  and the fmodel parameters params2 the channels are computed with (by default those of
+  new_global_fdp_refinery.static_fcalc_parameters)"""
+  import mmtbx.command_line.fmodel
+  from LS49.sim.step5_pad import data
+  from LS49.sim.structure_registry import text_digest
+  from LS49.utils.job_ledger import input_hash
+  if params2 is None:
+    from LS49.ML_push.new_global_fdp_refinery import static_fcalc_parameters
+    params2 = static_fcalc_parameters()
+  phil2 = mmtbx.command_line.fmodel.fmodel_from_xray_structure_master_params
+  return input_hash("static_fcalcs", VERSION, text_digest(data().get("pdb_lines")),
+    "henke", [7070.5 + incr for incr in range(N_CHANNELS)],
+    phil2.format(python_object=params2).as_str())[:16]
+
+class static_fcalc_store(object):
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, "meta.json"), "r") as F:
+      self.meta = json.load(F)
+    self.indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+    self.fcalc = np.load(os.path.join(path, "fcalc.npy"), mmap_mode="r")
+    self.n_rows = self.indices.shape[0]
+
+  @staticmethod
+  def is_complete(path):
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+  def focus(self):
+    return (self.n_rows, N_CHANNELS)
+
+  def column(self, incr):
+    """flex.complex_double (Nhkl,1) for one channel"""
+    channel = self.fcalc[incr]
+    result = flex.complex_double(flex.double(np.ascontiguousarray(channel.real)),
+                                 flex.double(np.ascontiguousarray(channel.imag)))
+    result.reshape(flex.grid((self.n_rows,1)))
+    return result
+
+  def matrix_copy_block(self, i_row, i_column, n_rows, n_columns):
+    block = self.fcalc[i_column:i_column+n_columns, i_row:i_row+n_rows].T
+    result = flex.complex_double(flex.double(np.ascontiguousarray(block.real)),
+                                 flex.double(np.ascontiguousarray(block.imag)))
+    result.reshape(flex.grid((n_rows,n_columns)))
+    return result
+
+  def as_flex(self):
+    """The full table as flex.complex_double (Nhkl,100), as get_static_fcalcs_with_HKL_lookup"""
+    return self.matrix_copy_block(0, 0, self.n_rows, N_CHANNELS)
+
+  def HKL_lookup(self):
+    from LS49.utils.miller_lookup import miller_lookup
+    return miller_lookup(self.indices)
+
+  def model_intensities(self):
+    """Starting intensity structure, flex.double (Nhkl,500), or None if not stored"""
+    path = os.path.join(self.path, "model_intensities.npy")
+    if not os.path.isfile(path): return None
+    table = np.load(path)
+    result = flex.double(np.ascontiguousarray(table))
+    result.reshape(flex.grid(table.shape))
+    return result
+
+  def save_model_intensities(self, model_intensities):
+    path = os.path.join(self.path, "model_intensities.npy")
+    tmp = "%s.%d.tmp.npy"%(path, os.getpid())
+    np.save(tmp, model_intensities.as_numpy_array().reshape(model_intensities.focus()))
+    os.rename(tmp, path)
+
+def _fill_channel(fcalc_path, incr):
+  # forked worker: writes its channel straight into the shared memmap
+  fcalc = np.load(fcalc_path, mmap_mode="r+")
+  fill_channel(fcalc, incr)
+  fcalc.flush()
+  return incr
+
+def fill_channel(fcalc, incr):
+  from LS49.ML_push.new_global_fdp_refinery import static_fcalc_channel
+  real, imag = static_fcalc_channel(incr).parts()
+  fcalc[incr].real = real.as_numpy_array()
+  fcalc[incr].imag = imag.as_numpy_array()
+
+def build_static_fcalc_store(root, comm=None, nproc=1):
+  """Compute the static table into <root>/<model_key()> unless already there, and attach.
+  With comm, every rank must call this; channels are dealt round-robin to the ranks.
+  Rank 0 decides whether the store exists, so all ranks take the same branch.  The table
+  is built in a directory private to this job and renamed into place; if another job
+  finished the same key first, its store is kept and ours is discarded."""
+  import time
+  import uuid
+  import shutil
+  from LS49.ML_push.new_global_fdp_refinery import static_fcalc_context
+  start = time.time()
+  rank = 0 if comm is None else comm.Get_rank()
+  size = 1 if comm is None else comm.Get_size()
+  key = model_key()
+  path = os.path.join(root, key)
+  complete = static_fcalc_store.is_complete(path) if rank == 0 else None
+  building = "%s.building.%d.%s"%(path, os.getpid(), uuid.uuid4().hex[:8]) if rank == 0 else None
+  if comm is not None:
+    complete, building = comm.bcast((complete, building), root=0)
+  if complete:
+    return static_fcalc_store(path)
+  Fmodel_indices = static_fcalc_context()["Fmodel_indices"]
+  if rank == 0:
+    os.makedirs(building)
+    indices = np.lib.format.open_memmap(os.path.join(building, "indices.npy"), mode="w+",
+      dtype=np.int32, shape=(Fmodel_indices.size(),3))
+    indices[:] = np.array(list(Fmodel_indices), dtype=np.int32)
+    del indices
+    np.lib.format.open_memmap(os.path.join(building, "fcalc.npy"), mode="w+",
+      dtype=np.complex128, shape=(N_CHANNELS,Fmodel_indices.size())).flush()
+  if comm is not None: comm.barrier()
+  my_channels = list(range(rank, N_CHANNELS, size))
+  fcalc_path = os.path.join(building, "fcalc.npy")
+  if nproc > 1 and len(my_channels) > 1:
+    from LS49.utils.fork_pool import fork_map
+    fork_map(_fill_channel, my_channels, nproc, shared=fcalc_path)
+  else:
+    fcalc = np.load(fcalc_path, mmap_mode="r+")
+    for incr in my_channels: fill_channel(fcalc, incr)
+    fcalc.flush()
+    del fcalc
+  compute_time = time.time() - start
+  if comm is not None: comm.barrier()
+  if rank == 0:
+    with open(os.path.join(building, "meta.json"), "w") as F:
+      json.dump(dict(version=VERSION, key=key, n_hkl=Fmodel_indices.size(),
+                     n_channels=N_CHANNELS, ranks=size, nproc=nproc), F)
+    try:
+      os.rename(building, path)
+      print("static fcalc store %s built over %d ranks in %.2fs (rank 0 compute %.2fs)"%(
+        path, size, time.time() - start, compute_time))
+    except OSError: # a concurrent job renamed its (identical) store into place first
+      assert static_fcalc_store.is_complete(path)
+      shutil.rmtree(building)
+      print("static fcalc store %s was completed by another job"%path)
+  if comm is not None: comm.barrier()
+  return static_fcalc_store(path)
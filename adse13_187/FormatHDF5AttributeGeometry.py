@@ -1,21 +1,41 @@
 from __future__ import absolute_import, division
 
+import os
 import numpy as np
 import h5py
 from copy import deepcopy
 import ast
+from collections import OrderedDict
 
 from dxtbx.format.FormatHDF5 import FormatHDF5
 from dials.array_family import flex
 from dxtbx.format.FormatStill import FormatStill
 from dxtbx.model import Beam
 
+# parsed detector and beam dicts by attribute string; the files of one campaign share
+# the geometry, and literal_eval of a 256-panel detector string is not free
+_geometry_dicts = {}
+
 
 class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
     """
     Class for reading HDF5 files for arbitrary geometries
     focused on performance
+
+    The image dataset stays open; get_raw_panels reads only the requested panels
+    (and optionally a slow/fast region of each) with HDF5 converting to float64
+    straight into one contiguous buffer.  flex.double(ndarray) still copies each
+    returned panel out of that buffer.  With HDF5_READ_AHEAD=<n> exported (or
+    set_read_ahead(n)), one HDF5 read fetches n consecutive images for sequential
+    access.  Per-shot spectra are read once per index and kept for the
+    SPECTRUM_CACHE_SIZE most recently used indices.
+
+    Multi-event containers written by LS49.adse13_187.event_container (event_row
+    present) are opened in SWMR mode, so they can be read while being written, and
+    their spectra are looked up per event rather than per image.
     """
+    SPECTRUM_CACHE_SIZE = 256
+
     @staticmethod
     def understand(image_file):
         try:
@@ -36,6 +56,9 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
 
     def _start(self):
         self._handle = h5py.File(self._image_file, "r")
+        if "event_row" in self._handle:
+            self._handle.close()
+            self._handle = h5py.File(self._image_file, "r", swmr=True)
         self.HAS_SPECTRUM_BEAM = False
         if hasattr(Beam, "set_spectrum"):
             self.HAS_SPECTRUM_BEAM = True
@@ -46,8 +69,12 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
         self._energies = None
         self._weights = None
         self._central_wavelengths = None
+        self._event_rows = None
         self._check_per_shot_spectra()
         self._ENERGY_CONV = 12398.419739640716
+        self._spectrum_cache = OrderedDict()
+        self._block = None
+        self.set_read_ahead(int(os.environ.get("HDF5_READ_AHEAD", 1)))
 
     def _geometry_define(self):
         det_str = self._image_dset.attrs["dxtbx_detector_string"]
@@ -57,8 +84,10 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
             beam_str = beam_str.decode()
         except AttributeError:
             pass
-        det_dict = ast.literal_eval(det_str)
-        beam_dict = ast.literal_eval(beam_str)
+        key = (det_str, beam_str)
+        if key not in _geometry_dicts:
+            _geometry_dicts[key] = (ast.literal_eval(det_str), ast.literal_eval(beam_str))
+        det_dict, beam_dict = _geometry_dicts[key]
         self._cctbx_detector = self._detector_factory.from_dict(det_dict)
         self._cctbx_beam = self._beam_factory.from_dict(beam_dict)
 
@@ -67,7 +96,14 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
         has_energies = "spectrum_energies" in keys
         has_weights = "spectrum_weights" in keys
         has_central_wavelengths = "central_wavelengths" in keys
-        if has_energies and has_weights:
+        if "event_row" in keys:
+            events = self._handle["events"]
+            self._event_rows = self._handle["event_row"]
+            self._spectrum_lengths = events["spectrum_length"]
+            self._has_spectra = True
+            self._energies = events["spectrum_energies"]
+            self._weights = events["spectrum_weights"]
+        elif has_energies and has_weights:
             self._has_spectra = True
             self._energies = self._handle["spectrum_energies"]
             self._weights = self._handle["spectrum_weights"]
@@ -76,15 +112,76 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
             self._central_wavelengths = self._handle["central_wavelengths"]
 
     def get_num_images(self):
+        if self._event_rows is not None:
+            self.refresh()
         return self._image_dset.shape[0]
 
-    def get_raw_data(self, index=0):
-        self.panels = self._image_dset[index]
-        if self.panels.dtype == np.float64:
-            flex_data = [flex.double(p) for p in self._image_dset[index]]
+    def refresh(self):
+        """Pick up frames appended to a multi-event container since opening"""
+        self._image_dset.refresh()
+        self._event_rows.refresh()
+        self._handle["frame"].refresh()
+        for dset in self._handle["events"].values():
+            dset.refresh()
+
+    def get_event_index(self, index=0):
+        """run795 event number of a frame of a multi-event container"""
+        return int(self._handle["events/i_exp"][self._event_rows[index]])
+
+    def get_frame_name(self, index=0):
+        """ratio, exascale, vintage or experimental, for a multi-event container"""
+        frame = self._handle["frame"]
+        names = frame.attrs["names"]
+        try:
+            names = names.decode()
+        except AttributeError:
+            pass
+        return names.split(",")[frame[index]]
+
+    def set_read_ahead(self, n_images):
+        """Number of consecutive images fetched per HDF5 read"""
+        self._read_ahead = max(1, n_images)
+        self._block = None
+
+    def _read_block(self, index, panels, region):
+        """float64 array (n_images, n_panels, slow, fast) starting at index,
+        panels in increasing order"""
+        n_images, n_panels, n_slow, n_fast = self._image_dset.shape
+        stop = min(index + self._read_ahead, n_images)
+        if panels is None:
+            panel_sel, n_sel = slice(0, n_panels), n_panels
+        elif len(panels) > 0 and list(panels) == list(range(panels[0], panels[-1] + 1)):
+            panel_sel, n_sel = slice(panels[0], panels[-1] + 1), len(panels)
         else:
-            flex_data = [flex.double(p.astype(np.float64)) for p in self._image_dset[index]]
-        return tuple(flex_data)
+            panel_sel, n_sel = list(panels), len(panels)
+        if region is None:
+            slow_sel, fast_sel = slice(0, n_slow), slice(0, n_fast)
+        else:
+            slow_sel, fast_sel = slice(*region[0]), slice(*region[1])
+        shape = (stop - index, n_sel,
+                 len(range(*slow_sel.indices(n_slow))), len(range(*fast_sel.indices(n_fast))))
+        block = np.empty(shape, dtype=np.float64)
+        self._image_dset.read_direct(block,
+            source_sel=np.s_[index:stop, panel_sel, slow_sel, fast_sel])
+        return block
+
+    def get_raw_panels(self, index=0, panels=None, region=None):
+        """Tuple of flex.double, one per panel id in panels (default all).
+        region=((slow0, slow1), (fast0, fast1)) restricts every panel to that window."""
+        selected = None if panels is None else tuple(sorted(set(panels)))
+        key = (selected, region)
+        block = self._block
+        if block is None or block[2] != key or not (block[0] <= index < block[1]):
+            data = self._read_block(index, selected, region)
+            block = self._block = (index, index + data.shape[0], key, data)
+        self.panels = block[3][index - block[0]]
+        if panels is None:
+            return tuple(flex.double(p) for p in self.panels)
+        position = dict((pid, i) for i, pid in enumerate(selected))
+        return tuple(flex.double(self.panels[position[pid]]) for pid in panels)
+
+    def get_raw_data(self, index=0):
+        return self.get_raw_panels(index)
 
     def get_detectorbase(self, index=None):
         raise NotImplementedError
@@ -93,18 +190,33 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
         return self._cctbx_detector
 
     def _get_wavelength(self, index):
-        if self._has_spectra:
-            w = self._weights[index]
-            E = self._energies[index]
-            ave_E = (w*E).sum() / (w.sum())
-            wavelength = self._ENERGY_CONV / ave_E
-            if self.HAS_SPECTRUM_BEAM:
-                self._w = w
-                self._E = E
-        elif self._has_central_wavelengths:
-            wavelength = self._central_wavelengths[index]
+        if index in self._spectrum_cache:
+            self._spectrum_cache[index] = self._spectrum_cache.pop(index)
         else:
-            wavelength = None
+            E = w = None
+            if self._event_rows is not None:
+                row = self._event_rows[index]
+                n = self._spectrum_lengths[row]
+                w = self._weights[row][:n]
+                E = self._energies[row][:n]
+                ave_E = (w*E).sum() / (w.sum())
+                wavelength = self._ENERGY_CONV / ave_E
+            elif self._has_spectra:
+                w = self._weights[index]
+                E = self._energies[index]
+                ave_E = (w*E).sum() / (w.sum())
+                wavelength = self._ENERGY_CONV / ave_E
+            elif self._has_central_wavelengths:
+                wavelength = self._central_wavelengths[index]
+            else:
+                wavelength = None
+            self._spectrum_cache[index] = (wavelength, E, w)
+            while len(self._spectrum_cache) > self.SPECTRUM_CACHE_SIZE:
+                self._spectrum_cache.popitem(last=False)
+        wavelength, E, w = self._spectrum_cache[index]
+        if self._has_spectra and self.HAS_SPECTRUM_BEAM:
+            self._w = w
+            self._E = E
         return wavelength
 
     def get_beam(self, index=0):
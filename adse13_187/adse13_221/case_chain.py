@@ -1,5 +1,6 @@
 from __future__ import division
-from LS49.adse13_187.cyto_batch import multipanel_sim
+from LS49.adse13_187.cyto_batch import multipanel_sim, multipanel_session
+import os
 from time import time
 import random, math
 from scitbx.array_family import flex
@@ -10,6 +11,23 @@ cube_diag = math.sqrt(1./3) # 0.57735
 unit_vectors = [(1,0,0), (0,1,0), (0,0,1), (cube_diag, cube_diag, cube_diag)]
 
 class case_chain_runner:
+  def simulate_event(self, CRYSTAL, Ncells_abc):
+    """Whitelist pixels of the current proposal, through the session when there is one.
+    Returns (whitelist_only, TIME_BG, TIME_BRAGG)."""
+    mos_aniso = (self.parameters["etaa"].proposal,
+                 self.parameters["etab"].proposal,
+                 self.parameters["etac"].proposal)
+    if self.session is not None:
+      result = self.session.simulate(CRYSTAL=CRYSTAL, Ncells_abc=Ncells_abc,
+        mos_spread=self.parameters["etaa"].proposal, mos_aniso=mos_aniso)
+    else:
+      result = multipanel_sim(CRYSTAL=CRYSTAL, cuda=True, Ncells_abc=Ncells_abc,
+        mos_spread=self.parameters["etaa"].proposal, mos_aniso=mos_aniso,
+        show_params=False, time_panels=False, include_background=False, skip_numpy=True,
+        **self.event)
+    whitelist_only, TIME_BG, TIME_BRAGG, self.exascale_mos_blocks = result
+    return whitelist_only, TIME_BG, TIME_BRAGG
+
   def chain_runner(self,expt,alt_expt,params,mask_array=None,n_cycles = 100, s_cycles=0,
       Zscore_callback=None, rmsd_callback=None):
 
@@ -87,42 +105,26 @@ class case_chain_runner:
     self.cycle_list = [key for key in self.ref_params]
     self.accept = flex.int()
 
+    # MULTIPANEL_SESSION=1 keeps the event setup (beam, detector, device allocations) across cycles
+    self.event = dict(DETECTOR=detector, BEAM=beam,
+        Famp = self.gpu_channels_singleton, energies=energies, fluxes=weights,
+        oversample=oversample, mos_dom=mosaic_spread_samples, mosaic_method=params.mosaic_spread.method,
+        beamsize_mm=beamsize_mm, profile=shapetype, verbose=verbose, spot_scale_override=spot_scale,
+        mask_file=mask_array, relevant_whitelist_order=self.relevant_whitelist_order)
+    self.session = None
+    if bool(int(os.environ.get("MULTIPANEL_SESSION",0))):
+      self.session = multipanel_session(**self.event)
+
     self.beginning_iteration = 0
     if s_cycles > 0:
       from LS49.adse13_187.adse13_221.simplex_method import simplex_detail
       # initialize prior to simplex
-      whitelist_only, TIME_BG, TIME_BRAGG, self.exascale_mos_blocks = multipanel_sim(
-        CRYSTAL=alt_crystal, DETECTOR=detector, BEAM=beam,
-        Famp = self.gpu_channels_singleton,
-        energies=energies, fluxes=weights,
-        cuda=True,
-        oversample=oversample, Ncells_abc=Ncells_abc,
-        mos_dom=mosaic_spread_samples, mos_spread=self.parameters["etaa"].proposal,
-        mos_aniso=(self.parameters["etaa"].proposal,
-                   self.parameters["etab"].proposal,
-                   self.parameters["etac"].proposal),
-        beamsize_mm=beamsize_mm,
-        profile=shapetype,
-        show_params=False,
-        time_panels=False, verbose=verbose,
-        spot_scale_override=spot_scale,
-        include_background=False,
-        mask_file=mask_array, skip_numpy=True,
-        relevant_whitelist_order=self.relevant_whitelist_order
-      )
+      whitelist_only, TIME_BG, TIME_BRAGG = self.simulate_event(alt_crystal, Ncells_abc)
       Rmsd,sigZ,LLG = Zscore_callback(kernel_model=whitelist_only, plot=False)
       self.accept.append(1)
       self.rmsd_chain.append(Rmsd); self.sigz_chain.append(sigZ); self.llg_chain.append(LLG)
 
-      PP = dict(detector=detector, beam=beam,
-        energies=energies, weights=weights,
-        oversample=oversample,
-        mosaic_spread_samples=mosaic_spread_samples,
-        beamsize_mm=beamsize_mm,
-        shapetype=shapetype,
-        verbose=verbose,
-        spot_scale=spot_scale,
-        mask_array=mask_array, Z=Zscore_callback)
+      PP = dict(Z=Zscore_callback)
 
       MIN = simplex_detail(alt_crystal, Ncells_abc, host_runner = self,
              PP = PP, n_cycles=n_cycles, s_cycles=s_cycles)
@@ -138,25 +140,7 @@ class case_chain_runner:
       elif turn=="ncells":
         Ncells_abc = self.parameters2["ncells"].get_current_model()
 
-      whitelist_only, TIME_BG, TIME_BRAGG, self.exascale_mos_blocks = multipanel_sim(
-        CRYSTAL=alt_crystal, DETECTOR=detector, BEAM=beam,
-        Famp = self.gpu_channels_singleton,
-        energies=energies, fluxes=weights,
-        cuda=True,
-        oversample=oversample, Ncells_abc=Ncells_abc,
-        mos_dom=mosaic_spread_samples, mos_spread=self.parameters["etaa"].proposal,
-        mos_aniso=(self.parameters["etaa"].proposal,
-                   self.parameters["etab"].proposal,
-                   self.parameters["etac"].proposal),
-        beamsize_mm=beamsize_mm,
-        profile=shapetype,
-        show_params=False,
-        time_panels=False, verbose=verbose,
-        spot_scale_override=spot_scale,
-        include_background=False,
-        mask_file=mask_array, skip_numpy=True,
-        relevant_whitelist_order=self.relevant_whitelist_order
-      )
+      whitelist_only, TIME_BG, TIME_BRAGG = self.simulate_event(alt_crystal, Ncells_abc)
       Rmsd,sigZ,LLG = Zscore_callback(kernel_model=whitelist_only, plot=False)
       if macro_iteration==self.beginning_iteration:
         for key in self.ref_params:
@@ -193,6 +177,9 @@ class case_chain_runner:
       del P
       TIME_EXA = time()-BEG
       print("\t\tExascale: time for Bragg sim: %.4fs; total: %.4fs\n" % (TIME_BRAGG, TIME_EXA))
+    if self.session is not None:
+      print("multipanel session: %d simulations on one event setup"%self.session.n_calls)
+      self.session.close()
     print ("MCMC <RMSD> %.2f"%(flex.mean(self.rmsd_chain[len(self.rmsd_chain)//2:])))
     print ("MCMC <sigz> %.2f"%(flex.mean(self.sigz_chain[len(self.sigz_chain)//2:])))
     print ("MCMC <-LLG> %.2f"%(flex.mean(self.llg_chain[len(self.llg_chain)//2:])))
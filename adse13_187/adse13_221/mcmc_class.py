@@ -45,8 +45,7 @@ class case_DS1 (MCMC_manager):
     from simtbx.nanoBragg import utils
     print("Experiment %d" % i_exp, flush=True)
 
-    from LS49.adse13_187.case_data import retrieve_from_repo
-    experiment_file = retrieve_from_repo(i_exp)
+    from LS49.adse13_187.case_data import retrieve_case
     cuda = True  # False  # whether to use cuda
     mosaic_spread = 0.00  # degrees
     mosaic_spread_samples = 250 # XXX Fixme make this a parameter
@@ -61,9 +60,7 @@ class case_DS1 (MCMC_manager):
     flat = True  # enfore that the camera has 0 thickness
     #<><><><><><><><>
     os.environ["NXMX_LOCAL_DATA"]="/global/cfs/cdirs/m3562/der/master_files/run_000795.JF07T32V01_master.h5"
-    El = ExperimentListFactory.from_json_file(experiment_file,
-                                              check_format=True)
-    exper = El[0]
+    exper = retrieve_case(i_exp) # from the CASE_DATA_CACHE file if exported
 
     crystal = exper.crystal
     detector = exper.detector
@@ -83,11 +80,7 @@ class case_DS1 (MCMC_manager):
     beam = exper.beam
 
     # XXX new code
-    spec = exper.imageset.get_spectrum(0)
-    energies_raw, weights_raw = spec.get_energies_eV().as_numpy_array(), \
-                                spec.get_weights().as_numpy_array()
-    energies, weights = utils.downsample_spectrum(energies_raw, weights_raw, method=1, total_flux=total_flux,
-                                                  ev_width=ev_res)
+    energies, weights = exper.downsample_spectrum(method=1, total_flux=total_flux, ev_width=ev_res)
 
     if flat:
         assert detector[0].get_thickness() == 0
@@ -140,8 +133,7 @@ class case_228 (MCMC_manager):
     from simtbx.nanoBragg import utils
     print("Experiment %d" % i_exp, flush=True)
 
-    from LS49.adse13_187.case_data import retrieve_from_repo
-    experiment_file = retrieve_from_repo(i_exp)
+    from LS49.adse13_187.case_data import retrieve_case
     cuda = True  # False  # whether to use cuda
     mosaic_spread = 0.07  # degrees
     mosaic_spread_samples = 500 # XXX Fixme make this a parameter
@@ -156,9 +148,7 @@ class case_228 (MCMC_manager):
     flat = True  # enfore that the camera has 0 thickness
     #<><><><><><><><>
     os.environ["NXMX_LOCAL_DATA"]="/global/cfs/cdirs/m3562/der/master_files/run_000795.JF07T32V01_master.h5"
-    El = ExperimentListFactory.from_json_file(experiment_file,
-                                              check_format=True)
-    exper = El[0]
+    exper = retrieve_case(i_exp) # from the CASE_DATA_CACHE file if exported
 
     crystal = exper.crystal
     detector = exper.detector
@@ -172,11 +162,7 @@ class case_228 (MCMC_manager):
     beam = exper.beam
 
     # XXX new code
-    spec = exper.imageset.get_spectrum(0)
-    energies_raw, weights_raw = spec.get_energies_eV().as_numpy_array(), \
-                                spec.get_weights().as_numpy_array()
-    energies, weights = utils.downsample_spectrum(energies_raw, weights_raw, method=1, total_flux=total_flux,
-                                                  ev_width=ev_res)
+    energies, weights = exper.downsample_spectrum(method=1, total_flux=total_flux, ev_width=ev_res)
 
     if flat:
         assert detector[0].get_thickness() == 0
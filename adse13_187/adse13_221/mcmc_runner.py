@@ -139,6 +139,10 @@ def generate_phil_scope():
           .help = Mahalanobis units (number of standard deviations to scale the jump).
       }
       mosaic_spread {
+        method = *double_uniform memoised_pairs
+          .type = choice
+          .help = mosaic_method of the simulation (LS49.adse13_187.cyto_batch); memoised_pairs
+          .help = serves each (eta_a, eta_b, eta_c) proposal from rescaled, memoised draws
         hyperparameter = 0.2
           .type = float(value_min=0.001, value_max=0.9)
           .help = The allowable range of proposal values as a multiplier of current value.
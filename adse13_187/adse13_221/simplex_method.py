@@ -1,7 +1,6 @@
 from __future__ import division
 from scitbx.array_family import flex
 from scitbx.simplex import simplex_opt
-from LS49.adse13_187.cyto_batch import multipanel_sim
 import copy
 from time import time
 
@@ -63,25 +62,8 @@ class simplex_detail:
           if "ncells" in selfOO.crnm.ref_params:
             selfOO.Ncells_abc = selfOO.crnm.ref_params["ncells"].get_current_model()
 
-          whitelist_only, TIME_BG, TIME_BRAGG, selfOO.crnm.exascale_mos_blocks = multipanel_sim(
-        CRYSTAL=selfOO.alt_crystal, DETECTOR=selfOO.PP["detector"], BEAM=selfOO.PP["beam"],
-        Famp = selfOO.crnm.gpu_channels_singleton,
-        energies=selfOO.PP["energies"], fluxes=selfOO.PP["weights"],
-        cuda=True,
-        oversample=selfOO.PP["oversample"], Ncells_abc=selfOO.Ncells_abc,
-        mos_dom=selfOO.PP["mosaic_spread_samples"], mos_spread=selfOO.crnm.parameters["etaa"].proposal,
-        mos_aniso=(selfOO.crnm.parameters["etaa"].proposal,
-                   selfOO.crnm.parameters["etab"].proposal,
-                   selfOO.crnm.parameters["etac"].proposal),
-        beamsize_mm=selfOO.PP["beamsize_mm"],
-        profile=selfOO.PP["shapetype"],
-        show_params=False,
-        time_panels=False, verbose=selfOO.PP["verbose"],
-        spot_scale_override=selfOO.PP["spot_scale"],
-        include_background=False,
-        mask_file=selfOO.PP["mask_array"], skip_numpy=True,
-        relevant_whitelist_order=selfOO.crnm.relevant_whitelist_order
-      )
+          whitelist_only, TIME_BG, TIME_BRAGG = selfOO.crnm.simulate_event(
+            selfOO.alt_crystal, selfOO.Ncells_abc)
           Rmsd,sigZ,LLG = selfOO.PP["Z"](kernel_model=whitelist_only, plot=False)
           #print ("Old NLL ",selfOO.crnm.llg_chain[-1], "NEW LLG",LLG, "diff",selfOO.crnm.llg_chain[-1] - LLG)
           for key in selfOO.crnm.ref_params:
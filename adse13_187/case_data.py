@@ -1,5 +1,5 @@
 from __future__ import division
-import os, shutil
+import os, shutil, json, struct
 from LS49 import ls49_big_data
 """Main idea:  these file names represent the top 75 diffracting events in Run795
 of the Oct. 2019 SwissFEL Bernina data collection.  Get the file names with function
@@ -41,7 +41,145 @@ def retrieve_from_repo(N):
   targetdir = os.path.join(ls49_big_data,"adse13_228")
   return os.path.join(targetdir, lookup_repo[N])
 
+# Preloaded case data.  Every job that simulates event N loads retrieve_from_repo(N)
+# with check_format=True (opening the NeXus master to reach the spectrum) and then runs
+# utils.downsample_spectrum.  build_case_cache() does this once for all events and
+# writes one file:
+#
+#   b"LS49CASE", uint64 header length, JSON header, padding to 8 bytes, float64 payload
+#
+# The header holds each event's beam and crystal dicts, an index into a table of
+# distinct detector dicts, and (offset, length) into the payload for the raw and the
+# downsampled spectrum.  Every rank maps the payload read-only.  Export
+# CASE_DATA_CACHE=<file> and retrieve_case(N) serves the event from it, falling back
+# to the experiment list for events not in the file.  Build with
+#
+#   NXMX_LOCAL_DATA=<master.h5> libtbx.python case_data.py cache <file>
+
+MAGIC = b"LS49CASE"
+DOWNSAMPLE = dict(method=1, total_flux=1e12, ev_width=1.5) # as in cyto_batch and mcmc_class
+
+class case(object):
+  """What the run795 scripts take from an event's experiment list"""
+  def __init__(self, N, detector, beam, crystal, energies_raw, weights_raw, downsampled=None,
+               exper=None):
+    self.N = N
+    self.detector = detector
+    self.beam = beam
+    self.crystal = crystal
+    self.energies_raw = energies_raw
+    self.weights_raw = weights_raw
+    self.downsampled = downsampled # (DOWNSAMPLE, energies, weights) or None
+    self.exper = exper # the experiment when loaded from the experiment list, else None
+
+  def downsample_spectrum(self, method=1, total_flux=1e12, ev_width=1.5):
+    """As utils.downsample_spectrum of the raw spectrum; precomputed for DOWNSAMPLE"""
+    import numpy as np
+    if self.downsampled is not None and self.downsampled[0] == dict(
+        method=method, total_flux=total_flux, ev_width=ev_width):
+      return np.array(self.downsampled[1]), np.array(self.downsampled[2])
+    from simtbx.nanoBragg import utils
+    return utils.downsample_spectrum(self.energies_raw, self.weights_raw, method=method,
+                                     total_flux=total_flux, ev_width=ev_width)
+
+  def experiment(self):
+    """The full experiment, with the imageset, e.g. for the measured pixels; loaded at
+    most once"""
+    if self.exper is None:
+      from dxtbx.model.experiment_list import ExperimentListFactory
+      self.exper = ExperimentListFactory.from_json_file(retrieve_from_repo(self.N),
+                                                        check_format=True)[0]
+    return self.exper
+
+def case_from_experiment(N):
+  from dxtbx.model.experiment_list import ExperimentListFactory
+  exper = ExperimentListFactory.from_json_file(retrieve_from_repo(N), check_format=True)[0]
+  spec = exper.imageset.get_spectrum(0)
+  return case(N, exper.detector, exper.beam, exper.crystal,
+              spec.get_energies_eV().as_numpy_array(), spec.get_weights().as_numpy_array(),
+              exper=exper)
+
+class case_cache(object):
+  def __init__(self, path):
+    import numpy as np
+    with open(path, "rb") as F:
+      assert F.read(len(MAGIC)) == MAGIC, "not a case data cache: %s"%path
+      length, = struct.unpack("<Q", F.read(8))
+      self.header = json.loads(F.read(length).decode())
+    self.payload = np.memmap(path, dtype=np.float64, mode="r",
+                             offset=self.header["payload_offset"])
+
+  def __contains__(self, N):
+    return str(N) in self.header["events"]
+
+  def case(self, N):
+    from dxtbx.model.beam import BeamFactory
+    from dxtbx.model.crystal import CrystalFactory
+    from dxtbx.model.detector import DetectorFactory
+    event = self.header["events"][str(N)]
+    arrays = dict((name, self.payload[offset:offset+n])
+                  for name, (offset, n) in event["arrays"].items())
+    return case(N, DetectorFactory.from_dict(self.header["detectors"][event["detector"]]),
+                BeamFactory.from_dict(event["beam"]), CrystalFactory.from_dict(event["crystal"]),
+                arrays["energies_raw"], arrays["weights_raw"],
+                (self.header["downsample"], arrays["energies"], arrays["weights"]))
+
+def build_case_cache(path, events=None):
+  """Load every event once and write the cache file; the payload is written before the
+  file is renamed into place, so readers never see a partial cache"""
+  import numpy as np
+  if events is None: events = sorted(lookup_repo)
+  header = dict(version=1, downsample=DOWNSAMPLE, detectors=[], events={})
+  payload = []
+  offset = 0
+  for N in events:
+    item = case_from_experiment(N)
+    energies, weights = item.downsample_spectrum(**DOWNSAMPLE)
+    detector = item.detector.to_dict()
+    if detector not in header["detectors"]: header["detectors"].append(detector)
+    arrays = {}
+    for name, values in [("energies_raw", item.energies_raw), ("weights_raw", item.weights_raw),
+                         ("energies", energies), ("weights", weights)]:
+      values = np.asarray(values, dtype=np.float64)
+      arrays[name] = (offset, len(values))
+      payload.append(values)
+      offset += len(values)
+    header["events"][str(N)] = dict(expt=lookup_repo[N],
+      detector=header["detectors"].index(detector), beam=item.beam.to_dict(),
+      crystal=item.crystal.to_dict(), arrays=arrays)
+    print("cached event", N, lookup_repo[N])
+  # the payload offset is part of the header, so iterate until the length is stable
+  header["payload_offset"] = 0
+  while True:
+    text = json.dumps(header).encode()
+    payload_offset = len(MAGIC) + 8 + len(text)
+    payload_offset += -payload_offset % 8
+    if payload_offset == header["payload_offset"]: break
+    header["payload_offset"] = payload_offset
+  tmp = "%s.%d.tmp"%(path, os.getpid())
+  with open(tmp, "wb") as F:
+    F.write(MAGIC)
+    F.write(struct.pack("<Q", len(text)))
+    F.write(text)
+    F.write(b"\0" * (payload_offset - F.tell()))
+    if len(payload) > 0: np.concatenate(payload).tofile(F)
+  os.rename(tmp, path)
+
+_cache = []
+def retrieve_case(N):
+  """Event N from the CASE_DATA_CACHE file when exported and present, else from the
+  experiment list"""
+  path = os.environ.get("CASE_DATA_CACHE")
+  if path is not None and os.path.isfile(path):
+    if len(_cache) == 0: _cache.append(case_cache(path))
+    if N in _cache[0]: return _cache[0].case(N)
+  return case_from_experiment(N)
+
 if __name__=="__main__":
-  lookup_cori, lookup_repo = lookup_top(75)
-  #print (lookup_repo)
-  fetch_to_repo(lookup_cori, lookup_repo)
+  import sys
+  if sys.argv[1:2] == ["cache"]:
+    build_case_cache(sys.argv[2])
+  else:
+    lookup_cori, lookup_repo = lookup_top(75)
+    #print (lookup_repo)
+    fetch_to_repo(lookup_cori, lookup_repo)
@@ -57,6 +57,13 @@ def parse_input():
     write_output = False
       .type = bool
       .help = whether to write an output image file (hdf5)
+    event_container = None
+      .type = path
+      .help = if write_output, append the events to one multi-event HDF5 file per rank in
+      .help = this directory (LS49.adse13_187.event_container) instead of writing
+      .help = exap_%d.hdf5 and boop_%d.hdf5 per event
+    event_container_compression = *gzip lzf none
+      .type = choice
     write_experimental_data = False
       .type = bool
       .help = if hdf5 file is written, also include a frame giving the experimental data
@@ -68,11 +75,13 @@ def parse_input():
     mosaic_spread_samples = 500
       .type = int
       .help = granularity of mosaic rotation, double it to find number of umats
-    mosaic_method = double_random double_uniform*
+    mosaic_method = double_random double_uniform* memoised_pairs
       .type = choice
       .help = algorithm for calculating an isotropic distribution of mosaic umats
       .help = double_random, uses rnd number generator for both angle and axis of rotation (legacy)
       .help = double_uniform uses uniform distribution of angle and axis, but matches them with rnd sequence
+      .help = memoised_pairs, normal angles about random axes plus inverses, from LS49.sim.mosaic_domains
+      .help = (a different model from the double_* ones; anisotropic spreads scale the draws per axis)
     mask_file = ""
       .type = path
       .help = for the exascale api only, specifying this path chooses the debranched-maskall kernel
@@ -94,6 +103,39 @@ def parse_input():
   params, options = parser.parse_args(show_diff_phil=True,quick_parse=True)
   return params,options
 
+# SimData Umats_method of each mosaic_method; memoised_pairs leaves SimData a single block
+UMATS_METHOD = dict(double_random=0, double_uniform=5, memoised_pairs=5)
+
+def uses_memoised_blocks(mosaic_method):
+  """mosaic_method=memoised_pairs: the blocks come from LS49.sim.mosaic_domains (normal_pairs,
+  or anisotropic_pairs for a mos_aniso), memoised per rank and rescaled for new spreads,
+  instead of SimData drawing 2*mos_dom of them per call.  This is its own mosaicity model,
+  not a faster route to SimData's double_random or double_uniform blocks."""
+  return mosaic_method == "memoised_pairs"
+
+def mosaic_cache_crystal(nbCrystal):
+  """Leave SimData a single unrotated block; push_cached_mosaic_blocks supplies the rest"""
+  nbCrystal.n_mos_domains = 1
+  nbCrystal.mos_spread_deg = 0
+  nbCrystal.anisotropic_mos_spread_deg = None
+
+def push_cached_mosaic_blocks(S, mos_dom, mos_spread, mos_aniso, seeds=None):
+  """Install the memoised blocks in the nanoBragg instance S.D; call after instantiate or
+  _crystal_properties and before the exascale_api allocation"""
+  from LS49.sim.mosaic_domains import mosaic_domains
+  seed = (0,1234) if seeds is None else tuple(seeds)
+  if mos_aniso is not None and max(mos_aniso) > 0:
+    UMAT_nm = mosaic_domains.umats(mos_aniso, mos_dom, method="anisotropic_pairs", seed=seed)
+    spread = max(mos_aniso)
+  elif mos_spread > 0:
+    UMAT_nm = mosaic_domains.umats(mos_spread, mos_dom, method="normal_pairs", seed=seed)
+    spread = mos_spread
+  else: return # no mosaicity, SimData's single block stands
+  S.D.mosaic_spread_deg = spread
+  S.D.mosaic_domains = len(UMAT_nm) # mosaic_domains setter must come after mosaic_spread_deg setter
+  S.D.set_mosaic_blocks(UMAT_nm)
+  S.exascale_mos_blocks = UMAT_nm
+
 def multipanel_sim(
   CRYSTAL, DETECTOR, BEAM, Famp, energies, fluxes,
   background_wavelengths=None, background_wavelength_weights=None,
@@ -107,7 +149,8 @@ def multipanel_sim(
   spot_scale_override=None, show_params=False, time_panels=False,
   add_water = False, add_air=False, water_path_mm=0.005, air_path_mm=0,
   adc_offset=0, readout_noise=3, psf_fwhm=0, gain=1, mosaicity_random_seeds=None,
-  include_background=True, mask_file="",skip_numpy=False,relevant_whitelist_order=None):
+  include_background=True, mask_file="",skip_numpy=False,relevant_whitelist_order=None,
+  backend=None):
 
   from simtbx.nanoBragg.nanoBragg_beam import NBbeam
   from simtbx.nanoBragg.nanoBragg_crystal import NBcrystal
@@ -135,6 +178,8 @@ def multipanel_sim(
   nbCrystal.n_mos_domains = mos_dom
   nbCrystal.mos_spread_deg = mos_spread
   nbCrystal.anisotropic_mos_spread_deg = mos_aniso
+  mosaic_cache = uses_memoised_blocks(mosaic_method)
+  if mosaic_cache: mosaic_cache_crystal(nbCrystal)
 
   pid = 0 # remove the loop, use C++ iteration over detector panels
   use_exascale_api = True
@@ -153,13 +198,15 @@ def multipanel_sim(
     S.gain = gain
     S.psf_fwhm = psf_fwhm
     S.include_noise = False
-    S.Umats_method = dict(double_random=0, double_uniform=5)[mosaic_method]
+    S.Umats_method = UMATS_METHOD[mosaic_method]
 
     if mosaicity_random_seeds is not None:
       S.mosaic_seeds = mosaicity_random_seeds
 
     S.instantiate_nanoBragg(verbose=verbose, oversample=oversample, interpolate=interpolate,
       device_Id=Famp.get_deviceID(),default_F=default_F, adc_offset=adc_offset)
+    if mosaic_cache:
+      push_cached_mosaic_blocks(S, mos_dom, mos_spread, mos_aniso, mosaicity_random_seeds)
 
     SIM = S.D # the nanoBragg instance
     assert Famp.get_deviceID()==SIM.device_Id
@@ -167,12 +214,12 @@ def multipanel_sim(
       SIM.spot_scale = spot_scale_override
     assert Famp.get_nchannels() == 1 # non-anomalous scenario
 
-    from simtbx.gpu import exascale_api
-    gpu_simulation = exascale_api(nanoBragg = SIM)
+    if backend is None:
+      import simtbx.gpu as backend
+    gpu_simulation = backend.exascale_api(nanoBragg = SIM)
     gpu_simulation.allocate() # presumably done once for each image
 
-    from simtbx.gpu import gpu_detector as gpud
-    gpu_detector = gpud(deviceId=SIM.device_Id, detector=DETECTOR,
+    gpu_detector = backend.gpu_detector(deviceId=SIM.device_Id, detector=DETECTOR,
                         beam=BEAM)
     gpu_detector.each_image_allocate()
 
@@ -239,6 +286,157 @@ def multipanel_sim(
     gpu_detector.each_image_free()
     return packed_numpy.as_numpy_array(), TIME_BG, TIME_BRAGG, S.exascale_mos_blocks or None
 
+class multipanel_session(object):
+  """Event-level state of multipanel_sim, for callers that simulate the same event many
+  times (one call per Metropolis cycle in case_chain.chain_runner, per vertex in the
+  simplex).  Beam, spectrum, SimData/nanoBragg, the gpu_detector allocation, the
+  amplitudes and the whitelist are set up once; simulate() takes only what changes per
+  call (crystal model, Ncells, mosaic spread) and returns the same tuple as
+  multipanel_sim(..., include_background=False, skip_numpy=True).  backend is the
+  simtbx module providing exascale_api and gpu_detector (simtbx.gpu by default).
+
+  The exascale_api device copy of the nanoBragg state is not kept: exascale_api has no
+  call that uploads only the crystal (A matrix, Ncells, mosaic blocks), so every call
+  after the first still runs deallocate() + allocate() on it, as multipanel_sim does.
+  What the session saves per call is the SimData/nanoBragg construction, the detector
+  allocation and the mask read; that saving has not been measured.
+  """
+  def __init__(self, DETECTOR, BEAM, Famp, energies, fluxes,
+    oversample=0, mos_dom=1, mosaic_method="double_uniform", beamsize_mm=0.001,
+    crystal_size_mm=0.01, verbose=0, default_F=0, interpolate=0, profile="gauss",
+    spot_scale_override=None, adc_offset=0, readout_noise=3, psf_fwhm=0, gain=1,
+    mosaicity_random_seeds=None, mask_file="", relevant_whitelist_order=None, backend=None):
+    from simtbx.nanoBragg.nanoBragg_beam import NBbeam
+    from scitbx.array_family import flex
+    from scipy import constants
+    import numpy as np
+    if backend is None:
+      import simtbx.gpu as backend
+    self.backend = backend
+    ENERGY_CONV = 10000000000.0 * constants.c * constants.h / constants.electron_volt
+    self.DETECTOR = DETECTOR; self.BEAM = BEAM; self.Famp = Famp
+    assert Famp.get_nchannels() == 1 # non-anomalous scenario
+    self.nbBeam = NBbeam()
+    self.nbBeam.size_mm = beamsize_mm
+    self.nbBeam.unit_s0 = BEAM.get_unit_s0()
+    wavelengths = ENERGY_CONV / np.array(energies)
+    self.nbBeam.spectrum = list(zip(wavelengths, fluxes))
+    self.crystal_args = dict(crystal_size_mm=crystal_size_mm, profile=profile, mos_dom=mos_dom)
+    self.instantiate_args = dict(verbose=verbose, oversample=oversample, interpolate=interpolate,
+      device_Id=Famp.get_deviceID(), default_F=default_F, adc_offset=adc_offset)
+    self.sim_args = dict(readout_noise=readout_noise, gain=gain, psf_fwhm=psf_fwhm,
+      Umats_method=UMATS_METHOD[mosaic_method],
+      mosaicity_random_seeds=mosaicity_random_seeds)
+    self.spot_scale_override = spot_scale_override
+    self.mosaic_cache = uses_memoised_blocks(mosaic_method)
+    if type(mask_file) is str and mask_file != "":
+      from LS49.adse13_187.adse13_221.mask_utils import mask_from_file
+      mask_file = mask_from_file(mask_file) # read once per event
+    self.mask = mask_file
+    assert relevant_whitelist_order is not None, "the session returns whitelist pixels only"
+    self.relevant_whitelist_order = relevant_whitelist_order
+    self.S = None
+    self.gpu_simulation = None
+    self.gpu_detector = None
+    self.n_calls = 0
+
+  def _crystal(self, CRYSTAL, Ncells_abc, mos_spread, mos_aniso):
+    from simtbx.nanoBragg.nanoBragg_crystal import NBcrystal
+    nbCrystal = NBcrystal(False)
+    nbCrystal.dxtbx_crystal = CRYSTAL
+    nbCrystal.Ncells_abc = Ncells_abc
+    nbCrystal.symbol = CRYSTAL.get_space_group().info().type().lookup_symbol()
+    nbCrystal.thick_mm = self.crystal_args["crystal_size_mm"]
+    nbCrystal.xtal_shape = self.crystal_args["profile"]
+    nbCrystal.n_mos_domains = self.crystal_args["mos_dom"]
+    nbCrystal.mos_spread_deg = mos_spread
+    nbCrystal.anisotropic_mos_spread_deg = mos_aniso
+    self.mosaicity = (mos_spread, mos_aniso)
+    if self.mosaic_cache: mosaic_cache_crystal(nbCrystal)
+    return nbCrystal
+
+  def _push_mosaic_blocks(self):
+    if self.mosaic_cache:
+      push_cached_mosaic_blocks(self.S, self.crystal_args["mos_dom"], self.mosaicity[0],
+        self.mosaicity[1], self.sim_args["mosaicity_random_seeds"])
+
+  def _instantiate(self, nbCrystal):
+    from simtbx.nanoBragg.sim_data import SimData
+    S = SimData(use_default_crystal = False)
+    S.detector = self.DETECTOR
+    S.beam = self.nbBeam
+    S.crystal = nbCrystal
+    S.panel_id = 0
+    S.add_air = False
+    S.add_water = False
+    S.readout_noise = self.sim_args["readout_noise"]
+    S.gain = self.sim_args["gain"]
+    S.psf_fwhm = self.sim_args["psf_fwhm"]
+    S.include_noise = False
+    S.Umats_method = self.sim_args["Umats_method"]
+    if self.sim_args["mosaicity_random_seeds"] is not None:
+      S.mosaic_seeds = self.sim_args["mosaicity_random_seeds"]
+    S.instantiate_nanoBragg(**self.instantiate_args)
+    assert self.Famp.get_deviceID()==S.D.device_Id
+    if self.spot_scale_override is not None:
+      S.D.spot_scale = self.spot_scale_override
+    self.S = S
+    self._push_mosaic_blocks()
+    self.gpu_simulation = self.backend.exascale_api(nanoBragg = S.D)
+    self.gpu_simulation.allocate()
+    self.gpu_detector = self.backend.gpu_detector(deviceId=S.D.device_Id, detector=self.DETECTOR,
+                                                  beam=self.BEAM)
+    self.gpu_detector.each_image_allocate()
+
+  def _update_crystal(self, nbCrystal):
+    # the detector, beam and spectrum stay; only the crystal properties (A matrix, Ncells,
+    # mosaic blocks) are pushed to the existing nanoBragg instance.  exascale_api copies
+    # the whole nanoBragg state in allocate(), so its device copy is remade every call.
+    self.S.crystal = nbCrystal
+    self.S._crystal_properties()
+    self._push_mosaic_blocks()
+    if self.spot_scale_override is not None:
+      self.S.D.spot_scale = self.spot_scale_override
+    if hasattr(self.gpu_simulation, "deallocate"):
+      self.gpu_simulation.deallocate()
+      self.gpu_simulation.allocate()
+    else:
+      self.gpu_simulation = self.backend.exascale_api(nanoBragg = self.S.D)
+      self.gpu_simulation.allocate()
+    self.gpu_detector.scale_in_place(0.) # clears the accumulated pixels, keeps the allocation
+
+  def simulate(self, CRYSTAL, Ncells_abc, mos_spread, mos_aniso=None):
+    from scitbx.array_family import flex
+    nbCrystal = self._crystal(CRYSTAL, Ncells_abc, mos_spread, mos_aniso)
+    if self.S is None: self._instantiate(nbCrystal)
+    else: self._update_crystal(nbCrystal)
+    self.n_calls += 1
+    x = 0 # only one energy channel
+    P = Profiler("%40s"%"session from gpu amplitudes cuda")
+    if type(self.mask) is str: # all-pixel kernel
+      self.gpu_simulation.add_energy_channel_from_gpu_amplitudes(
+        x, self.Famp, self.gpu_detector)
+    elif type(self.mask) is flex.int:
+      self.gpu_simulation.add_energy_channel_mask_allpanel(
+        channel_number = x, gpu_amplitudes = self.Famp, gpu_detector = self.gpu_detector,
+        pixel_active_list_ints = self.mask )
+    else:
+      self.gpu_simulation.add_energy_channel_mask_allpanel(
+        channel_number = x, gpu_amplitudes = self.Famp, gpu_detector = self.gpu_detector,
+        pixel_active_mask_bools = self.mask )
+    TIME_BRAGG = time()-P.start_el
+    del P
+    whitelist_only = self.gpu_detector.get_whitelist_raw_pixels(self.relevant_whitelist_order)
+    assert len(whitelist_only) == len(self.relevant_whitelist_order) # guard against shoebox overlap bug
+    return whitelist_only, 0., TIME_BRAGG, self.S.exascale_mos_blocks or None
+
+  def close(self):
+    if self.gpu_detector is not None:
+      self.gpu_detector.each_image_free()
+    self.gpu_detector = None
+    self.gpu_simulation = None
+    self.S = None
+
 def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
     from simtbx.nanoBragg import utils
     from dxtbx.model.experiment_list import ExperimentListFactory
@@ -246,10 +444,15 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
 
     print("Experiment %d" % i_exp, flush=True)
     sys.stdout.flush()
+    if params.write_output and params.event_container is not None:
+      from LS49.adse13_187.event_container import rank_event_container
+      if rank_event_container(params.event_container, rank,
+          compression=params.event_container_compression).has(i_exp):
+        print("Event %d is already in the event container, skipping" % i_exp)
+        return
 
     outfile = "boop_%d.hdf5" % i_exp
-    from LS49.adse13_187.case_data import retrieve_from_repo
-    experiment_file = retrieve_from_repo(i_exp)
+    from LS49.adse13_187.case_data import retrieve_case
     # Not used # refl_file = "/global/cfs/cdirs/m3562/der/run795/top_%d.refl" % i_exp
     cuda = True  # False  # whether to use cuda
     omp = False
@@ -270,9 +473,7 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
     flat = True  # enfore that the camera has 0 thickness
     #<><><><><><><><>
     # XXX new code
-    El = ExperimentListFactory.from_json_file(experiment_file,
-                                              check_format=True)
-    exper = El[0]
+    exper = retrieve_case(i_exp) # from the CASE_DATA_CACHE file if exported
 
     crystal = exper.crystal
     detector = exper.detector
@@ -286,11 +487,7 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
     beam = exper.beam
 
     # XXX new code
-    spec = exper.imageset.get_spectrum(0)
-    energies_raw, weights_raw = spec.get_energies_eV().as_numpy_array(), \
-                                spec.get_weights().as_numpy_array()
-    energies, weights = utils.downsample_spectrum(energies_raw, weights_raw, method=1, total_flux=total_flux,
-                                                  ev_width=ev_res)
+    energies, weights = exper.downsample_spectrum(method=1, total_flux=total_flux, ev_width=ev_res)
 
     if flat:
         assert detector[0].get_thickness() == 0
@@ -339,7 +536,7 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
       TIME_EXA = time()-BEG
       print ("Exascale time",TIME_EXA)
       if params.write_experimental_data:
-        data = exper.imageset.get_raw_data(0)
+        data = exper.experiment().imageset.get_raw_data(0)
 
       tsave = time()
       img_sh = JF16M_numpy_array.shape
@@ -353,7 +550,7 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
         beam_dict.pop("spectrum_weights")
       except Exception: pass
 # XXX no longer have two separate files
-      if params.write_output:
+      if params.write_output and params.event_container is None: # else the boop event holds these frames
        with utils.H5AttributeGeomWriter("exap_%d.hdf5"%i_exp,
                                 image_shape=img_sh, num_images=num_output_images,
                                 detector=det_dict, beam=beam_dict,
@@ -416,7 +613,7 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
         #    new_det.add_panel(detector[pid])
         #detector = new_det
     if params.write_experimental_data:
-        data = exper.imageset.get_raw_data(0)
+        data = exper.experiment().imageset.get_raw_data(0)
 
     tsave = time()
     pdata = np.array(pdata) # now pdata is a numpy array of shape 256,254,254
@@ -429,7 +626,23 @@ def tst_one(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params):
       beam_dict.pop("spectrum_energies")
       beam_dict.pop("spectrum_weights")
     except Exception: pass
-    if params.write_output:
+    if params.write_output and params.event_container is not None:
+      from LS49.adse13_187.event_container import rank_event_container
+      container = rank_event_container(params.event_container, rank,
+        compression=params.event_container_compression)
+      frames = [("ratio", JF16M_numpy_array/pdata), ("exascale", JF16M_numpy_array),
+                ("vintage", pdata)]
+      if params.write_experimental_data:
+        frames.append(("experimental", [data[pid].as_numpy_array() for pid in panel_list]))
+      container.add_event(i_exp, frames, detector=det_dict, beam=beam_dict,
+        energies=energies, weights=weights,
+        parameters=dict(Ncells_abc=Ncells_abc, mosaic_spread=mosaic_spread,
+                        mosaic_spread_samples=mosaic_spread_samples, spot_scale=spot_scale,
+                        total_flux=total_flux, beamsize_mm=beamsize_mm, oversample=oversample,
+                        crystal_A=crystal.get_A(), central_wavelength=mn_wave))
+      tsave = time() - tsave
+      print("Saved event %d to %s. Saving took %.4f sec" % (i_exp, container.filename, tsave, ))
+    elif params.write_output:
       print("Saving output data of shape", img_sh)
       with utils.H5AttributeGeomWriter(outfile, image_shape=img_sh, num_images=num_output_images,
                                 detector=det_dict, beam=beam_dict,
@@ -532,6 +745,9 @@ def run_batch_job(test_without_mpi=False):
     )
     parcels.remove(idx)
     print("idx------finis-------->",idx,"rank",rank,time(),"elapsed",time()-cache_time)
+  if params.write_output and params.event_container is not None:
+    from LS49.adse13_187.event_container import rank_event_container
+    rank_event_container(params.event_container, rank).close()
   comm.barrier()
   print("Overall rank",rank,"at",datetime.datetime.now(),
         "seconds elapsed after srun startup %.3f"%(time()-start_elapse))
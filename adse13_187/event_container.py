@@ -0,0 +1,118 @@
+from __future__ import division, print_function
+import os
+import numpy as np
+
+"""Multi-event HDF5 containers for the cyto_batch outputs.
+
+Instead of one H5AttributeGeomWriter file per simulated event (boop_%d.hdf5, with the
+256-panel detector and beam attribute strings written again each time), each rank
+appends its events to one chunked, optionally compressed file:
+
+  images               (N_frames, panels, slow, fast) float32, one panel per chunk;
+                       attrs dxtbx_detector_string and dxtbx_beam_string, written once
+  event_row            (N_frames,) row of the frame's event in events/
+  frame                (N_frames,) index into frame.attrs["names"]
+  events/i_exp                 (N_events,) run795 event number
+  events/spectrum_energies     (N_events, n) downsampled spectrum, zero padded
+  events/spectrum_weights      (N_events, n)
+  events/spectrum_length       (N_events,) valid channels of the spectrum rows
+  events/<parameter>           (N_events, ...) model parameters (Ncells_abc, crystal A, ...)
+
+Every dataset is extendable.  The file is written in SWMR mode, so readers may open
+it while the rank is still appending: FormatHDF5AttributeGeometry recognizes the
+layout (event_row present), opens it with swmr=True and indexes the spectra through
+event_row.  Select in cyto_batch with event_container=<directory> and
+event_container_compression=gzip|lzf|none.
+"""
+
+from LS49.sim.image_container import COMPRESSION
+
+FRAMES = ("ratio", "exascale", "vintage", "experimental")
+
+class event_container(object):
+  def __init__(self, filename, compression="gzip"):
+    import h5py
+    self.filename = filename
+    self.compression = compression
+    self.handle = h5py.File(filename, "a", libver="latest")
+    self.done = set()
+    if "events" in self.handle:
+      self.done = set(int(i) for i in self.handle["events/i_exp"][:])
+      self.handle.swmr_mode = True
+
+  def __len__(self):
+    return self.handle["events/i_exp"].shape[0] if "events" in self.handle else 0
+
+  def has(self, i_exp):
+    return i_exp in self.done
+
+  def _create(self, image_shape, detector, beam, parameters):
+    images = self.handle.create_dataset("images", shape=(0,)+image_shape,
+      maxshape=(None,)+image_shape, chunks=(1,1)+image_shape[1:], dtype=np.float32,
+      **COMPRESSION[self.compression])
+    images.attrs["dxtbx_detector_string"] = str(detector)
+    images.attrs["dxtbx_beam_string"] = str(beam)
+    self.handle.create_dataset("event_row", shape=(0,), maxshape=(None,), dtype=np.int64)
+    frame = self.handle.create_dataset("frame", shape=(0,), maxshape=(None,), dtype=np.int8)
+    frame.attrs["names"] = ",".join(FRAMES)
+    events = self.handle.create_group("events")
+    events.create_dataset("i_exp", shape=(0,), maxshape=(None,), dtype=np.int64)
+    events.create_dataset("spectrum_length", shape=(0,), maxshape=(None,), dtype=np.int32)
+    for name in ["spectrum_energies", "spectrum_weights"]:
+      events.create_dataset(name, shape=(0,0), maxshape=(None,None), chunks=(1,256),
+                            dtype=np.float64)
+    for name, value in sorted(parameters.items()):
+      shape = np.shape(value)
+      events.create_dataset(name, shape=(0,)+shape, maxshape=(None,)+shape, dtype=np.float64)
+    self.handle.swmr_mode = True # no new objects from here on, only appends
+
+  def _append(self, dataset, values):
+    row = dataset.shape[0]
+    dataset.resize(row + len(values), axis=0)
+    dataset[row:] = values
+
+  def add_event(self, i_exp, frames, detector, beam, energies, weights, parameters=None):
+    """frames: list of (name in FRAMES, (panels, slow, fast) array); detector and beam are
+    dxtbx dicts, only stored with the first event; parameters: name -> number or tuple,
+    the same names for every event"""
+    assert not self.has(i_exp), "event %d is already in %s"%(i_exp, self.filename)
+    if parameters is None: parameters = {}
+    images = [np.asarray(data, dtype=np.float32) for name, data in frames]
+    if "images" not in self.handle:
+      self._create(images[0].shape, detector, beam, parameters)
+    events = self.handle["events"]
+    row = len(self)
+    # the event first, then the frames, so a concurrent reader never sees a frame
+    # whose event is missing
+    n = len(energies)
+    for name, values in [("spectrum_energies", energies), ("spectrum_weights", weights)]:
+      dataset = events[name]
+      dataset.resize(max(n, dataset.shape[1]), axis=1)
+      dataset.resize(row + 1, axis=0)
+      padded = np.zeros(dataset.shape[1])
+      padded[:n] = values
+      dataset[row] = padded
+    self._append(events["spectrum_length"], [n])
+    for name, value in sorted(parameters.items()):
+      self._append(events[name], [value])
+    self._append(events["i_exp"], [i_exp])
+    self._append(self.handle["event_row"], [row] * len(frames))
+    self._append(self.handle["frame"], [FRAMES.index(name) for name, data in frames])
+    for image in images:
+      self._append(self.handle["images"], image[np.newaxis])
+    self.handle.flush()
+    self.done.add(i_exp)
+
+  def close(self):
+    self.handle.close()
+
+_singleton = []
+def rank_event_container(directory, rank, compression="gzip"):
+  """This rank's container in directory, created on first use"""
+  if len(_singleton) == 0:
+    if not os.path.isdir(directory):
+      try: os.makedirs(directory)
+      except OSError: pass # another rank got there first
+    _singleton.append(event_container(os.path.join(directory, "events_%05d.h5"%rank),
+                      compression=compression))
+  return _singleton[0]
@@ -156,6 +156,11 @@ def tst_one_monkeypatch(i_exp,spectra,Fmerge,gpu_channels_singleton,rank,params)
       instance = format_instance(filename)
       reference = [D.as_numpy_array() for D in instance.get_raw_data()]
       print("reference length for %s is %d"%("exap_%d.hdf5"%i_exp,len(reference)))
+      # panel subsets and windows read lazily agree with the full stack
+      subset = instance.get_raw_panels(0, panels=[5,3,200])
+      for pid, D in zip([5,3,200], subset): assert np.all(D.as_numpy_array() == reference[pid])
+      window = instance.get_raw_panels(0, panels=[7], region=((10,20),(30,60)))[0]
+      assert np.all(window.as_numpy_array() == reference[7][10:20,30:60])
 
       # assertion on equality:
       abs_diff = np.abs(JF16M_numpy_array - reference).max()
@@ -44,6 +44,15 @@ def parse_input():
       .help = backend for parallel execution
       .help = Note, for now the assumption that default==cuda is baked in to the tests
       .help = specifically tst_step5_batch_single_process_GPU.py
+    scheduler {
+      method = *static dynamic
+        .type = choice
+        .help = static: fixed round-robin parcel of images per rank
+        .help = dynamic: ranks claim the next images from a shared counter on rank 0
+      chunk = 1
+        .type = int
+        .help = number of images claimed at a time
+    }
   """
   phil_scope = parse(master_phil)
   # The script usage
@@ -62,7 +71,8 @@ def parse_input():
   params, options = parser.parse_args(show_diff_phil=True,quick_parse=True)
   return params,options
 
-def tst_one(image,spectra,crystal,random_orientation,sfall_channels,gpu_channels_singleton,rank,params):
+def tst_one(image,spectra,crystal,random_orientation,sfall_channels,gpu_channels_singleton,rank,params,
+            overwrite=False,on_written=None):
 
   iterator = spectra.generate_recast_renormalized_image(image=image%100000,energy=7120.,total_flux=1e12)
 
@@ -73,11 +83,11 @@ def tst_one(image,spectra,crystal,random_orientation,sfall_channels,gpu_channels
   file_prefix = prefix_root%image
   rand_ori = sqr(random_orientation)
   from LS49.adse13_196.revapi.step5_pad import run_sim2smv
-  run_sim2smv(prefix = file_prefix,
+  return run_sim2smv(prefix = file_prefix,
               crystal = crystal,
               spectra=iterator,rotation=rand_ori,quick=quick,rank=rank,
               gpu_channels_singleton=gpu_channels_singleton,
-              sfall_channels=sfall_channels,params=params)
+              sfall_channels=sfall_channels,params=params,overwrite=overwrite,on_written=on_written,image_index=image)
 
 def run_step5_batch(test_without_mpi=False):
   params,options = parse_input()
@@ -103,9 +113,11 @@ def run_step5_batch(test_without_mpi=False):
   workaround_nt = int(os.environ.get("OMP_NUM_THREADS",1))
   omptbx.omp_set_num_threads(workaround_nt)
   N_total = int(os.environ["N_SIM"]) # number of items to simulate
-  N_stride = size # total number of worker tasks
+  spectra_store_file = os.environ.get("SPECTRA_STORE") # built by LS49/spectra/spectra_store.py
+  from LS49.sim.random_orientations import uses_indexed_orientations
+  indexed_orientations = uses_indexed_orientations() # ORIENTATION_TABLE or ORIENTATION_SEED
   print("hello from rank %d of %d"%(rank,size),"with omp_threads=",omp_get_num_procs())
-  import datetime
+  import datetime, functools
   start_comp = time()
 
   # now inside the Python imports, begin energy channel calculation
@@ -122,11 +134,28 @@ def run_step5_batch(test_without_mpi=False):
   GF.make_P1_primitive()
 
   # Generating sf for my wavelengths
+  from LS49.sim.sf_channel_cache import channel_cache
+  sf_cache = channel_cache(local_data) # None unless SF_CHANNEL_CACHE is exported
+  # SF_LINEAR_CHANNELS: one fmodel per scatterer group, then each channel is a linear combination
+  linear = None
+  if sf_cache is None and bool(int(os.environ.get("SF_LINEAR_CHANNELS",0))):
+    from LS49.sim.util_fmodel import anomalous_linear_fmodel
+    linear = anomalous_linear_fmodel(GF)
+    anomalous_tables = dict(FE1=local_data.get("Fe_oxidized_model"),FE2=local_data.get("Fe_reduced_model"))
+    my_channels = [x for x in range(len(wavlen)) if x%size == rank]
+    channel_values = dict(zip(my_channels, linear.fp_fdp_at_wavelengths(
+      [wavlen[x] for x in my_channels], anomalous_tables)))
   sfall_channels = {}
   for x in range(len(wavlen)):
     if rank > len(wavlen): break
     if x%size != rank: continue
 
+    if sf_cache is not None:
+      sfall_channels[x]=sf_cache.amplitudes(GF, wavlen[x])
+      continue
+    if linear is not None:
+      sfall_channels[x]=linear.amplitudes(wavlen[x], anomalous_tables, values=channel_values[x])
+      continue
     GF.reset_wavelength(wavlen[x])
     GF.reset_specific_at_wavelength(
                      label_has="FE1",tables=local_data.get("Fe_oxidized_model"),newvalue=wavlen[x])
@@ -147,10 +176,12 @@ def run_step5_batch(test_without_mpi=False):
     from LS49.spectra.generate_spectra import spectra_simulation
     from LS49.adse13_196.revapi.step5_pad import microcrystal
     print("hello2 from rank %d of %d"%(rank,size))
-    SS = spectra_simulation()
+    # with a precomputed spectra store, every rank memory-maps it instead of receiving SS
+    SS = None if spectra_store_file is not None else spectra_simulation()
     C = microcrystal(Deff_A = 4000, length_um = 4., beam_diameter_um = 1.0) # assume smaller than 10 um crystals
     from LS49 import legacy_random_orientations
-    random_orientations = legacy_random_orientations(N_total)
+    # with indexed orientations, every rank addresses them itself instead of receiving the list
+    random_orientations = None if indexed_orientations else legacy_random_orientations(N_total)
     transmitted_info = dict(spectra = SS,
                             crystal = C,
                             sfall_info = sfall_channels,
@@ -159,7 +190,12 @@ def run_step5_batch(test_without_mpi=False):
     transmitted_info = None
   transmitted_info = comm.bcast(transmitted_info, root = 0)
   comm.barrier()
-  parcels = list(range(rank,N_total,N_stride))
+  if spectra_store_file is not None:
+    from LS49.spectra.spectra_store import spectra_store
+    transmitted_info["spectra"] = spectra_store(spectra_store_file)
+  if indexed_orientations:
+    from LS49.sim.random_orientations import random_orientations
+    transmitted_info["random_orientations"] = random_orientations(N_total)
 
   print(rank, time(), "finished with single broadcast, now set up the rank logger")
 
@@ -173,7 +209,6 @@ def run_step5_batch(test_without_mpi=False):
 
   print(rank, time(), "finished with the rank logger, now construct the GPU cache container")
 
-  import random
   gpu_instance = get_exascale("gpu_instance", params.context)
   gpu_energy_channels = get_exascale("gpu_energy_channels", params.context)
 
@@ -183,20 +218,39 @@ def run_step5_batch(test_without_mpi=False):
     deviceId = gpu_run.get_deviceID())
     # singleton will instantiate, regardless of gpu, device count, or exascale API
 
+  from LS49.utils.image_scheduler import make_queue
+  queue = make_queue(params.scheduler.method, comm, N_total, chunk=params.scheduler.chunk, MPI=MPI)
+  # JOB_LEDGER=<dir> resumes a campaign from its ledger instead of per-file existence checks
+  from LS49.utils.job_ledger import campaign_ledger, input_hash
+  ledger = campaign_ledger(comm)
+  ledger_verify = bool(int(os.environ.get("JOB_LEDGER_VERIFY",0)))
   comm.barrier()
-  while len(parcels)>0:
-    idx = random.choice(parcels)
+  for idx in queue:
+    if ledger is not None:
+      image_hash = input_hash("step5_MPIbatch", idx, transmitted_info["random_orientations"][idx])
+      if ledger.is_complete(idx, image_hash, verify=ledger_verify): continue
     cache_time = time()
     print("idx------start-------->",idx,"rank",rank,time())
     # if rank==0: os.system("nvidia-smi")
+    # the ledger entry is made once the image file is complete, possibly by the background writer
+    on_written = None if ledger is None else functools.partial(ledger.record, idx, image_hash)
     tst_one(image=idx,spectra=transmitted_info["spectra"],
         crystal=transmitted_info["crystal"],
         random_orientation=transmitted_info["random_orientations"][idx],
         sfall_channels=transmitted_info["sfall_info"], gpu_channels_singleton=gpu_channels_singleton,
-        rank=rank,params=params
+        rank=rank,params=params,overwrite=ledger is not None,on_written=on_written
     )
-    parcels.remove(idx)
     print("idx------finis-------->",idx,"rank",rank,time(),"elapsed",time()-cache_time)
+  queue.free() # every rank, once its loop is done
+  from LS49.utils.async_writer import image_writer
+  writer = image_writer()
+  if writer is not None:
+    writer.close() # wait for the background writes
+    print("rank",rank,"wrote",writer.n_written,"images in background, compute blocked %.3f seconds"%writer.wait_time)
+  if os.environ.get("IMAGE_CONTAINER") is not None:
+    from LS49.sim.image_container import rank_container
+    rank_container(rank).close()
+  print("rank",rank,"simulated",queue.n_claimed,"images, waited %.3f seconds for work"%queue.wait_time)
   comm.barrier()
   del gpu_channels_singleton
   # avoid Kokkos allocation "device_Fhkl" being deallocated after Kokkos::finalize was called
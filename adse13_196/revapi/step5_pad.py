@@ -18,12 +18,13 @@ def full_path(filename):
   return os.path.join(big_data,filename)
 
 def data():
-  from LS49.sim.fdp_plot import george_sherrell
+  # files are read and parsed once per process; the tables are shared, treat as read-only
+  from LS49.sim.structure_registry import registry
   return dict(
-    pdb_lines = open(full_path("1m2a.pdb"),"r").read(),
-    Fe_oxidized_model = george_sherrell(full_path("data_sherrell/pf-rd-ox_fftkk.out")),
-    Fe_reduced_model = george_sherrell(full_path("data_sherrell/pf-rd-red_fftkk.out")),
-    Fe_metallic_model = george_sherrell(full_path("data_sherrell/Fe_fake.dat"))
+    pdb_lines = registry.text(full_path("1m2a.pdb")),
+    Fe_oxidized_model = registry.anomalous_table(full_path("data_sherrell/pf-rd-ox_fftkk.out")),
+    Fe_reduced_model = registry.anomalous_table(full_path("data_sherrell/pf-rd-red_fftkk.out")),
+    Fe_metallic_model = registry.anomalous_table(full_path("data_sherrell/Fe_fake.dat"))
   )
 
 def raw_to_pickle(raw_pixels, fileout):
@@ -106,16 +107,43 @@ def basic_detector(): # from development, not actually used here but useful for
                  'type': ''}]}
   return DetectorFactory.from_dict(det_descr)
 
+def add_water_and_air_background(SIM,water_bg,air_bg):
+  SIM.Fbg_vs_stol = water_bg
+  SIM.amorphous_sample_thick_mm = 0.1
+  SIM.amorphous_density_gcm3 = 1
+  SIM.amorphous_molecular_weight_Da = 18
+  SIM.flux=1e12
+  SIM.beamsize_mm=0.003 # square (not user specified)
+  SIM.exposure_s=1.0 # multiplies flux x exposure
+  SIM.add_background(sort_stable=(add_background_algorithm=="sort_stable"))
+
+  SIM.Fbg_vs_stol = air_bg
+  SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
+  SIM.amorphous_density_gcm3 = 1.2e-3
+  SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
+  SIM.add_background(sort_stable=(add_background_algorithm=="sort_stable"))
+
 from LS49.sim.debug_utils import channel_extractor
 CHDBG_singleton = channel_extractor()
 
 def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,params,
-                quick=False,save_bragg=False,sfall_channels=None):
+                quick=False,save_bragg=False,sfall_channels=None,overwrite=False,on_written=None,
+                image_index=None):
   smv_fileout = prefix + ".img"
   burst_buffer_expand_dir = os.path.expandvars(params.logger.outdir)
   burst_buffer_fileout = os.path.join(burst_buffer_expand_dir,smv_fileout)
   reference_fileout = os.path.join(".",smv_fileout)
-  if not quick:
+  from time import time
+  start_time = time()
+  from LS49.sim.image_container import rank_container
+  container = None if image_index is None else rank_container(rank) # None unless IMAGE_CONTAINER
+  if container is not None:
+    if container.has(image_index): # even with overwrite: a row is never appended twice
+      print("Image %d already in %s, skipping in rank %d"%(image_index,container.filename,rank))
+      # stored before a crash, but possibly not yet in the caller's job ledger
+      if overwrite and on_written is not None: on_written([container.row_output(image_index)])
+      return
+  elif not quick and not overwrite: # with overwrite, the caller's job ledger decides
     if not write_safe(reference_fileout):
       print("File %s already exists, skipping in rank %d"%(reference_fileout,rank))
       return
@@ -266,21 +294,14 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,para
 
   if add_background_algorithm in ["jh","sort_stable"]:
     QQ = Profiler("nanoBragg background rank %d"%(rank))
-
-    SIM.Fbg_vs_stol = water_bg
-    SIM.amorphous_sample_thick_mm = 0.1
-    SIM.amorphous_density_gcm3 = 1
-    SIM.amorphous_molecular_weight_Da = 18
-    SIM.flux=1e12
-    SIM.beamsize_mm=0.003 # square (not user specified)
-    SIM.exposure_s=1.0 # multiplies flux x exposure
-    SIM.add_background(sort_stable=(add_background_algorithm=="sort_stable"))
-
-    SIM.Fbg_vs_stol = air_bg
-    SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
-    SIM.amorphous_density_gcm3 = 1.2e-3
-    SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
-    SIM.add_background(sort_stable=(add_background_algorithm=="sort_stable"))
+    # background does not depend on the crystal; with BACKGROUND_TEMPLATE it is reused across images
+    from LS49.sim.background_template import rank_background_templates
+    templates = rank_background_templates()
+    if templates is not None:
+      templates.add_background(SIM, lambda S: add_water_and_air_background(S,water_bg,air_bg),
+                               recipe=add_background_algorithm)
+    else:
+      add_water_and_air_background(SIM,water_bg,air_bg)
     del QQ
 
   SIM.detector_psf_kernel_radius_pixels=5;
@@ -293,7 +314,13 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,para
   del QQ
 
   extra = "PREFIX=%s;\nRANK=%d;\n"%(prefix,rank)
-  SIM.to_smv_format_py(fileout=burst_buffer_fileout,intfile_scale=1,rotmat=True,extra=extra,gz=True)
+  if container is not None:
+    stored = container.append(SIM, image_index, rotation, wavelength_A, rank, time()-start_time,
+                     spectrum_index=image_index%100000)
+    if on_written is not None: on_written([stored])
+  else:
+    from LS49.utils.async_writer import write_smv_image
+    write_smv_image(SIM, burst_buffer_fileout, extra, on_written) # atomic; in the background if ASYNC_IMAGE_WRITER
 
   SIM.free_all()
 
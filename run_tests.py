@@ -7,8 +7,30 @@ tst_list = [
   "$D/tests/tst_spectrum_iterator.py",
   "$D/tests/tst_structure_factors.py",
   "$D/tests/tst_sf_energies.py",
+  "$D/tests/tst_fp_fdp_table.py",
+  "$D/tests/tst_sf_channel_cache.py",
+  "$D/tests/tst_sf_linear_channels.py",
   "$D/tests/tst_mosaic_orientations.py",
+  "$D/tests/tst_mosaic_domains.py",
   "$D/tests/tst_crystal_orientations.py",
+  "$D/tests/tst_image_scheduler.py",
+  "$D/tests/tst_miller_lookup.py",
+  "$D/tests/tst_intensity_structure_distributed.py",
+  "$D/tests/tst_channel_accumulator.py",
+  "$D/tests/tst_channel_parallel.py",
+  "$D/tests/tst_job_ledger.py",
+  "$D/tests/tst_event_container.py",
+  "$D/tests/tst_case_data.py",
+  "$D/tests/tst_background_template.py",
+  "$D/tests/tst_async_writer.py",
+  "$D/tests/tst_channel_session.py",
+  "$D/tests/tst_image_container.py",
+  "$D/tests/tst_multipanel_session.py",
+  "$D/tests/tst_scattering_factors.py",
+  "$D/tests/tst_static_fcalc_store.py",
+  "$D/tests/tst_structure_registry.py",
+  "$D/tests/tst_spectra_store.py",
+  "$D/tests/tst_hdf5_attribute_geometry.py",
   "$D/tests/tst_jh_add_spots.py",
 ]
 
@@ -84,10 +106,57 @@ tst_structure_factors.py:
   the computed structure factors without energy dependence, in both P1 and C2
 tst_sf_energies.py:
   the computed structure factors at selected energies
+tst_fp_fdp_table.py:
+  indexed Fe f', f" lookup agrees with the original list scan; interpolation hits the table points
+  the batch query follows replaced fp, fdp arrays
+tst_sf_channel_cache.py:
+  round trip of per-channel amplitudes through the on-disk channel cache
+tst_sf_linear_channels.py:
+  channel amplitudes from the anomalous-linear decomposition agree with the full fmodel
+  cached bulk-solvent contribution reproduces the full fmodel across wavelengths
 tst_mosaic_orientations.py:
   the mosaic domains
+tst_mosaic_domains.py:
+  memoised and rescaled mosaic-domain sets (isotropic, paired, anisotropic) reproduce a fresh draw
 tst_crystal_orientations.py
   the 100000 random orientations
+tst_image_scheduler.py
+  static and dynamic (shared counter) image queues each cover every image exactly once
+tst_miller_lookup.py
+  bulk packed-key Miller index lookup agrees with the HKL tuple dictionary; pickles compactly
+tst_intensity_structure_distributed.py
+  channels computed in forked processes assemble the same intensity table as the serial loop
+tst_channel_accumulator.py
+  in-place and compensated float32 channel sums agree with the float64 expression
+tst_channel_parallel.py
+  forked channel pool reduces to the serial channel sum, leaving the caller's OpenMP threads alone
+tst_job_ledger.py
+  ledger records survive a restart, detect changed inputs and outputs, and a torn last line
+tst_event_container.py
+  events appended across reopenings, with growing spectra, read back through FormatHDF5AttributeGeometry
+tst_case_data.py
+  preloaded case data file reproduces the geometry, crystal and raw and downsampled spectra
+tst_background_template.py
+  reused water + air background template agrees with the direct calculation on a small detector
+  a template hit leaves the simulator's flux and sample settings as a miss does
+tst_async_writer.py
+  background image writer blocks on a full queue, gzips spooled images into place, calls back in order
+tst_channel_session.py
+  reused multi-channel nanoBragg session reproduces the per-channel simulator loop on a small detector
+tst_image_container.py
+  per-rank image container round trip through FormatHDF5SimContainer; ledger rows verify the stored pixels
+tst_multipanel_session.py
+  multipanel session through a fake exascale backend: matches multipanel_sim, one detector allocation per event
+tst_scattering_factors.py
+  batched, cached Henke f', f" and the per-element apply agree with the per-scatterer table loop
+tst_static_fcalc_store.py
+  memory-mapped static fcalc table of a small structure: built, complete, reloaded without recompute; key follows params2
+tst_structure_registry.py
+  registry text re-read on size or mtime change, private copies of tables and structures, pickle round trip
+tst_spectra_store.py
+  memory-mapped spectra store reproduces spectra_simulation images exactly, also after pickling
+tst_hdf5_attribute_geometry.py
+  synthetic three-panel file: panel subsets, regions and read-ahead blocks; bounded spectrum cache
 tst_monochromatic_image.py
   monochromatic "quick" simulation of raw image 0
   the air and water scatterers
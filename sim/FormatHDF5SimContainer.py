@@ -0,0 +1,44 @@
+from __future__ import absolute_import, division
+
+import h5py
+
+from LS49.adse13_187.FormatHDF5AttributeGeometry import FormatHDF5AttributeGeometry
+
+
+class FormatHDF5SimContainer(FormatHDF5AttributeGeometry):
+    """
+    Class for reading the per-rank image containers written by
+    LS49.sim.image_container, with access to the per-image simulation metadata
+    """
+    @staticmethod
+    def understand(image_file):
+        try:
+            img_handle = h5py.File(image_file, "r")
+            keys = img_handle.keys()
+        except (IOError, AttributeError) as err:
+            return False
+        for key in ["image_index", "rotation_matrices", "direct_space_abc"]:
+            if key not in keys:
+                return False
+        return True
+
+    def _start(self):
+        super(FormatHDF5SimContainer, self)._start()
+        self._image_index = self._handle["image_index"]
+
+    def get_image_index(self, index=0):
+        """Global image number (the %06d of the equivalent SMV file)"""
+        return int(self._image_index[index])
+
+    def get_rotation_matrix(self, index=0):
+        return tuple(float(a) for a in self._handle["rotation_matrices"][index])
+
+    def get_direct_space_abc(self, index=0):
+        """As DIRECT_SPACE_ABC in the SMV header"""
+        return tuple(float(a) for a in self._handle["direct_space_abc"][index])
+
+
+if __name__ == '__main__':
+    import sys
+    for arg in sys.argv[1:]:
+        print(FormatHDF5SimContainer.understand(arg))
@@ -0,0 +1,99 @@
+from __future__ import division, print_function
+import os
+from collections import OrderedDict
+from scitbx.array_family import flex
+
+"""Per-rank reusable water + air background.
+
+run_sim2smv adds the amorphous water and air scattering with two add_background()
+passes over the full detector for every image.  That background depends on the
+detector geometry, the sample description and the wavelength, but not on the crystal
+orientation, so here it is computed once per wavelength bin on an otherwise empty
+detector, kept in memory, and added to each image scaled by the image flux.
+add_background() only ever adds to raw_pixels, so apart from the binning of the
+wavelength the result is the direct calculation up to floating point summation order.
+The beam and sample settings the recipe leaves on SIM (flux, exposure, beam size,
+Fbg_vs_stol, amorphous_*) are recorded with the template and set again on every hit,
+so later steps see the same SIM whether or not the background was computed.
+
+Enable with BACKGROUND_TEMPLATE=<wavelength bin width in Angstrom>, e.g. 0.0005
+(0 reuses a template only for identical wavelengths).  BACKGROUND_TEMPLATE_VALIDATE=1
+additionally runs the direct calculation for every image and reports the difference.
+"""
+
+# SIM attributes set by the background recipes, in the order they set them
+STATE = ["Fbg_vs_stol", "amorphous_sample_thick_mm", "amorphous_density_gcm3",
+         "amorphous_molecular_weight_Da", "flux", "beamsize_mm", "exposure_s"]
+
+class background_templates(object):
+  def __init__(self, bin_width_A=0., max_templates=4, validate=False):
+    self.bin_width_A = bin_width_A
+    self.max_templates = max_templates # each template is a full detector of doubles
+    self.validate = validate
+    self.templates = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.validation = [] # (wavelength, max abs difference, max background)
+
+  def key(self, SIM, recipe, wavelength_A):
+    if self.bin_width_A > 0: wavelength_key = int(round(wavelength_A / self.bin_width_A))
+    else: wavelength_key = repr(wavelength_A)
+    return (recipe, tuple(SIM.detpixels_fastslow), SIM.pixel_size_mm, SIM.distance_mm,
+            SIM.oversample, wavelength_key)
+
+  def template_wavelength(self, wavelength_A):
+    if self.bin_width_A > 0: return round(wavelength_A / self.bin_width_A) * self.bin_width_A
+    return wavelength_A
+
+  def _compute(self, SIM, add_background, wavelength_A):
+    bragg = SIM.raw_pixels.deep_copy()
+    SIM.raw_pixels *= 0.
+    SIM.wavelength_A = self.template_wavelength(wavelength_A)
+    add_background(SIM)
+    template = SIM.raw_pixels.deep_copy()
+    template_flux = SIM.flux * SIM.exposure_s
+    state = [(name, getattr(SIM, name)) for name in STATE]
+    SIM.raw_pixels = bragg
+    SIM.wavelength_A = wavelength_A
+    return template, template_flux, state
+
+  def add_background(self, SIM, add_background, recipe, flux=None):
+    """Add the cached background to SIM.raw_pixels, computing the template with
+    add_background(SIM) on a miss.  flux (photons per image) defaults to that of the
+    template, i.e. to the flux set by add_background."""
+    wavelength_A = SIM.wavelength_A
+    key = self.key(SIM, recipe, wavelength_A)
+    if key in self.templates:
+      self.hits += 1
+      self.templates[key] = self.templates.pop(key) # most recently used last
+      for name, value in self.templates[key][2]: setattr(SIM, name, value)
+    else:
+      self.misses += 1
+      self.templates[key] = self._compute(SIM, add_background, wavelength_A)
+      while len(self.templates) > self.max_templates: self.templates.popitem(last=False)
+    template, template_flux, state = self.templates[key]
+    if self.validate:
+      direct = SIM.raw_pixels.deep_copy()
+    if flux is None or flux == template_flux:
+      SIM.raw_pixels += template
+    else:
+      SIM.raw_pixels += template * (flux / template_flux)
+    if self.validate:
+      SIM.raw_pixels, templated = direct, SIM.raw_pixels
+      add_background(SIM)
+      SIM.wavelength_A = wavelength_A
+      delta = (SIM.raw_pixels - templated).as_1d()
+      report = (wavelength_A, flex.max(flex.abs(delta)), flex.max(template))
+      self.validation.append(report)
+      print("background template at %.6f A: max |direct - template| %.4g, max background %.4g"%report)
+      SIM.raw_pixels = templated
+
+_singleton = []
+def rank_background_templates():
+  """Process-level template cache when BACKGROUND_TEMPLATE is exported, else None"""
+  bin_width = os.environ.get("BACKGROUND_TEMPLATE")
+  if bin_width is None: return None
+  if len(_singleton) == 0:
+    _singleton.append(background_templates(bin_width_A=float(bin_width),
+      validate=bool(int(os.environ.get("BACKGROUND_TEMPLATE_VALIDATE",0)))))
+  return _singleton[0]
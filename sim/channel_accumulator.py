@@ -0,0 +1,156 @@
+from __future__ import division, print_function
+import os
+from scitbx.array_family import flex
+
+"""Accumulation of the per-channel Bragg images into the final image.
+
+run_sim2smv combines the 100 spectrum channels with
+
+  SIM.raw_pixels += CH.raw_pixels * crystal.domains_per_crystal
+
+which allocates a full-detector temporary for the product (and one for the sum when
+raw_pixels is fetched from the simulator) for every channel.  The accumulator keeps one
+per-rank buffer, reused from image to image, and offers
+
+  legacy   the expression above (default)
+  inplace  float64, CH.raw_pixels added in place; the common scale factor is applied
+           once at the end, so no temporaries per channel
+  float32  float32 running sum with Kahan compensation (numpy), updated in blocks of
+           BLOCK pixels with block-sized scratch.  The sum and the compensation are
+           kept per rank, 8 bytes per pixel together: as much memory as the inplace
+           float64 buffer, so this mode does not lower the memory of the rank, and
+           it reads the float64 channel images like the other modes.  The result is
+           added to SIM.raw_pixels block by block, without a full float64 copy.
+           The deviation is of the order of float32 rounding of the final pixel
+           values
+
+Select with CHANNEL_ACCUMULATION=legacy|inplace|float32.  CHANNEL_ACCUMULATION_VALIDATE=1
+also accumulates the legacy float64 reference and reports the maximum deviation of the
+selected mode for each image.  To compare two saved images (save_bragg pickles):
+
+  libtbx.python channel_accumulator.py reference_dblprec_001.pickle test_dblprec_001.pickle
+"""
+
+MODES = ("legacy", "inplace", "float32")
+BLOCK = 1<<16 # pixels per float32 update, the size of the scratch and of the float64 temporaries
+
+def max_deviation(reference, test):
+  """Maximum absolute and relative (to the maximum of reference) deviation"""
+  delta = (test - reference).as_1d()
+  max_abs = max(-flex.min(delta), flex.max(delta)) if delta.size() > 0 else 0.
+  scale = flex.max(flex.abs(reference.as_1d())) if reference.size() > 0 else 0.
+  return max_abs, (max_abs / scale if scale > 0 else 0.)
+
+class channel_accumulator(object):
+  def __init__(self, mode="legacy", validate=False):
+    assert mode in MODES, "unknown accumulation mode %s"%mode
+    self.mode = mode
+    self.validate = validate
+    self.buffers = None # reused across images of the same size
+    self.deviations = [] # (max abs, max rel) per validated image
+    self.block = BLOCK
+
+  def begin(self, SIM):
+    """Start an image; channels are added to SIM.raw_pixels at finish()"""
+    self.SIM = SIM
+    self.focus = tuple(SIM.raw_pixels.focus())
+    self.factor = None
+    self.n_channels = 0
+    self.reference = None
+    if self.validate and self.mode != "legacy":
+      self.reference = flex.double(flex.grid(self.focus), 0.)
+    if self.mode == "inplace":
+      if self.buffers is None or self.buffers.focus() != self.focus:
+        self.buffers = flex.double(flex.grid(self.focus), 0.)
+      else: self.buffers.fill(0.)
+    elif self.mode == "float32":
+      import numpy as np
+      size = self.focus[0] * self.focus[1]
+      if (self.buffers is None or self.buffers[0].size != size
+          or self.buffers[2].size != min(self.block, size)):
+        self.buffers = [np.zeros(size, dtype=np.float32) for i in range(2)] + [ # sum, compensation
+          np.zeros(min(self.block, size), dtype=np.float32) for i in range(2)] # block scratch x2
+      else:
+        for buffer in self.buffers[0:2]: buffer.fill(0.)
+
+  def add(self, pixels, factor=1.):
+    """Add factor * pixels for one channel"""
+    self.n_channels += 1
+    if self.mode == "legacy":
+      self.SIM.raw_pixels += pixels * factor
+      return
+    if self.reference is not None:
+      self.reference += pixels * factor
+    if self.mode == "inplace":
+      if self.factor is None: self.factor = factor
+      if factor == self.factor:
+        self.buffers += pixels
+      else: # per-channel factors: one temporary, scaled relative to the common factor
+        self.buffers += pixels * (factor / self.factor)
+    elif self.mode == "float32":
+      import numpy as np
+      total, compensation, y, t = self.buffers
+      # as_numpy_array() of the whole channel would be a full float64 copy; convert
+      # block by block straight into the float32 scratch instead
+      flat = pixels.as_1d()
+      for start in range(0, flat.size(), self.block):
+        stop = min(start + self.block, flat.size())
+        s_, y_, t_ = total[start:stop], y[:stop-start], t[:stop-start]
+        c_ = compensation[start:stop]
+        np.multiply(flat[start:stop].as_numpy_array(), factor, out=y_, casting="same_kind")
+        np.subtract(y_, c_, out=y_)
+        np.add(s_, y_, out=t_)
+        np.subtract(t_, s_, out=c_)
+        np.subtract(c_, y_, out=c_)
+        s_[:] = t_
+
+  def result(self):
+    """Sum of the channels added since begin(), flex.double with the detector grid.
+    For inplace this is the reusable buffer itself."""
+    if self.mode == "inplace":
+      if self.factor is not None and self.factor != 1.: self.buffers *= self.factor
+      image = self.buffers
+    else:
+      import numpy as np
+      image = flex.double(self.buffers[0].astype(np.float64))
+      image.reshape(flex.grid(self.focus))
+    if self.reference is not None:
+      deviation = max_deviation(self.reference, image)
+      self.deviations.append(deviation)
+      print("channel accumulation %s vs float64 reference over %d channels: max |deviation| %.4g (relative %.3g)"%(
+        (self.mode, self.n_channels) + deviation))
+    return image
+
+  def _add_float32_blocks(self, raw_pixels):
+    """raw_pixels += the float32 sum, one BLOCK at a time"""
+    import numpy as np
+    total = self.buffers[0]
+    for start in range(0, total.size, self.block):
+      stop = min(start + self.block, total.size)
+      selection = flex.size_t_range(start, stop)
+      raw_pixels.set_selected(selection,
+        raw_pixels.select(selection) + flex.double(total[start:stop].astype(np.float64)))
+
+  def finish(self):
+    """Add the accumulated channels to SIM.raw_pixels (legacy mode already did)"""
+    if self.mode != "legacy" and self.n_channels > 0:
+      if self.mode == "float32" and self.reference is None:
+        self._add_float32_blocks(self.SIM.raw_pixels)
+      else:
+        self.SIM.raw_pixels += self.result()
+    self.SIM = None
+
+_singleton = []
+def rank_channel_accumulator():
+  """Process-level accumulator configured from CHANNEL_ACCUMULATION"""
+  if len(_singleton) == 0:
+    _singleton.append(channel_accumulator(mode=os.environ.get("CHANNEL_ACCUMULATION","legacy"),
+      validate=bool(int(os.environ.get("CHANNEL_ACCUMULATION_VALIDATE",0)))))
+  return _singleton[0]
+
+if __name__=="__main__":
+  import sys
+  from six.moves import cPickle as pickle
+  with open(sys.argv[1],"rb") as F: reference = pickle.load(F)
+  with open(sys.argv[2],"rb") as F: test = pickle.load(F)
+  print("max |deviation| %.4g (relative %.3g)"%max_deviation(reference, test))
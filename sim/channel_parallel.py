@@ -0,0 +1,97 @@
+from __future__ import division, print_function
+import os
+
+"""Channel-parallel CPU simulation of one image.
+
+On the CPU, run_sim2smv steps through the spectrum channels in series, and the only
+parallelism is the OpenMP loop inside each add_nanoBragg_spots call, which is short and
+scales poorly at high thread counts.  Here the channel list is split into contiguous
+chunks, one per worker; each worker builds its own simulator per channel and sums its
+chunk in place, and the partial images are combined by pairwise (tree) reduction.
+
+  CHANNEL_PARALLEL=<workers>             number of worker processes (unset or 1: serial)
+  CHANNEL_PARALLEL_THREADS=<threads>     OpenMP threads inside each worker (default 1)
+
+Processes are forked (utils/fork_pool, always the fork start method), so each worker
+starts with a copy of the rank state (structure factor generator, tables) and no
+pickling of inputs; only the partial images come back.  Forking inside an MPI rank, as
+in step5_batch, is not supported by many MPI stacks: there (unless FORK_UNDER_MPI=1 is
+exported) no pool is made and run_sim2smv keeps its serial channel loop.  The OpenMP
+thread count is only changed inside the forked workers; the rank's own setting is
+never touched.  There is no thread backend: nanoBragg holds the GIL while it adds
+spots, so threads would run the channels one at a time.  The sum differs from the
+serial one by floating point summation order only.  Per-channel images are not
+available to the channel debug extractor in this mode.
+"""
+
+def tree_sum(images):
+  """Pairwise reduction of a list of flex arrays, in place into the left operands"""
+  images = list(images)
+  while len(images) > 1:
+    reduced = []
+    for i in range(0, len(images) - 1, 2):
+      images[i] += images[i+1]
+      reduced.append(images[i])
+    if len(images) % 2 == 1: reduced.append(images[-1])
+    images = reduced
+  return images[0] if len(images) == 1 else None
+
+def split_channels(channels, workers):
+  """Contiguous chunks, sizes differing by at most one"""
+  channels = list(channels)
+  n = min(workers, len(channels))
+  bounds = [len(channels) * i // n for i in range(n + 1)] if n > 0 else [0]
+  return [channels[bounds[i]:bounds[i+1]] for i in range(n)]
+
+def set_threads(threads):
+  """Set the OpenMP thread count, returning the previous one (None: leave alone)"""
+  if threads is None: return None
+  import omptbx
+  previous = omptbx.omp_get_max_threads()
+  omptbx.omp_set_num_threads(threads)
+  return previous
+
+def _chunk_sum(job, chunk):
+  channel_simulator, factor, threads = job
+  partial = None
+  for x in chunk:
+    CH = channel_simulator(x)
+    if partial is None: partial = CH.raw_pixels * factor
+    else: partial += CH.raw_pixels * factor
+    CH.free_all()
+  return partial
+
+def _forked_chunk_sum(job, chunk):
+  # runs in a forked worker, but restore anyway in case fork_map ran it in the caller
+  previous = set_threads(job[2])
+  try:
+    return _chunk_sum(job, chunk)
+  finally:
+    set_threads(previous)
+
+class channel_pool(object):
+  def __init__(self, workers=1, threads=None):
+    self.workers = workers
+    self.threads = threads
+
+  def sum_channels(self, channel_simulator, channels, factor=1.):
+    """factor * sum over channels x of channel_simulator(x).raw_pixels (None if no channels).
+    channel_simulator(x) returns a new simulator with the spots added."""
+    from LS49.utils.fork_pool import fork_allowed, fork_map
+    chunks = split_channels(channels, self.workers)
+    if len(chunks) == 0: return None
+    job = (channel_simulator, factor, self.threads)
+    if len(chunks) == 1 or not fork_allowed(): # in this process, with its own thread count
+      partials = [_chunk_sum(job, chunk) for chunk in chunks]
+    else:
+      partials = fork_map(_forked_chunk_sum, chunks, len(chunks), shared=job)
+    return tree_sum(partials)
+
+def rank_channel_pool():
+  """channel_pool from CHANNEL_PARALLEL, or None for the serial loop (also when forking
+  is not allowed, see utils/fork_pool)"""
+  from LS49.utils.fork_pool import fork_allowed
+  workers = int(os.environ.get("CHANNEL_PARALLEL", 1))
+  if workers <= 1 or not fork_allowed(): return None
+  threads = os.environ.get("CHANNEL_PARALLEL_THREADS", "1")
+  return channel_pool(workers=workers, threads=int(threads))
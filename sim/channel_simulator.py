@@ -1,4 +1,6 @@
 from __future__ import division
+from six.moves import StringIO
+from time import time
 import scitbx
 import math
 from simtbx.nanoBragg import nanoBragg
@@ -96,3 +98,93 @@ class ChannelSimulator:
       self.raw_pixels += self.SIM.raw_pixels  # NOTE: will be on GPU
     else:
       raise Exception("unknown spots algorithm '%s' " % algo)
+
+
+class MultiChannelSession:
+  """Per-rank simulator session, generalizing ChannelSimulator to many images.
+
+  Detector, beam, crystal size and mosaic blocks are set up once.  Each image
+  then only resets the orientation and the accumulation buffer, and each energy
+  channel only resets wavelength, flux and Fhkl, so that the 100 channels of an
+  image are summed into one buffer instead of 100 freshly allocated nanoBragg
+  objects.  Allocation counts and setup/compute times are kept per image in
+  self.image_stats, and each finished image's stats are passed to any callables
+  in self.listeners.
+  """
+  def __init__(self, N, UMAT_nm,
+               detpixels_slowfast=(3000,3000),
+               pixel_size_mm=0.11,
+               distance_mm=141.7,
+               mosaic_spread_deg=0.05,
+               beamsize_mm=0.003,
+               algo="NKS",
+               SEED=1):
+    t0 = time()
+    self.algo = algo
+    self.SIM = nanoBragg(detpixels_slowfast=detpixels_slowfast, pixel_size_mm=pixel_size_mm,
+                         Ncells_abc=(N, N, N), wavelength_A=1, verbose=0)
+    self.SIM.adc_offset_adu = 10 # Do not offset by 40
+    self.SIM.mosaic_spread_deg = mosaic_spread_deg # interpreted by UMAT_nm as a half-width stddev
+    self.SIM.mosaic_domains = len(UMAT_nm) # mosaic_domains setter must come after mosaic_spread_deg setter
+    self.SIM.distance_mm = distance_mm
+    self.SIM.set_mosaic_blocks(UMAT_nm)
+    self.SIM.seed = SEED
+    self.SIM.oversample = 1
+    self.SIM.polarization = 1
+    self.SIM.default_F = 0
+    self.SIM.xtal_shape = shapetype.Gauss # both crystal & RLP are Gaussian
+    self.SIM.progress_meter = False
+    self.SIM.exposure_s = 1.0
+    self.SIM.beamsize_mm = beamsize_mm
+    temp=self.SIM.Ncells_abc
+    self.SIM.Ncells_abc=temp
+    self.shape = self.SIM.raw_pixels.focus()
+    self.session_setup_time = time() - t0
+    self.listeners = []
+    self.image_stats = None
+    self.accumulator = None
+
+  def begin_image(self, Amatrix_rot):
+    t0 = time()
+    self.image_stats = dict(allocations=0, setup_time=0., channel_time=0., n_channels=0)
+    self.SIM.Amatrix_RUB = Amatrix_rot
+    self.SIM.raw_pixels *= 0. # zeroed in place, the buffer lasts as long as the session
+    if self.algo == "cuda": # cuda overwrites rather than adds, so accumulate separately
+      if self.accumulator is None:
+        self.accumulator = flex.double(flex.grid(self.shape))
+        self.image_stats["allocations"] += 1
+      else:
+        self.accumulator.fill(0.)
+    self.image_stats["setup_time"] += time() - t0
+
+  def add_channel(self, wavelength_A, flux, Fhkl, rank=0):
+    t0 = time()
+    self.SIM.wavelength_A = wavelength_A
+    self.SIM.flux = flux
+    self.SIM.Fhkl = Fhkl
+    t1 = time()
+    self.image_stats["setup_time"] += t1 - t0
+    P = Profiler("nanoBragg C++ rank %d"%(rank))
+    if self.algo == "NKS":
+      self.SIM.add_nanoBragg_spots_nks(streambuf(StringIO()))
+    elif self.algo == "JH":
+      self.SIM.add_nanoBragg_spots()
+    elif self.algo == "cuda":
+      self.SIM.add_nanoBragg_spots_cuda()
+      self.accumulator += self.SIM.raw_pixels
+    else:
+      raise Exception("unknown spots algorithm '%s' " % self.algo)
+    del P
+    self.image_stats["channel_time"] += time() - t1
+    self.image_stats["n_channels"] += 1
+
+  def end_image(self):
+    """Return the summed Bragg pixels of all channels, and notify listeners.
+    The returned buffer is zeroed by the next begin_image; copy it to keep it."""
+    raw_pixels = self.accumulator if self.algo == "cuda" else self.SIM.raw_pixels
+    for listener in self.listeners:
+      listener(self.image_stats)
+    return raw_pixels
+
+  def free_all(self):
+    self.SIM.free_all()
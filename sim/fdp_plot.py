@@ -31,22 +31,139 @@ class csv:
     plt.plot(elist, [ -self.ox_fp[idx] for idx in lookup ], "r.")
     plt.plot(elist, [ self.ox_fdp[idx] for idx in lookup ], "r.")
 
-class george_sherrell:
+class fp_fdp_table(object):
+  """Indexed f', f" lookup over self.energy, self.fp, self.fdp (set by the subclass).
+
+  An energy is rounded to the nearest eV and looked up directly: by arithmetic on a
+  regular grid, by dictionary otherwise, so on-grid results are those of the original
+  list(self.energy).index() scan.  Energies whose rounded value is not in the table
+  are interpolated (interpolation = "linear" or "spline", a natural cubic spline)
+  instead of failing; energies outside the table raise ValueError."""
+  interpolation = "linear"
+
+  def _build_index(self):
+    energy = self.energy
+    n = len(energy)
+    step = energy[1] - energy[0] if n > 1 else 0.
+    regular = step > 0 and all(abs(energy[i] - (energy[0] + i*step)) < 1.e-6 for i in range(n))
+    self._index = dict(sources=(energy, self.fp, self.fdp), n=n,
+                       regular=regular, start=energy[0], step=step,
+                       lookup=None if regular else dict([(e, i) for i, e in enumerate(energy)]),
+                       spline=None, arrays=None)
+    return self._index
+
+  def _get_index(self):
+    # rebuilt when energy, fp or fdp is replaced (or energy changes length)
+    index = getattr(self, "_index", None)
+    if (index is None or index["n"] != len(self.energy) or
+        not all(a is b for a, b in zip(index["sources"], (self.energy, self.fp, self.fdp)))):
+      index = self._build_index()
+    return index
+
+  def index_of_energy(self,lookup_energy):
+    """Table row holding exactly lookup_energy, or None"""
+    index = self._get_index()
+    if index["regular"]:
+      x = (lookup_energy - index["start"]) / index["step"]
+      i = int(round(x))
+      if abs(x - i) < 1.e-6 and 0 <= i < len(self.energy) and self.energy[i] == lookup_energy:
+        return i
+      return None
+    return index["lookup"].get(lookup_energy)
+
+  def _spline_second_derivatives(self, y):
+    # natural cubic spline through (energy, y)
+    x = self.energy; n = len(x)
+    y2 = [0.]*n; u = [0.]*n
+    for i in range(1, n-1):
+      sig = (x[i]-x[i-1])/(x[i+1]-x[i-1])
+      p = sig*y2[i-1] + 2.
+      y2[i] = (sig-1.)/p
+      u[i] = (y[i+1]-y[i])/(x[i+1]-x[i]) - (y[i]-y[i-1])/(x[i]-x[i-1])
+      u[i] = (6.*u[i]/(x[i+1]-x[i-1]) - sig*u[i-1])/p
+    for k in range(n-2, -1, -1):
+      y2[k] = y2[k]*y2[k+1] + u[k]
+    return y2
+
+  def interpolate(self,energy):
+    from bisect import bisect_right
+    x = self.energy
+    if not (x[0] <= energy <= x[len(x)-1]):
+      raise ValueError("energy %.2f outside the table (%.2f, %.2f)"%(energy, x[0], x[len(x)-1]))
+    hi = min(max(bisect_right(x, energy), 1), len(x)-1)
+    lo = hi - 1
+    h = x[hi] - x[lo]
+    a = (x[hi] - energy)/h; b = (energy - x[lo])/h
+    values = []
+    for y in [self.fp, self.fdp]:
+      value = a*y[lo] + b*y[hi]
+      if self.interpolation == "spline":
+        y2 = self._spline_table()[len(values)]
+        value += ((a*a*a - a)*y2[lo] + (b*b*b - b)*y2[hi])*(h*h)/6.
+      values.append(value)
+    return tuple(values)
+
+  def fp_fdp_at_energy(self,energy):
+    lookup_idx = self.index_of_energy(round2(energy,0))
+    if lookup_idx is not None:
+      return self.fp[lookup_idx], self.fdp[lookup_idx]
+    return self.interpolate(energy)
+
+  def fp_fdp_at_wavelength(self,angstroms):
+    return self.fp_fdp_at_energy(12398.425/angstroms)
+
+  def _spline_table(self):
+    index = self._get_index()
+    if index["spline"] is None:
+      index["spline"] = [self._spline_second_derivatives(self.fp),
+                         self._spline_second_derivatives(self.fdp)]
+    return index["spline"]
+
+  def fp_fdp_at_wavelengths(self,angstroms):
+    """Batch query: flex.double f', f" for a sequence of wavelengths, the values of
+    fp_fdp_at_wavelength computed over arrays (one searchsorted pass for the on-grid
+    lookup, one for the interpolation brackets)"""
+    import numpy as np
+    index = self._get_index()
+    if index.get("arrays") is None:
+      index["arrays"] = [self.energy.as_numpy_array(), self.fp.as_numpy_array(),
+                         self.fdp.as_numpy_array()]
+    x, fp_table, fdp_table = index["arrays"]
+    if hasattr(angstroms, "as_numpy_array"): angstroms = angstroms.as_numpy_array()
+    energy = 12398.425/np.asarray(angstroms, dtype=np.float64)
+    # on-grid: the energy rounded to the nearest eV (round2 for positive values) is in the table
+    rounded = np.floor(energy + 0.5)
+    row = np.minimum(np.searchsorted(x, rounded), len(x)-1)
+    exact = x[row] == rounded
+    outside = ~exact & ((energy < x[0]) | (energy > x[-1]))
+    if outside.any():
+      bad = energy[outside][0]
+      raise ValueError("energy %.2f outside the table (%.2f, %.2f)"%(bad, x[0], x[-1]))
+    hi = np.clip(np.searchsorted(x, energy, side="right"), 1, len(x)-1)
+    lo = hi - 1
+    h = x[hi] - x[lo]
+    a = (x[hi] - energy)/h; b = (energy - x[lo])/h
+    values = []
+    for i, (table, y) in enumerate([(fp_table, self.fp), (fdp_table, self.fdp)]):
+      value = a*table[lo] + b*table[hi]
+      if self.interpolation == "spline":
+        y2 = np.asarray(self._spline_table()[i])
+        value += ((a*a*a - a)*y2[lo] + (b*b*b - b)*y2[hi])*(h*h)/6.
+      values.append(flex.double(np.where(exact, table[row], value)))
+    return tuple(values)
+
+class george_sherrell(fp_fdp_table):
   def __init__(self,file):
     self.energy = flex.double()
     self.fp = flex.double()
     self.fdp = flex.double()
-    with open(file,"rU") as F:
+    with open(file,"r") as F:
       lines = F.readlines()
       for line in lines:
         tokens = [float(f) for f in line.strip().split()]
         self.energy.append(tokens[0])
         self.fp.append(tokens[1])
         self.fdp.append(tokens[2])
-  def fp_fdp_at_wavelength(self,angstroms):
-    lookup_energy = round2(12398.425/angstroms,0)
-    lookup_idx = list(self.energy).index(lookup_energy)
-    return self.fp[lookup_idx], self.fdp[lookup_idx]
   def plot_them(self,plt,f1,f2):
     plt.plot(self.energy, self.fp, f1)
     plt.plot(self.energy, self.fdp, f2)
@@ -0,0 +1,166 @@
+from __future__ import division, print_function
+import os
+import glob
+import numpy as np
+
+"""Per-rank HDF5 image containers for the batch simulation drivers.
+
+Instead of one gzipped SMV file per image (100000 files, 100000 metadata operations,
+and a glob plus reopen for every downstream read), each rank appends its images to a
+single chunked HDF5 file, one image per chunk, with a selectable compression filter.
+The layout is that of adse13_187/FormatHDF5AttributeGeometry:
+
+  images               (N, 1, slow, fast) float32, attrs dxtbx_detector_string and
+                       dxtbx_beam_string
+  central_wavelengths  (N,) mean wavelength of the spectrum
+
+plus per-image metadata datasets
+
+  image_index          (N,) global image number, the %06d of the SMV file name
+  spectrum_index       (N,) row of the spectra used
+  rotation_matrices    (N, 9) crystal rotation
+  direct_space_abc     (N, 9) as DIRECT_SPACE_ABC in the SMV header
+  rank                 (N,) simulating rank
+  sim_time             (N,) seconds spent in run_sim2smv
+
+so the files are read by FormatHDF5SimContainer (a FormatHDF5AttributeGeometry
+subclass) as well as directly with h5py.  Enable in the batch drivers with
+IMAGE_CONTAINER=<directory>; IMAGE_CONTAINER_COMPRESSION is gzip (default), lzf or none.
+
+An image already in the container is never appended again.  With a job ledger, the
+ledger entry of a container image is (file, row, checksum of the stored pixels), see
+row_output(), so JOB_LEDGER_VERIFY checks the row itself with verify_row().
+"""
+
+COMPRESSION = dict(gzip=dict(compression="gzip", compression_opts=4, shuffle=True),
+                   lzf=dict(compression="lzf", shuffle=True),
+                   none=dict())
+
+METADATA = [("image_index", np.int64, ()), ("spectrum_index", np.int64, ()),
+            ("central_wavelengths", np.float64, ()), ("rotation_matrices", np.float64, (9,)),
+            ("direct_space_abc", np.float64, (9,)), ("rank", np.int32, ()),
+            ("sim_time", np.float64, ())]
+
+def detector_string(SIM):
+  """dxtbx detector dict for the monolithic nanoBragg detector, beam at the center"""
+  fast, slow = SIM.detpixels_fastslow
+  pixsize = SIM.pixel_size_mm
+  return str({'panels':
+               [{'fast_axis': (1.0, 0.0, 0.0), 'slow_axis': (0.0, -1.0, 0.0),
+                 'gain': 1.0, 'identifier': '', 'image_size': (fast, slow), 'mask': [],
+                 'material': '', 'mu': 0.0, 'name': 'Panel',
+                 'origin': (-fast*pixsize/2., slow*pixsize/2., -SIM.distance_mm),
+                 'pedestal': 0.0, 'pixel_size': (pixsize, pixsize),
+                 'px_mm_strategy': {'type': 'SimplePxMmStrategy'}, 'raw_image_offset': (0, 0),
+                 'thickness': 0.0, 'trusted_range': (-1e7, 1e7), 'type': ''}]})
+
+def beam_string(wavelength_A):
+  return str({'direction': (0.0, 0.0, 1.0), 'wavelength': wavelength_A, 'divergence': 0.0,
+              'sigma_divergence': 0.0, 'polarization_normal': (0.0, 1.0, 0.0),
+              'polarization_fraction': 0.999, 'flux': 0.0, 'transmission': 1.0})
+
+class image_container(object):
+  def __init__(self, filename, compression="gzip"):
+    import h5py
+    self.filename = filename
+    self.compression = compression
+    self.handle = h5py.File(filename, "a")
+    self.rows = {} # image_index -> row
+    if "image_index" in self.handle:
+      for row, image_index in enumerate(self.handle["image_index"][:]):
+        self.rows[int(image_index)] = row
+
+  def __len__(self):
+    return self.handle["images"].shape[0] if "images" in self.handle else 0
+
+  def has(self, image_index):
+    return image_index in self.rows
+
+  def row_output(self, image_index):
+    """Ledger output of a stored image: (filename, row, sha256 of the float32 pixels)"""
+    row = self.rows[image_index]
+    return (self.filename, row, row_checksum(self.handle, row))
+
+  def _create(self, SIM, shape, wavelength_A):
+    images = self.handle.create_dataset("images", shape=(0,1)+shape, maxshape=(None,1)+shape,
+                                        chunks=(1,1)+shape, dtype=np.float32,
+                                        **COMPRESSION[self.compression])
+    images.attrs["dxtbx_detector_string"] = detector_string(SIM)
+    images.attrs["dxtbx_beam_string"] = beam_string(wavelength_A)
+    for name, dtype, item_shape in METADATA:
+      self.handle.create_dataset(name, shape=(0,)+item_shape, maxshape=(None,)+item_shape,
+                                 dtype=dtype)
+
+  def append(self, SIM, image_index, rotation, wavelength_A, rank, sim_time, spectrum_index=None):
+    from scitbx.matrix import sqr
+    fast, slow = SIM.detpixels_fastslow
+    if "images" not in self.handle: self._create(SIM, (slow, fast), wavelength_A)
+    row = len(self)
+    values = dict(image_index=image_index,
+                  spectrum_index=image_index if spectrum_index is None else spectrum_index,
+                  central_wavelengths=wavelength_A, rotation_matrices=rotation.elems,
+                  direct_space_abc=sqr(SIM.Amatrix).inverse().transpose().elems,
+                  rank=rank, sim_time=sim_time)
+    pixels = SIM.raw_pixels.as_numpy_array().astype(np.float32).reshape((1, slow, fast))
+    self.handle["images"].resize(row+1, axis=0)
+    self.handle["images"][row] = pixels
+    for name, dtype, item_shape in METADATA:
+      self.handle[name].resize(row+1, axis=0)
+      self.handle[name][row] = values[name]
+    self.handle.flush()
+    self.rows[image_index] = row
+    return self.row_output(image_index)
+
+  def close(self):
+    self.handle.close()
+
+def row_checksum(handle, row):
+  import hashlib
+  pixels = np.ascontiguousarray(handle["images"][row], dtype=np.float32)
+  return hashlib.sha256(pixels.tobytes()).hexdigest()
+
+def verify_row(filename, row, image_index, checksum):
+  """True if row of the container file still holds image_index with these pixels"""
+  import h5py
+  if len(_singleton) > 0 and _singleton[0].filename == filename: # open for appending here
+    handle = _singleton[0].handle
+    return (row < len(_singleton[0]) and int(handle["image_index"][row]) == image_index
+            and row_checksum(handle, row) == checksum)
+  if not os.path.isfile(filename): return False
+  with h5py.File(filename, "r") as handle:
+    if "images" not in handle or row >= handle["images"].shape[0]: return False
+    return int(handle["image_index"][row]) == image_index and row_checksum(handle, row) == checksum
+
+_singleton = []
+def rank_container(rank):
+  """This rank's container when IMAGE_CONTAINER is exported, else None"""
+  directory = os.environ.get("IMAGE_CONTAINER")
+  if directory is None: return None
+  if len(_singleton) == 0:
+    if not os.path.isdir(directory):
+      try: os.makedirs(directory)
+      except OSError: pass # another rank got there first
+    _singleton.append(image_container(os.path.join(directory, "rank_%05d.h5"%rank),
+                      compression=os.environ.get("IMAGE_CONTAINER_COMPRESSION","gzip")))
+  return _singleton[0]
+
+class container_directory(object):
+  """Read side: find images by global index across all rank containers"""
+  def __init__(self, directory):
+    import h5py
+    self.files = sorted(glob.glob(os.path.join(directory, "rank_*.h5")))
+    self.location = {}
+    for filename in self.files:
+      with h5py.File(filename, "r") as handle:
+        if "image_index" not in handle: continue
+        for row, image_index in enumerate(handle["image_index"][:]):
+          self.location[int(image_index)] = (filename, row)
+
+  def metadata(self, image_index, name):
+    import h5py
+    filename, row = self.location[image_index]
+    with h5py.File(filename, "r") as handle:
+      return handle[name][row]
+
+  def direct_space_abc(self, image_index):
+    return tuple(float(a) for a in self.metadata(image_index, "direct_space_abc"))
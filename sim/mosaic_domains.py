@@ -0,0 +1,105 @@
+from __future__ import division, print_function
+import math
+from collections import OrderedDict
+from scitbx.array_family import flex
+from scitbx.matrix import col, sqr
+
+"""Memoised mosaic-domain rotation sets.
+
+step5_pad.run_sim2smv and differential_roi_manager regenerate the UMAT_nm mosaic blocks
+for every image with the same recipe: rotation axes from a Mersenne twister seeded with
+0, rotation angles from a normal distribution of width mosaic_spread_deg on the global
+scitbx.random generator seeded with 1234.  The set only depends on
+
+  (spread, domain count, method, seeds)
+
+so mosaic_domain_provider.umats() builds it once per key.  The normal variates are kept
+at unit width as well; a request that differs only in spread (e.g. a new mosaicity
+proposal) rescales the unit angles instead of drawing new random numbers, which is how
+the normal variate itself is scaled, so the result is the freshly drawn set.
+
+Methods:
+
+  normal_sphere      count blocks, random axis, angle ~ N(0, spread); the step5_pad recipe
+  normal_pairs       the same count draws, each block followed by its inverse (2*count
+                     blocks, symmetric like SimData's double_* sets but not their draws)
+  anisotropic_pairs  spread = (eta_a, eta_b, eta_c): rotation vector with components
+                     eta_i * z_i (z_i unit normals) along the x, y, z axes of the frame
+                     the blocks are applied in, plus inverses (2*count blocks).  Each
+                     MCMC proposal of one eta rescales the cached unit draws.
+
+The last two are what cyto_batch's mosaic_method=memoised_pairs simulates with.
+
+The returned flex.mat3_double is shared; treat it as read-only.  On a cache hit the
+global scitbx.random generator is not reseeded or advanced.
+"""
+
+METHODS = ("normal_sphere", "normal_pairs", "anisotropic_pairs")
+
+class mosaic_domain_provider(object):
+  def __init__(self, max_sets=16):
+    self.max_sets = max_sets
+    self.unit_sets = OrderedDict() # (count, method, seed) -> unit draws
+    self.sets = OrderedDict() # (spread_deg, count, method, seed) -> flex.mat3_double
+    self.draws = 0
+    self.rescales = 0
+    self.hits = 0
+
+  def _remember(self, cache, key, value):
+    cache[key] = value
+    while len(cache) > self.max_sets: cache.popitem(last=False)
+    return value
+
+  def unit_set(self, count, method="normal_sphere", seed=(0,1234)):
+    """Unit-spread draws: (axes, angles in radians) for the isotropic methods, a list of
+    unit-normal rotation vectors for anisotropic_pairs"""
+    assert method in METHODS
+    key = (count, method, seed)
+    if key in self.unit_sets:
+      self.unit_sets[key] = self.unit_sets.pop(key)
+      return self.unit_sets[key]
+    import scitbx.random
+    self.draws += 1
+    scitbx.random.set_random_seed(seed[1])
+    rand_norm = scitbx.random.normal_distribution(mean=0, sigma=1.)
+    g = scitbx.random.variate(rand_norm)
+    if method == "anisotropic_pairs":
+      z = g(3*count)
+      draws = [col((z[3*i], z[3*i+1], z[3*i+2])) for i in range(count)]
+    else:
+      mersenne_twister = flex.mersenne_twister(seed=seed[0])
+      angles = g(count)
+      axes = [col(mersenne_twister.random_double_point_on_sphere()) for i in range(count)]
+      draws = (axes, angles)
+    return self._remember(self.unit_sets, key, draws)
+
+  def umats(self, spread_deg, count, method="normal_sphere", seed=(0,1234)):
+    """UMAT_nm for mosaic_spread_deg = spread_deg (a 3-tuple for anisotropic_pairs) and
+    mosaic_domains = count"""
+    if method == "anisotropic_pairs": spread_deg = tuple(spread_deg)
+    key = (spread_deg, count, method, seed)
+    if key in self.sets:
+      self.hits += 1
+      self.sets[key] = self.sets.pop(key)
+      return self.sets[key]
+    if (count, method, seed) in self.unit_sets: self.rescales += 1
+    draws = self.unit_set(count, method, seed)
+    UMAT_nm = flex.mat3_double()
+    if method == "anisotropic_pairs":
+      eta = col(spread_deg) * (math.pi/180.)
+      for z in draws:
+        rotation = col((eta[0]*z[0], eta[1]*z[1], eta[2]*z[2]))
+        angle = rotation.length()
+        U = rotation.normalize().axis_and_angle_as_r3_rotation_matrix(angle,deg=False) \
+            if angle > 0. else sqr((1,0,0,0,1,0,0,0,1))
+        UMAT_nm.append(U)
+        UMAT_nm.append(U.transpose())
+    else:
+      sigma = spread_deg * math.pi/180.
+      for site, m in zip(*draws):
+        U = site.axis_and_angle_as_r3_rotation_matrix(m*sigma,deg=False)
+        UMAT_nm.append(U)
+        if method == "normal_pairs": UMAT_nm.append(U.transpose())
+    return self._remember(self.sets, key, UMAT_nm)
+
+mosaic_domains = mosaic_domain_provider()
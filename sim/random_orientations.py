@@ -0,0 +1,101 @@
+from __future__ import division, print_function
+import os
+import numpy as np
+
+"""Index-addressable crystal orientations.
+
+LS49.legacy_random_orientations() draws N rotation matrices in a serial mersenne
+twister loop, which the batch drivers run on rank 0 and then broadcast.  Here the
+orientation of image i is available directly from i:
+
+  orientation_table    memory-maps a (N,9) float64 .npy table.  Built from the legacy
+                       generator it reproduces legacy_random_orientations() bit for bit.
+  counter_orientations computes orientation i from (seed, i) with the counter-based
+                       Philox generator; no table, no serial prologue.
+
+Build the compatibility table once with:
+  libtbx.python random_orientations.py <table.npy> [N_total]
+and export ORIENTATION_TABLE=<table.npy> for the batch drivers.  Exporting
+ORIENTATION_SEED=<seed> instead gives the drivers counter_orientations; these are a
+different set of orientations from the legacy list, so the images change too.
+"""
+
+def build_legacy_table(filename, N_total=100000):
+  from LS49 import legacy_random_orientations
+  table = np.array(legacy_random_orientations(N_total), dtype=np.float64).reshape((N_total,9))
+  tmp = "%s.%d.tmp"%(filename, os.getpid())
+  with open(tmp, "wb") as F:
+    np.save(F, table)
+  os.rename(tmp, filename)
+  return filename
+
+class orientation_table(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self._open()
+  def _open(self):
+    self.table = np.load(self.filename, mmap_mode="r")
+    assert self.table.ndim == 2 and self.table.shape[1] == 9
+  # pickle only the file name
+  def __getstate__(self):
+    return dict(filename=self.filename)
+  def __setstate__(self, state):
+    self.filename = state["filename"]
+    self._open()
+  def __len__(self):
+    return self.table.shape[0]
+  def __getitem__(self, i):
+    return tuple(float(v) for v in self.table[i])
+
+def uniform_deviates_to_matrix(u):
+  """Uniformly distributed rotations (Shoemake) from an (n,3) array of uniform deviates"""
+  u = np.atleast_2d(u)
+  a = np.sqrt(1.-u[:,0]); b = np.sqrt(u[:,0])
+  x = a*np.sin(2.*np.pi*u[:,1]); y = a*np.cos(2.*np.pi*u[:,1])
+  z = b*np.sin(2.*np.pi*u[:,2]); w = b*np.cos(2.*np.pi*u[:,2])
+  return np.stack([1.-2.*(y*y+z*z), 2.*(x*y-z*w),    2.*(x*z+y*w),
+                   2.*(x*y+z*w),    1.-2.*(x*x+z*z), 2.*(y*z-x*w),
+                   2.*(x*z-y*w),    2.*(y*z+x*w),    1.-2.*(x*x+y*y)], axis=1)
+
+class counter_orientations(object):
+  def __init__(self, N_total, seed=0):
+    assert N_total is not None and N_total >= 0, "counter_orientations needs N_total, the number of images"
+    self.seed = seed
+    self.N_total = int(N_total)
+  def __len__(self):
+    return self.N_total
+  def deviates(self, i):
+    # counter word 1 addresses the image, word 0 is left for the draws themselves
+    bit_generator = np.random.Philox(key=self.seed, counter=[0, int(i), 0, 0])
+    return np.random.Generator(bit_generator).random(3)
+  def batch(self, indices):
+    return uniform_deviates_to_matrix(np.array([self.deviates(i) for i in indices]))
+  def __getitem__(self, i):
+    if not 0 <= i < self.N_total:
+      raise IndexError("orientation %d out of range for N_total=%d"%(i, self.N_total))
+    return tuple(float(v) for v in self.batch([i])[0])
+
+def uses_indexed_orientations():
+  """True if every rank can address orientations itself, so rank 0 need not broadcast them"""
+  return "ORIENTATION_TABLE" in os.environ or "ORIENTATION_SEED" in os.environ
+
+def random_orientations(N_total=100000):
+  """Memory-mapped compatibility table if ORIENTATION_TABLE is exported, counter-based
+  orientations if ORIENTATION_SEED is, else the legacy list"""
+  seed = os.environ.get("ORIENTATION_SEED")
+  if seed is not None:
+    assert "ORIENTATION_TABLE" not in os.environ, "export ORIENTATION_TABLE or ORIENTATION_SEED, not both"
+    return counter_orientations(N_total, seed=int(seed))
+  filename = os.environ.get("ORIENTATION_TABLE")
+  if filename is None:
+    from LS49 import legacy_random_orientations
+    return legacy_random_orientations(N_total)
+  table = orientation_table(filename)
+  assert len(table) >= N_total, "orientation table %s has only %d entries"%(filename, len(table))
+  return table
+
+if __name__=="__main__":
+  import sys
+  N_total = int(sys.argv[2]) if len(sys.argv)>2 else 100000
+  build_legacy_table(sys.argv[1], N_total)
+  print("Wrote %d legacy orientations to %s"%(N_total, sys.argv[1]))
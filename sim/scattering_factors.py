@@ -0,0 +1,92 @@
+from __future__ import division, print_function
+from scitbx.array_family import flex
+
+"""Batched, cached f', f'' from the Henke or Sasaki tables.
+
+gen_fmodel.reset_wavelength() used to call henke.table(element).at_angstrom(wavelength)
+once per scatterer, so setting up 100 channels for a few thousand atoms meant a few
+hundred thousand interpreted table lookups.  The values only depend on the element
+and the wavelength, so the service here resolves them per element, for any number of
+wavelengths in one call, memoizes them, and writes them into an xray_structure by
+element group (flex set_selected) instead of per atom:
+
+  henke_service.fp_fdp("Fe", wavelengths)        -> flex.double fp, flex.double fdp
+  groups = element_groups(xray_structure)        # once per structure
+  henke_service.apply(xray_structure, wavelength, groups)
+
+The eltbx tables only interpolate one wavelength per call, so each (element, wavelength)
+is looked up once; a wavelength vector asked for again (the channel list of every
+image) is served whole from the batch cache.  apply() without groups reuses the groups
+of the structure it saw last.  The result is identical to the per-atom loop.
+"""
+
+def element_groups(xray_structure):
+  """Scatterer selections keyed by element symbol, as used for the table lookup"""
+  groups = {}
+  for i_seq, sc in enumerate(xray_structure.scatterers()):
+    groups.setdefault(sc.element_symbol(), flex.size_t()).append(i_seq)
+  return groups
+
+def label_groups(xray_structure, labels):
+  """Scatterer selections for scatterers whose label contains each of labels"""
+  groups = {}
+  for label in labels:
+    groups[label] = flex.size_t([i_seq for i_seq, sc in enumerate(xray_structure.scatterers())
+                                 if label in sc.label])
+  return groups
+
+class scattering_factor_service(object):
+  def __init__(self, table="henke"):
+    from cctbx.eltbx import henke, sasaki
+    self.table = dict(henke=henke, sasaki=sasaki)[table]
+    self.values = {} # (element, wavelength) -> (fp, fdp)
+    self.batches = {} # (element, wavelengths) -> (flex fp, flex fdp)
+    self.last_groups = None # (xray_structure, n_scatterers, groups)
+    self.lookups = 0
+
+  def fp_fdp(self, element, wavelengths):
+    """f', f'' of one element for a sequence of wavelengths (Angstrom)"""
+    batch_key = (element, tuple([float(wavelength) for wavelength in wavelengths]))
+    if batch_key not in self.batches:
+      fp = flex.double(); fdp = flex.double()
+      for wavelength in batch_key[1]:
+        value = self.value(element, wavelength)
+        fp.append(value[0]); fdp.append(value[1])
+      self.batches[batch_key] = (fp, fdp)
+    fp, fdp = self.batches[batch_key]
+    return fp.deep_copy(), fdp.deep_copy()
+
+  def value(self, element, wavelength):
+    """(f', f'') of one element at one wavelength"""
+    key = (element, float(wavelength))
+    if key not in self.values:
+      factors = self.table.table(element).at_angstrom(float(wavelength))
+      self.values[key] = (factors.fp(), factors.fdp())
+      self.lookups += 1
+    return self.values[key]
+
+  def groups(self, xray_structure):
+    """element_groups(xray_structure), kept for the most recent structure"""
+    n_scatterers = xray_structure.scatterers().size()
+    if (self.last_groups is None or self.last_groups[0] is not xray_structure
+        or self.last_groups[1] != n_scatterers):
+      self.last_groups = (xray_structure, n_scatterers, element_groups(xray_structure))
+    return self.last_groups[2]
+
+  def precompute(self, elements, wavelengths):
+    """Fill the cache for every element x wavelength, returning {element: (fp, fdp)}"""
+    return dict([(element, self.fp_fdp(element, wavelengths)) for element in elements])
+
+  def apply(self, xray_structure, wavelength, groups=None):
+    """Set f', f'' of every scatterer at one wavelength, one flex operation per element"""
+    if groups is None: groups = self.groups(xray_structure)
+    scatterers = xray_structure.scatterers()
+    fps = scatterers.extract_fps(); fdps = scatterers.extract_fdps()
+    for element in groups:
+      fp, fdp = self.value(element, wavelength)
+      fps.set_selected(groups[element], fp)
+      fdps.set_selected(groups[element], fdp)
+    scatterers.set_fps(fps)
+    scatterers.set_fdps(fdps)
+
+henke_service = scattering_factor_service("henke")
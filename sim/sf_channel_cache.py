@@ -0,0 +1,140 @@
+from __future__ import division, print_function
+import os
+import json
+import hashlib
+import numpy as np
+from scitbx.array_family import flex
+
+"""Content-addressed on-disk cache of per-channel structure factor amplitudes.
+
+The amplitudes used for each wavelength channel depend only on the PDB model, the
+wavelength, the FE1/FE2 anomalous tables, k_sol/b_sol, the resolution and the
+algorithm.  A hash of exactly those inputs names a float64 .npy file holding the
+amplitude data; the Miller indices and crystal symmetry are stored once per model
+(they do not change with wavelength).  Data files are opened with numpy memory
+mapping, so that after a single precompute every rank reads from the page cache
+instead of re-running the bulk-solvent fmodel calculation.
+
+Enable in the simulation drivers by exporting SF_CHANNEL_CACHE=<directory>.
+"""
+
+def _sha(*items):
+  H = hashlib.sha256()
+  for item in items:
+    if not isinstance(item, bytes): item = str(item).encode()
+    H.update(item)
+    H.update(b"\0")
+  return H.hexdigest()
+
+def table_digest(tables):
+  """Digest of an anomalous f',f" table (george_sherrell or compatible)"""
+  if tables is None: return "none"
+  return _sha(*[np.asarray(list(getattr(tables, attr)), dtype=np.float64).tobytes()
+                for attr in ["energy", "fp", "fdp"]])
+
+class sf_channel_cache(object):
+  def __init__(self, cache_dir, pdb_text, FE1_model, FE2_model):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      try: os.makedirs(cache_dir)
+      except OSError: pass # another rank got there first
+    self.FE1_model = FE1_model
+    self.FE2_model = FE2_model
+    self.model_digest = _sha(pdb_text, table_digest(FE1_model), table_digest(FE2_model))
+    self._miller_sets = {} # per-process, keyed by structure key
+    self.hits = 0
+    self.misses = 0
+
+  def structure_key(self, fmodel_generator):
+    """Everything that determines the Miller set: model, symmetry, resolution & fmodel parameters"""
+    P = fmodel_generator.params2
+    XS = fmodel_generator.xray_structure
+    return _sha(self.model_digest, XS.unit_cell().parameters(),
+                XS.space_group_info().type().hall_symbol(),
+                P.high_resolution, P.fmodel.k_sol, P.fmodel.b_sol,
+                P.structure_factors_accuracy.algorithm)
+
+  def channel_key(self, fmodel_generator, wavelength_A):
+    return _sha(self.structure_key(fmodel_generator), "%.10f"%wavelength_A)
+
+  def _path(self, key, suffix):
+    return os.path.join(self.cache_dir, key + suffix)
+
+  def _atomic_save(self, path, array):
+    tmp = "%s.%d.tmp"%(path, os.getpid())
+    with open(tmp, "wb") as F:
+      np.save(F, array)
+    os.rename(tmp, path)
+
+  def _miller_set(self, skey):
+    if skey not in self._miller_sets:
+      with open(self._path(skey, ".json"), "r") as F:
+        info = json.load(F)
+      from cctbx import crystal, miller
+      symmetry = crystal.symmetry(unit_cell=tuple(info["unit_cell"]),
+                                  space_group_symbol="Hall: %s"%info["hall_symbol"])
+      indices = np.load(self._path(skey, "_indices.npy"))
+      MI = flex.miller_index([tuple(int(i) for i in hkl) for hkl in indices])
+      self._miller_sets[skey] = miller.set(symmetry, MI, anomalous_flag=info["anomalous_flag"])
+    return self._miller_sets[skey]
+
+  def get(self, fmodel_generator, wavelength_A):
+    """Return the cached amplitude array, or None if this channel was never computed"""
+    skey = self.structure_key(fmodel_generator)
+    path = self._path(self.channel_key(fmodel_generator, wavelength_A), ".npy")
+    if not (os.path.isfile(path) and os.path.isfile(self._path(skey, ".json"))): return None
+    data = np.load(path, mmap_mode="r") # contiguous float64, as written by put
+    amplitudes = self._miller_set(skey).array(data=flex.double(data)) # one copy, off the map
+    amplitudes.set_observation_type_xray_amplitude()
+    return amplitudes
+
+  def put(self, fmodel_generator, wavelength_A, amplitudes):
+    skey = self.structure_key(fmodel_generator)
+    if not os.path.isfile(self._path(skey, ".json")):
+      indices = np.array(list(amplitudes.indices()), dtype=np.int32).reshape((-1,3))
+      self._atomic_save(self._path(skey, "_indices.npy"), indices)
+      info = dict(unit_cell=list(amplitudes.unit_cell().parameters()),
+                  hall_symbol=amplitudes.space_group_info().type().hall_symbol(),
+                  anomalous_flag=bool(amplitudes.anomalous_flag()))
+      tmp = self._path(skey, ".json.%d.tmp"%os.getpid())
+      with open(tmp, "w") as F:
+        json.dump(info, F)
+      os.rename(tmp, self._path(skey, ".json"))
+    self._atomic_save(self._path(self.channel_key(fmodel_generator, wavelength_A), ".npy"),
+                      amplitudes.data().as_numpy_array())
+
+  def compute(self, fmodel_generator, wavelength_A):
+    fmodel_generator.reset_wavelength(wavelength_A)
+    fmodel_generator.reset_specific_at_wavelength(
+                     label_has="FE1",tables=self.FE1_model,newvalue=wavelength_A)
+    fmodel_generator.reset_specific_at_wavelength(
+                     label_has="FE2",tables=self.FE2_model,newvalue=wavelength_A)
+    return fmodel_generator.get_amplitudes()
+
+  def amplitudes(self, fmodel_generator, wavelength_A):
+    """Cached amplitudes for one channel, computing and storing them on a miss"""
+    result = self.get(fmodel_generator, wavelength_A)
+    if result is not None:
+      self.hits += 1
+      return result
+    self.misses += 1
+    result = self.compute(fmodel_generator, wavelength_A)
+    self.put(fmodel_generator, wavelength_A, result)
+    return result
+
+  def precompute(self, fmodel_generator, wavelengths, rank=0, size=1):
+    """Fill the cache for a list of wavelengths, splitting the channels over ranks"""
+    for x in range(len(wavelengths)):
+      if x%size != rank: continue
+      self.amplitudes(fmodel_generator, wavelengths[x])
+
+_singletons = {}
+def channel_cache(local_data, FE1="Fe_oxidized_model", FE2="Fe_reduced_model"):
+  """Process-level cache object when SF_CHANNEL_CACHE is exported, else None"""
+  cache_dir = os.environ.get("SF_CHANNEL_CACHE")
+  if cache_dir is None: return None
+  key = (cache_dir, FE1, FE2)
+  if key not in _singletons:
+    _singletons[key] = sf_channel_cache(cache_dir, local_data.get("pdb_lines"),
+                                        local_data.get(FE1), local_data.get(FE2))
+  return _singletons[key]
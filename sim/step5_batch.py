@@ -19,7 +19,7 @@ generate_spectra.big_data = ls49_big_data
 
 # Develop procedure for MPI control
 
-def tst_one(image,spectra,crystal,random_orientation):
+def tst_one(image,spectra,crystal,random_orientation,overwrite=False,on_written=None):
   iterator = spectra.generate_recast_renormalized_image(image=image,energy=7120.,total_flux=1e12)
 
   quick = False
@@ -29,7 +29,8 @@ def tst_one(image,spectra,crystal,random_orientation):
   file_prefix = prefix_root%image
   rand_ori = sqr(random_orientation)
   from LS49.sim.step5_pad import run_sim2smv
-  run_sim2smv(prefix = file_prefix,crystal = crystal,spectra=iterator,rotation=rand_ori,quick=quick,rank=rank)
+  return run_sim2smv(prefix = file_prefix,crystal = crystal,spectra=iterator,rotation=rand_ori,quick=quick,rank=rank,
+                     overwrite=overwrite,on_written=on_written,image_index=image)
 
 if __name__=="__main__":
   from mpi4py import MPI
@@ -40,19 +41,23 @@ if __name__=="__main__":
   workaround_nt = int(os.environ.get("OMP_NUM_THREADS",1))
   omptbx.omp_set_num_threads(workaround_nt)
   N_total = 100000 # number of items to simulate
-  N_stride = size # total number of worker tasks
+  spectra_store_file = os.environ.get("SPECTRA_STORE") # built by LS49/spectra/spectra_store.py
+  from LS49.sim.random_orientations import uses_indexed_orientations
+  indexed_orientations = uses_indexed_orientations() # ORIENTATION_TABLE or ORIENTATION_SEED
   print("hello from rank %d of %d"%(rank,size),"with omp_threads=",omp_get_num_procs())
-  import datetime
+  import datetime, functools
   start_elapse = time()
   if rank == 0:
     print("Rank 0 time", datetime.datetime.now())
     from LS49.spectra.generate_spectra import spectra_simulation
     from LS49.sim.step5_pad import microcrystal
     print("hello2 from rank %d of %d"%(rank,size))
-    SS = spectra_simulation()
+    # with a precomputed spectra store, every rank memory-maps it instead of receiving SS
+    SS = None if spectra_store_file is not None else spectra_simulation()
     C = microcrystal(Deff_A = 4000, length_um = 4., beam_diameter_um = 1.0) # assume smaller than 10 um crystals
     from LS49 import legacy_random_orientations
-    random_orientations = legacy_random_orientations(N_total)
+    # with indexed orientations, every rank addresses them itself instead of receiving the list
+    random_orientations = None if indexed_orientations else legacy_random_orientations(N_total)
     transmitted_info = dict(spectra = SS,
                             crystal = C,
                             random_orientations = random_orientations)
@@ -60,14 +65,57 @@ if __name__=="__main__":
     transmitted_info = None
   transmitted_info = comm.bcast(transmitted_info, root = 0)
   comm.barrier()
-  parcels = list(range(rank,N_total,N_stride))
-  while len(parcels)>0:
-    import random
-    idx = random.choice(parcels)
+  if spectra_store_file is not None:
+    from LS49.spectra.spectra_store import spectra_store
+    transmitted_info["spectra"] = spectra_store(spectra_store_file)
+  if indexed_orientations:
+    from LS49.sim.random_orientations import random_orientations
+    transmitted_info["random_orientations"] = random_orientations(N_total)
+
+  from LS49.sim.sf_channel_cache import channel_cache
+  from LS49.sim.step5_pad import data
+  local_data = data()
+  sf_cache = channel_cache(local_data)
+  if sf_cache is not None:
+    # fill the channel cache once, split over ranks, instead of 100 fmodels for every image
+    from scitbx.array_family import flex
+    from LS49.sim.util_fmodel import gen_fmodel
+    channel_wavelengths = 12398.425 / (flex.double(range(100)) + 7120. - 49.5)
+    GF = gen_fmodel(resolution=1.7,pdb_text=local_data.get("pdb_lines"),algorithm="fft",
+                    wavelength=channel_wavelengths[50])
+    GF.set_k_sol(0.435)
+    GF.make_P1_primitive()
+    sf_cache.precompute(GF, channel_wavelengths, rank=rank, size=size)
+    print("rank",rank,"channel cache hits",sf_cache.hits,"misses",sf_cache.misses)
+    comm.barrier()
+  # IMAGE_SCHEDULER=dynamic hands out images on demand instead of fixed round-robin parcels
+  from LS49.utils.image_scheduler import make_queue
+  queue = make_queue(os.environ.get("IMAGE_SCHEDULER","static"), comm, N_total,
+                     chunk=int(os.environ.get("IMAGE_SCHEDULER_CHUNK",1)), MPI=MPI)
+  # JOB_LEDGER=<dir> resumes a campaign from its ledger instead of per-file existence checks
+  from LS49.utils.job_ledger import campaign_ledger, input_hash
+  ledger = campaign_ledger(comm)
+  ledger_verify = bool(int(os.environ.get("JOB_LEDGER_VERIFY",0)))
+  for idx in queue:
+    if ledger is not None:
+      image_hash = input_hash("step5_MPIbatch", idx, transmitted_info["random_orientations"][idx])
+      if ledger.is_complete(idx, image_hash, verify=ledger_verify): continue
     cache_time = time()
     print("idx------start-------->",idx,"rank",rank,time())
+    # the ledger entry is made once the image file is complete, possibly by the background writer
+    on_written = None if ledger is None else functools.partial(ledger.record, idx, image_hash)
     tst_one(image=idx,spectra=transmitted_info["spectra"],
-            crystal=transmitted_info["crystal"],random_orientation=transmitted_info["random_orientations"][idx])
-    parcels.remove(idx)
+            crystal=transmitted_info["crystal"],random_orientation=transmitted_info["random_orientations"][idx],
+            overwrite=ledger is not None,on_written=on_written)
     print("idx------finis-------->",idx,"rank",rank,time(),"elapsed",time()-cache_time)
+  queue.free() # every rank, once its loop is done
+  from LS49.utils.async_writer import image_writer
+  writer = image_writer()
+  if writer is not None:
+    writer.close() # wait for the background writes
+    print("rank",rank,"wrote",writer.n_written,"images in background, compute blocked %.3f seconds"%writer.wait_time)
+  if os.environ.get("IMAGE_CONTAINER") is not None:
+    from LS49.sim.image_container import rank_container
+    rank_container(rank).close()
+  print("rank",rank,"simulated",queue.n_claimed,"images, waited %.3f seconds for work"%queue.wait_time)
   print("OK exiting rank",rank,"at",datetime.datetime.now(),"seconds elapsed",time()-start_elapse)
@@ -10,19 +10,20 @@ from cctbx import crystal
 import math
 import scitbx
 from LS49.sim.util_fmodel import gen_fmodel
+import os
 
 big_data = "." # directory location for reference files
 def full_path(filename):
-  import os
   return os.path.join(big_data,filename)
 
 def data():
-  from LS49.sim.fdp_plot import george_sherrell
+  # files are read and parsed once per process; the tables are shared, treat as read-only
+  from LS49.sim.structure_registry import registry
   return dict(
-    pdb_lines = open(full_path("1m2a.pdb"),"r").read(),
-    Fe_oxidized_model = george_sherrell(full_path("data_sherrell/pf-rd-ox_fftkk.out")),
-    Fe_reduced_model = george_sherrell(full_path("data_sherrell/pf-rd-red_fftkk.out")),
-    Fe_metallic_model = george_sherrell(full_path("data_sherrell/Fe_fake.dat"))
+    pdb_lines = registry.text(full_path("1m2a.pdb")),
+    Fe_oxidized_model = registry.anomalous_table(full_path("data_sherrell/pf-rd-ox_fftkk.out")),
+    Fe_reduced_model = registry.anomalous_table(full_path("data_sherrell/pf-rd-red_fftkk.out")),
+    Fe_metallic_model = registry.anomalous_table(full_path("data_sherrell/Fe_fake.dat"))
   )
 
 def raw_to_pickle(raw_pixels, fileout):
@@ -73,19 +74,42 @@ dials.image_viewer idx-step4_000000_integrated_experiments.json idx-step4_000000
 """
 def write_safe(fname):
   # make sure file or compressed file is not already on disk
-  import os
   return (not os.path.isfile(fname)) and (not os.path.isfile(fname+".gz"))
 
 add_spots_algorithm = "NKS"
-def channel_pixels(wavelength_A,flux,N,UMAT_nm,Amatrix_rot,fmodel_generator,local_data,rank):
+use_linear_channels = bool(int(os.environ.get("SF_LINEAR_CHANNELS",0)))
+linear_fmodel_singletons = {}
+def linear_fmodel(fmodel_generator,local_data):
+  """Per-process anomalous_linear_fmodel, shared by all images with the same model and fmodel parameters"""
+  from LS49.sim.util_fmodel import anomalous_linear_fmodel
+  P = fmodel_generator.params2
+  key = (local_data.get("pdb_lines"), P.high_resolution, P.fmodel.k_sol, P.fmodel.b_sol,
+         P.structure_factors_accuracy.algorithm)
+  if key not in linear_fmodel_singletons:
+    linear_fmodel_singletons[key] = anomalous_linear_fmodel(fmodel_generator)
+  return linear_fmodel_singletons[key]
+
+def channel_amplitudes(wavelength_A,fmodel_generator,local_data):
+  from LS49.sim.sf_channel_cache import channel_cache
+  sf_cache = channel_cache(local_data)
+  print("USING scatterer-specific energy-dependent scattering factors")
+  if sf_cache is not None:
+    return sf_cache.amplitudes(fmodel_generator, wavelength_A)
+  if use_linear_channels:
+    return linear_fmodel(fmodel_generator,local_data).amplitudes(wavelength_A,
+      dict(FE1=local_data.get("Fe_oxidized_model"),FE2=local_data.get("Fe_reduced_model")))
   fmodel_generator.reset_wavelength(wavelength_A)
   fmodel_generator.reset_specific_at_wavelength(
                    label_has="FE1",tables=local_data.get("Fe_oxidized_model"),newvalue=wavelength_A)
   fmodel_generator.reset_specific_at_wavelength(
                    label_has="FE2",tables=local_data.get("Fe_reduced_model"),newvalue=wavelength_A)
-  print("USING scatterer-specific energy-dependent scattering factors")
-  sfall_channel = fmodel_generator.get_amplitudes()
-  SIM = nanoBragg(detpixels_slowfast=(3000,3000),pixel_size_mm=0.11,Ncells_abc=(N,N,N),
+  return fmodel_generator.get_amplitudes()
+
+def channel_pixels(wavelength_A,flux,N,UMAT_nm,Amatrix_rot,fmodel_generator,local_data,rank,
+                   sfall_channel=None,detpixels_slowfast=(3000,3000)):
+  if sfall_channel is None:
+    sfall_channel = channel_amplitudes(wavelength_A,fmodel_generator,local_data)
+  SIM = nanoBragg(detpixels_slowfast=detpixels_slowfast,pixel_size_mm=0.11,Ncells_abc=(N,N,N),
     wavelength_A=wavelength_A,verbose=0)
   SIM.adc_offset_adu = 10 # Do not offset by 40
   SIM.mosaic_spread_deg = 0.05 # interpreted by UMAT_nm as a half-width stddev
@@ -132,10 +156,70 @@ def channel_pixels(wavelength_A,flux,N,UMAT_nm,Amatrix_rot,fmodel_generator,loca
 from LS49.sim.debug_utils import channel_extractor
 CHDBG_singleton = channel_extractor()
 
-def run_sim2smv(prefix,crystal,spectra,rotation,rank,quick=False,save_bragg=False):
+# CHANNEL_SESSION=1 sums all channels of an image into one reusable per-rank nanoBragg
+# session instead of constructing a new 3000x3000 simulator per channel.  Per-channel
+# images are then not available to CHDBG_singleton.
+use_channel_session = bool(int(os.environ.get("CHANNEL_SESSION",0)))
+channel_session_singleton = None
+channel_session_key = None
+def get_channel_session(N,UMAT_nm):
+  # keyed on the crystal size and mosaic blocks; a change frees the old session
+  global channel_session_singleton, channel_session_key
+  key = (N, tuple(UMAT_nm))
+  if channel_session_singleton is not None and key != channel_session_key:
+    channel_session_singleton.free_all()
+    channel_session_singleton = None
+  if channel_session_singleton is None:
+    from LS49.sim.channel_simulator import MultiChannelSession
+    channel_session_singleton = MultiChannelSession(N, UMAT_nm, algo=add_spots_algorithm)
+    channel_session_key = key
+  return channel_session_singleton
+
+def add_water_background(SIM):
+  # rough approximation to water: interpolation points for sin(theta/lambda) vs structure factor
+  bg = flex.vec2_double([(0,2.57),(0.0365,2.58),(0.07,2.8),(0.12,5),(0.162,8),(0.2,6.75),(0.18,7.32),(0.216,6.75),(0.236,6.5),(0.28,4.5),(0.3,4.3),(0.345,4.36),(0.436,3.77),(0.5,3.17)])
+  SIM.Fbg_vs_stol = bg
+  SIM.amorphous_sample_thick_mm = 0.1
+  SIM.amorphous_density_gcm3 = 1
+  SIM.amorphous_molecular_weight_Da = 18
+  SIM.flux=1e12
+  SIM.beamsize_mm=0.003 # square (not user specified)
+  SIM.exposure_s=1.0 # multiplies flux x exposure
+  SIM.add_background()
+
+def add_air_background(SIM):
+  # rough approximation to air
+  bg = flex.vec2_double([(0,14.1),(0.045,13.5),(0.174,8.35),(0.35,4.78),(0.5,4.22)])
+  SIM.Fbg_vs_stol = bg
+  #SIM.amorphous_sample_thick_mm = 35 # between beamstop and collimator
+  SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
+  SIM.amorphous_density_gcm3 = 1.2e-3
+  SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
+  print("amorphous_sample_size_mm=",SIM.amorphous_sample_size_mm)
+  print("amorphous_sample_thick_mm=",SIM.amorphous_sample_thick_mm)
+  print("amorphous_density_gcm3=",SIM.amorphous_density_gcm3)
+  print("amorphous_molecular_weight_Da=",SIM.amorphous_molecular_weight_Da)
+  SIM.add_background()
+
+def add_water_and_air_background(SIM):
+  add_water_background(SIM)
+  add_air_background(SIM)
+
+def run_sim2smv(prefix,crystal,spectra,rotation,rank,quick=False,save_bragg=False,overwrite=False,on_written=None,
+                image_index=None):
   local_data = data()
   smv_fileout = prefix + ".img"
-  if not quick:
+  from time import time
+  start_time = time()
+  from LS49.sim.image_container import rank_container
+  container = None if image_index is None else rank_container(rank) # None unless IMAGE_CONTAINER
+  if container is not None:
+    if container.has(image_index): # even with overwrite: a row is never appended twice
+      print("Image %d already in %s, skipping in rank %d"%(image_index,container.filename,rank))
+      # stored before a crash, but possibly not yet in the caller's job ledger
+      if overwrite and on_written is not None: on_written([container.row_output(image_index)])
+      return
+  elif not quick and not overwrite: # with overwrite, the caller's job ledger decides
     if not write_safe(smv_fileout):
       print("File %s already exists, skipping in rank %d"%(smv_fileout,rank))
       return
@@ -178,15 +262,9 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,quick=False,save_bragg=Fals
                            # mosaic_domains setter must come after mosaic_spread_deg setter
   SIM.distance_mm=141.7
 
-  UMAT_nm = flex.mat3_double()
-  mersenne_twister = flex.mersenne_twister(seed=0)
-  scitbx.random.set_random_seed(1234)
-  rand_norm = scitbx.random.normal_distribution(mean=0, sigma=SIM.mosaic_spread_deg * math.pi/180.)
-  g = scitbx.random.variate(rand_norm)
-  mosaic_rotation = g(SIM.mosaic_domains)
-  for m in mosaic_rotation:
-    site = col(mersenne_twister.random_double_point_on_sphere())
-    UMAT_nm.append( site.axis_and_angle_as_r3_rotation_matrix(m,deg=False) )
+  # same rotations as drawing them here (axes seed 0, angles seed 1234), memoised per rank
+  from LS49.sim.mosaic_domains import mosaic_domains
+  UMAT_nm = mosaic_domains.umats(SIM.mosaic_spread_deg, SIM.mosaic_domains, seed=(0,1234))
   SIM.set_mosaic_blocks(UMAT_nm)
 
   #SIM.detector_thick_mm = 0.5 # = 0 for Rayonix
@@ -305,47 +383,63 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,quick=False,save_bragg=Fals
   print(crystal.domains_per_crystal)
   SIM.raw_pixels *= crystal.domains_per_crystal; # must calculate the correct scale!
 
-  for x in range(len(flux)):
+  if use_channel_session:
+    session = get_channel_session(N,UMAT_nm)
+    session.begin_image(Amatrix_rot)
+    for x in range(len(flux)):
+      print("+++++++++++++++++++++++++++++++++++++++ Wavelength",x)
+      session.add_channel(wavlen[x],flux[x],channel_amplitudes(wavlen[x],GF,local_data),rank=rank)
+    SIM.raw_pixels += session.end_image() * crystal.domains_per_crystal
+    print("channel session rank %d"%rank, session.image_stats)
+
+  # CHANNEL_PARALLEL=<workers> splits the channels over a pool, see channel_parallel
+  from LS49.sim.channel_parallel import rank_channel_pool
+  pool = None if use_channel_session or add_spots_algorithm=="cuda" else rank_channel_pool()
+  if pool is not None:
+    # amplitudes first, in this process, so the workers share no structure factor state
+    amplitudes = [channel_amplitudes(wavlen[x],GF,local_data) for x in range(len(flux))]
+    def channel_simulator(x):
+      print("+++++++++++++++++++++++++++++++++++++++ Wavelength",x)
+      return channel_pixels(wavlen[x],flux[x],N,UMAT_nm,Amatrix_rot,GF,local_data,rank,
+                            sfall_channel=amplitudes[x])
+    from libtbx.development.timers import Profiler
+    P = Profiler("nanoBragg %d channels over %d workers rank %d"%(len(flux),pool.workers,rank))
+    SIM.raw_pixels += pool.sum_channels(channel_simulator, range(len(flux)),
+                                        factor=crystal.domains_per_crystal)
+    del P
+
+  # CHANNEL_ACCUMULATION selects how the channel images are summed, see channel_accumulator
+  from LS49.sim.channel_accumulator import rank_channel_accumulator
+  accumulator = rank_channel_accumulator()
+  accumulator.begin(SIM)
+  for x in range(0 if use_channel_session or pool is not None else len(flux)):
     from libtbx.development.timers import Profiler
     P = Profiler("nanoBragg Python and C++ rank %d"%(rank))
 
     print("+++++++++++++++++++++++++++++++++++++++ Wavelength",x)
     CH = channel_pixels(wavlen[x],flux[x],N,UMAT_nm,Amatrix_rot,GF,local_data,rank)
-    SIM.raw_pixels += CH.raw_pixels * crystal.domains_per_crystal
+    accumulator.add(CH.raw_pixels, crystal.domains_per_crystal)
     CHDBG_singleton.extract(channel_no=x, data=CH.raw_pixels)
     CH.free_all()
 
     del P
+  accumulator.finish()
 
   # image 1: crystal Bragg scatter
   if quick or save_bragg:  SIM.to_smv_format(fileout=prefix + "_intimage_001.img")
 
   if save_bragg: raw_to_pickle(SIM.raw_pixels, fileout=prefix + "_dblprec_001.pickle")
 
-  # rough approximation to water: interpolation points for sin(theta/lambda) vs structure factor
-  bg = flex.vec2_double([(0,2.57),(0.0365,2.58),(0.07,2.8),(0.12,5),(0.162,8),(0.2,6.75),(0.18,7.32),(0.216,6.75),(0.236,6.5),(0.28,4.5),(0.3,4.3),(0.345,4.36),(0.436,3.77),(0.5,3.17)])
-  SIM.Fbg_vs_stol = bg
-  SIM.amorphous_sample_thick_mm = 0.1
-  SIM.amorphous_density_gcm3 = 1
-  SIM.amorphous_molecular_weight_Da = 18
-  SIM.flux=1e12
-  SIM.beamsize_mm=0.003 # square (not user specified)
-  SIM.exposure_s=1.0 # multiplies flux x exposure
-  SIM.add_background()
-  if quick:  SIM.to_smv_format(fileout=prefix + "_intimage_002.img")
-
-  # rough approximation to air
-  bg = flex.vec2_double([(0,14.1),(0.045,13.5),(0.174,8.35),(0.35,4.78),(0.5,4.22)])
-  SIM.Fbg_vs_stol = bg
-  #SIM.amorphous_sample_thick_mm = 35 # between beamstop and collimator
-  SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
-  SIM.amorphous_density_gcm3 = 1.2e-3
-  SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
-  print("amorphous_sample_size_mm=",SIM.amorphous_sample_size_mm)
-  print("amorphous_sample_thick_mm=",SIM.amorphous_sample_thick_mm)
-  print("amorphous_density_gcm3=",SIM.amorphous_density_gcm3)
-  print("amorphous_molecular_weight_Da=",SIM.amorphous_molecular_weight_Da)
-  SIM.add_background()
+  # background does not depend on the crystal; with BACKGROUND_TEMPLATE it is reused across images
+  from LS49.sim.background_template import rank_background_templates
+  templates = None if quick else rank_background_templates()
+  if templates is not None:
+    templates.add_background(SIM, add_water_and_air_background, recipe="step5_pad")
+    print("background templates rank %d hits %d misses %d"%(rank,templates.hits,templates.misses))
+  else:
+    add_water_background(SIM)
+    if quick:  SIM.to_smv_format(fileout=prefix + "_intimage_002.img")
+    add_air_background(SIM)
 
   #apply beamstop mask here
 
@@ -378,7 +472,13 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,quick=False,save_bragg=Fals
 
   print("raw_pixels=",SIM.raw_pixels)
   extra = "PREFIX=%s;\nRANK=%d;\n"%(prefix,rank)
-  SIM.to_smv_format_py(fileout=smv_fileout,intfile_scale=1,rotmat=True,extra=extra,gz=True)
+  if container is not None:
+    stored = container.append(SIM, image_index, rotation, wavelength_A, rank, time()-start_time,
+                     spectrum_index=image_index)
+    if on_written is not None: on_written([stored])
+  else:
+    from LS49.utils.async_writer import write_smv_image
+    write_smv_image(SIM, smv_fileout, extra, on_written) # atomic; in the background if ASYNC_IMAGE_WRITER
 
   # try to write as CBF
   if False:
@@ -0,0 +1,95 @@
+from __future__ import division, print_function
+import os
+import hashlib
+from six.moves import cPickle as pickle
+
+"""Process-level registry of parsed input files.
+
+step5_pad.data() re-read the PDB and the three Fe tables on every call, and
+get_C2_structures() re-tokenized and re-parsed 1m2a into four xray structures on
+every call, both on hot paths (per image, per LBFGS iteration).  The registry parses
+each (file content hash, selection) once per process and hands out
+
+  text(path)                  the file text, re-read only if size or mtime change
+  anomalous_table(path)       a copy of the george_sherrell table, parsed once
+  xray_structure(pdb_text, selection, selector)
+                              a copy (deep_copy_scatterers) of the parsed structure, so
+                              callers may reset f', f'' freely
+
+With STRUCTURE_REGISTRY=<directory> exported, parsed structures are also pickled
+there (atomically), so that new ranks load them instead of parsing the PDB.
+"""
+
+def text_digest(text):
+  return hashlib.sha256(text.encode()).hexdigest()
+
+def copy_table(table):
+  """Copy of an fp_fdp_table with its own energy, fp, fdp arrays"""
+  import copy
+  result = copy.copy(table)
+  for name in ["energy", "fp", "fdp"]:
+    setattr(result, name, getattr(table, name).deep_copy())
+  result.__dict__.pop("_index", None) # rebuilt on first lookup
+  return result
+
+class structure_registry(object):
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self.texts = {} # path -> (size, mtime, text)
+    self.tables = {} # (path, size, mtime) -> table
+    self.structures = {} # (digest, selection) -> xray.structure
+    self.parses = 0
+
+  def _stat(self, path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+  def text(self, path):
+    size, mtime = self._stat(path)
+    entry = self.texts.get(path)
+    if entry is None or entry[0:2] != (size, mtime):
+      with open(path, "r") as F:
+        entry = (size, mtime, F.read())
+      self.texts[path] = entry
+    return entry[2]
+
+  def anomalous_table(self, path):
+    from LS49.sim.fdp_plot import george_sherrell
+    key = (path,) + self._stat(path)
+    if key not in self.tables:
+      self.tables[key] = george_sherrell(path)
+    return copy_table(self.tables[key])
+
+  def _disk_path(self, key):
+    return os.path.join(self.cache_dir, "%s_%s.pickle"%key)
+
+  def _parse(self, pdb_text, selection, selector):
+    key = (text_digest(pdb_text), selection)
+    if self.cache_dir is not None and os.path.isfile(self._disk_path(key)):
+      with open(self._disk_path(key), "rb") as F:
+        return pickle.load(F)
+    from iotbx import pdb
+    lines = pdb_text if selector is None else selector(pdb_text)
+    pdb_inp = pdb.input(source_info=None,lines = lines)
+    xray_structure = pdb_inp.xray_structure_simple()
+    xray_structure.show_summary(prefix="%s "%selection)
+    self.parses += 1
+    if self.cache_dir is not None:
+      if not os.path.isdir(self.cache_dir):
+        try: os.makedirs(self.cache_dir)
+        except OSError: pass # another rank got there first
+      tmp = "%s.%d.tmp"%(self._disk_path(key), os.getpid())
+      with open(tmp, "wb") as F:
+        pickle.dump(xray_structure, F, pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp, self._disk_path(key))
+    return xray_structure
+
+  def xray_structure(self, pdb_text, selection="all", selector=None):
+    """Copy of the structure parsed from selector(pdb_text) (the whole text if selector is None);
+    selection names the selector, and with the text digest keys the cache"""
+    key = (text_digest(pdb_text), selection)
+    if key not in self.structures:
+      self.structures[key] = self._parse(pdb_text, selection, selector)
+    return self.structures[key].deep_copy_scatterers()
+
+registry = structure_registry(cache_dir=os.environ.get("STRUCTURE_REGISTRY"))
@@ -90,13 +90,9 @@ class gen_fmodel(object):
     xray_structure.show_summary(prefix="Input structure ")
     #
     # take a detour to insist on calculating anomalous contribution of every atom
-    scatterers = xray_structure.scatterers()
-    from cctbx.eltbx import sasaki, henke
-    for sc in scatterers:
-      #expected_sasaki = sasaki.table(sc.element_symbol()).at_angstrom(wavelength)
-      expected_henke = henke.table(sc.element_symbol()).at_angstrom(wavelength)
-      sc.fp = expected_henke.fp()
-      sc.fdp = expected_henke.fdp()
+    from LS49.sim.scattering_factors import henke_service
+    self.xray_structure = xray_structure
+    henke_service.apply(xray_structure, wavelength, self.get_scatterer_groups())
 
     import mmtbx.command_line.fmodel
     phil2 = mmtbx.command_line.fmodel.fmodel_from_xray_structure_master_params
@@ -117,17 +113,32 @@ class gen_fmodel(object):
     P1_primitive_xray_structure.show_summary(prefix="P1 structure ")
     self.cb_op_C2_to_P = self.xray_structure.change_of_basis_op_to_primitive_setting()
     self.xray_structure = P1_primitive_xray_structure
+    self.invalidate_bulk_solvent()
+    self.scatterer_groups = {}
   def set_k_sol(self,newvalue):  self.params2.fmodel.k_sol = newvalue
+  def get_scatterer_groups(self,label_has=None):
+    """Element (label_has=None) or label selections, cached until the structure is replaced"""
+    from LS49.sim.scattering_factors import element_groups, label_groups
+    if getattr(self, "scatterer_groups", None) is None: self.scatterer_groups = {}
+    if label_has not in self.scatterer_groups:
+      if label_has is None:
+        self.scatterer_groups[None] = element_groups(self.xray_structure)
+      else:
+        self.scatterer_groups[label_has] = label_groups(self.xray_structure,[label_has])[label_has]
+    return self.scatterer_groups[label_has]
   def reset_wavelength(self,newvalue):
-    scatterers = self.xray_structure.scatterers()
-    for sc in scatterers:
-      from cctbx.eltbx import sasaki, henke
-      #expected_sasaki = sasaki.table(sc.element_symbol()).at_angstrom(newvalue)
-      expected_henke = henke.table(sc.element_symbol()).at_angstrom(newvalue)
-      sc.fp = expected_henke.fp()
-      sc.fdp = expected_henke.fdp()
+    from LS49.sim.scattering_factors import henke_service
+    henke_service.apply(self.xray_structure, newvalue, self.get_scatterer_groups())
   def reset_specific_at_wavelength(self,label_has,tables,newvalue,verbose=False):
     scatterers = self.xray_structure.scatterers()
+    if not verbose:
+      selection = self.get_scatterer_groups(label_has)
+      if len(selection) == 0: return
+      newfp,newfdp = tables.fp_fdp_at_wavelength(angstroms=newvalue)
+      fps = scatterers.extract_fps(); fdps = scatterers.extract_fdps()
+      fps.set_selected(selection, newfp); fdps.set_selected(selection, newfdp)
+      scatterers.set_fps(fps); scatterers.set_fdps(fdps)
+      return
     for sc in scatterers:
       if label_has in sc.label:
         newfp,newfdp = tables.fp_fdp_at_wavelength(angstroms=newvalue)
@@ -156,21 +167,179 @@ class gen_fmodel(object):
       add_sigmas     = False,
       params         = self.params2)
   def get_amplitudes(self):
-    import mmtbx
-    f_model_complex = mmtbx.utils.fmodel_from_xray_structure(
-      xray_structure = self.xray_structure,
-      f_obs          = None,
-      add_sigmas     = False,
-      params         = self.params2).f_model
+    f_model_complex = self.get_f_model_complex()
     f_model_real = abs(f_model_complex)
     f_model_real.set_observation_type_xray_amplitude()
     return f_model_real
   def get_intensities(self):
-    import mmtbx
-    f_model_complex = mmtbx.utils.fmodel_from_xray_structure(
-      xray_structure = self.xray_structure,
-      f_obs          = None,
-      add_sigmas     = False,
-      params         = self.params2).f_model
+    f_model_complex = self.get_f_model_complex()
     f_model_real = f_model_complex.as_intensity_array()
     return f_model_real
+
+  # Bulk-solvent cache.  The mask, f_mask and Miller set depend on the coordinates, ADPs,
+  # occupancies, scattering types, cell, resolution and solvent parameters, but not on f', f''.
+  # With SF_BULK_SOLVENT_CACHE=1 the full mmtbx fmodel runs once per structure_key(); from
+  # f_model = k_total * (f_calc + sum k_mask * f_mask) the overall scale k_total and the mask
+  # term are kept separately, and later calls refresh only f_calc.  At cache time the
+  # decomposition must reproduce the full f_model, else that key is computed in full every
+  # time.  SF_BULK_SOLVENT_CACHE_VALIDATE=1 compares every cached result with the full path.
+  def structure_key(self):
+    import hashlib
+    XS = self.xray_structure
+    P = self.params2
+    H = hashlib.sha256()
+    for array in [XS.sites_frac().as_double(), XS.extract_u_iso_or_u_equiv(), XS.scatterers().extract_occupancies()]:
+      H.update(array.copy_to_byte_str())
+    H.update(str((XS.unit_cell().parameters(), XS.space_group_info().type().hall_symbol(),
+                  [sc.scattering_type for sc in XS.scatterers()],
+                  P.high_resolution, P.low_resolution, P.fmodel.k_sol, P.fmodel.b_sol, P.fmodel.b_cart,
+                  P.structure_factors_accuracy.algorithm,
+                  P.mask.solvent_radius, P.mask.shrink_truncation_radius, P.mask.grid_step_factor)).encode())
+    return H.hexdigest()
+  def invalidate_bulk_solvent(self):
+    """Call after changing the structure in a way structure_key() does not see"""
+    self.bulk_solvent = None
+  def f_calc_on(self, miller_set):
+    sfa = self.params2.structure_factors_accuracy
+    return miller_set.structure_factors_from_scatterers(
+      xray_structure = self.xray_structure,
+      algorithm = sfa.algorithm, cos_sin_table = sfa.cos_sin_table,
+      grid_resolution_factor = sfa.grid_resolution_factor, quality_factor = sfa.quality_factor,
+      u_base = sfa.u_base, b_base = sfa.b_base, wing_cutoff = sfa.wing_cutoff).f_calc()
+  def bulk_solvent_terms(self, f_container):
+    """(k_total, f_mask_term) of the full calculation, or None if f_model is not reproduced"""
+    from scitbx.array_family import flex
+    fmodel = f_container.fmodel
+    f_model = f_container.f_model
+    f_calc = fmodel.f_calc()
+    if tuple(f_calc.indices()) != tuple(f_model.indices()): return None # once per key
+    def data(array): return array.data() if hasattr(array, "data") else array
+    f_mask_term = flex.complex_double(f_calc.size(), 0j)
+    for k_mask, f_mask in zip(fmodel.k_masks(), fmodel.f_masks()):
+      k_mask = data(k_mask)
+      f_mask_term += flex.complex_double(k_mask, flex.double(k_mask.size(), 0.)) * data(f_mask)
+    k_total = data(fmodel.k_isotropic()) * data(fmodel.k_anisotropic())
+    k_total = flex.complex_double(k_total, flex.double(k_total.size(), 0.))
+    rebuilt = k_total * (f_calc.data() + f_mask_term)
+    if flex_max_abs(rebuilt - f_model.data()) > 1.e-6 * flex_max_abs(f_model.data()):
+      return None
+    return k_total, f_mask_term
+  def get_f_model_complex(self):
+    import os
+    if not bool(int(os.environ.get("SF_BULK_SOLVENT_CACHE",0))):
+      return self.get_fmodel().f_model
+    key = self.structure_key()
+    cache = getattr(self, "bulk_solvent", None)
+    if cache is None or cache[0] != key:
+      f_container = self.get_fmodel() # full path: mask, f_mask, Miller set
+      f_model = f_container.f_model
+      terms = self.bulk_solvent_terms(f_container)
+      if terms is None:
+        print("bulk solvent cache: fmodel not reproduced by k_total*(f_calc+f_mask), computing in full")
+      self.bulk_solvent = (key, f_model, terms) # f_model as the Miller set of later calls
+      return f_model
+    if cache[2] is None: return self.get_fmodel().f_model # not decomposable, see bulk_solvent_terms
+    miller_set, (k_total, f_mask_term) = cache[1], cache[2]
+    f_model = miller_set.customized_copy(data=k_total*(self.f_calc_on(miller_set).data()+f_mask_term))
+    if bool(int(os.environ.get("SF_BULK_SOLVENT_CACHE_VALIDATE",0))):
+      full = self.get_fmodel().f_model
+      assert full.indices() == f_model.indices()
+      deviation = flex_max_abs(full.data()-f_model.data()) / flex_max_abs(full.data())
+      assert deviation < 1.e-6, "cached bulk solvent fmodel deviates by %g"%deviation
+    return f_model
+
+class anomalous_linear_fmodel(object):
+  """Fmodel as a linear function of the anomalous scattering factors.
+
+  With coordinates, B factors and the bulk-solvent mask fixed, the complex fmodel is
+  affine in each scatterer's f' + i f'', so
+    F(lambda) = F_ref + sum_g [(f'_g(lambda) - f'_g,ref) + i(f''_g(lambda) - f''_g,ref)] * D_g
+  where group g is either a label passed in label_groups (FE1, FE2) or an element,
+  and D_g = F(f'_g,ref + 1) - F_ref is the geometric sum over the group's sites.
+  Construction costs one fmodel per group plus the reference; after that every
+  channel is complex array arithmetic.  validate() compares to the full calculation.
+  """
+  def __init__(self, fmodel_generator, label_groups=("FE1","FE2")):
+    from scitbx.array_family import flex
+    self.fmodel_generator = fmodel_generator
+    scatterers = fmodel_generator.xray_structure.scatterers()
+    self.groups = {}
+    for i_seq, sc in enumerate(scatterers):
+      key = sc.element_symbol()
+      for label in label_groups:
+        if label in sc.label: key = label
+      self.groups.setdefault(key, flex.size_t()).append(i_seq)
+    self.reference = {}
+    for key in self.groups:
+      values = set((scatterers[i_seq].fp, scatterers[i_seq].fdp) for i_seq in self.groups[key])
+      assert len(values) == 1, "group %s does not share one f', f''"%key
+      self.reference[key] = values.pop()
+    self.f_ref = fmodel_generator.get_f_model_complex()
+    self.basis = {}
+    for key in self.groups:
+      for i_seq in self.groups[key]: scatterers[i_seq].fp += 1.
+      D = fmodel_generator.get_f_model_complex()
+      for i_seq in self.groups[key]: scatterers[i_seq].fp -= 1.
+      assert D.indices() == self.f_ref.indices()
+      self.basis[key] = D.data() - self.f_ref.data()
+
+  def fp_fdp_at_wavelength(self, wavelength_A, tables):
+    """Group f', f'' at a wavelength: tables[label] for labelled groups, Henke otherwise"""
+    from cctbx.eltbx import henke
+    values = {}
+    for key in self.groups:
+      if key in tables:
+        values[key] = tables[key].fp_fdp_at_wavelength(angstroms=wavelength_A)
+      else:
+        expected_henke = henke.table(key).at_angstrom(wavelength_A)
+        values[key] = (expected_henke.fp(), expected_henke.fdp())
+    return values
+
+  def fp_fdp_at_wavelengths(self, wavelengths_A, tables):
+    """fp_fdp_at_wavelength for a list of wavelengths, one batch table query per group"""
+    from LS49.sim.scattering_factors import henke_service
+    columns = {}
+    for key in self.groups:
+      if key in tables:
+        columns[key] = tables[key].fp_fdp_at_wavelengths(wavelengths_A)
+      else:
+        columns[key] = henke_service.fp_fdp(key, wavelengths_A)
+    return [dict([(key, (columns[key][0][i], columns[key][1][i])) for key in columns])
+            for i in range(len(wavelengths_A))]
+
+  def f_model(self, values):
+    data = self.f_ref.data().deep_copy()
+    for key in self.groups:
+      fp, fdp = values[key]
+      fp_ref, fdp_ref = self.reference[key]
+      data += self.basis[key] * complex(fp - fp_ref, fdp - fdp_ref)
+    return self.f_ref.customized_copy(data=data)
+
+  def amplitudes(self, wavelength_A, tables, values=None):
+    """Channel amplitudes; values, if given, are this wavelength's fp_fdp_at_wavelengths entry"""
+    if values is None: values = self.fp_fdp_at_wavelength(wavelength_A, tables)
+    f_model_real = abs(self.f_model(values))
+    f_model_real.set_observation_type_xray_amplitude()
+    return f_model_real
+
+  def validate(self, wavelength_A, tables, tolerance=1.e-5):
+    """Max |F_linear - F_full| relative to max F_full at one wavelength; the structure
+    is returned to its reference f', f'' afterwards"""
+    GF = self.fmodel_generator
+    GF.reset_wavelength(wavelength_A)
+    for label in tables:
+      GF.reset_specific_at_wavelength(label_has=label,tables=tables[label],newvalue=wavelength_A)
+    full = GF.get_amplitudes()
+    scatterers = GF.xray_structure.scatterers()
+    for key in self.groups:
+      for i_seq in self.groups[key]:
+        scatterers[i_seq].fp, scatterers[i_seq].fdp = self.reference[key]
+    linear = self.amplitudes(wavelength_A, tables)
+    assert linear.indices() == full.indices()
+    deviation = flex_max_abs(linear.data() - full.data()) / flex_max_abs(full.data())
+    assert deviation < tolerance, "linear fmodel deviates by %g at %.5f A"%(deviation, wavelength_A)
+    return deviation
+
+def flex_max_abs(data):
+  from scitbx.array_family import flex
+  return flex.max(flex.abs(data))
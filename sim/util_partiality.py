@@ -24,7 +24,14 @@ with (open("sfall_P1_7122_amplitudes.pickle","rb")) as F:
 
 def channel_pixels(ROI,wavelength_A,flux,N,UMAT_nm,Amatrix_rot,fmodel_generator,output):
   energy_dependent_fmodel=False
-  if energy_dependent_fmodel:
+  sf_cache = None
+  if energy_dependent_fmodel: # the cache only serves energy-dependent amplitudes
+    from LS49.sim.sf_channel_cache import channel_cache
+    sf_cache = channel_cache(dict(pdb_lines=pdb_lines,
+      Fe_oxidized_model=Fe_oxidized_model, Fe_reduced_model=Fe_reduced_model))
+  if sf_cache is not None:
+    sfall_channel = sf_cache.amplitudes(fmodel_generator, wavelength_A)
+  elif energy_dependent_fmodel:
     fmodel_generator.reset_wavelength(wavelength_A)
     fmodel_generator.reset_specific_at_wavelength(
                    label_has="FE1",tables=Fe_oxidized_model,newvalue=wavelength_A)
@@ -268,14 +275,18 @@ def run_sim2smv(ROI,prefix,crystal,spectra,rotation,rank,quick=False):
   print(crystal.domains_per_crystal)
   SIM.raw_pixels *= crystal.domains_per_crystal; # must calculate the correct scale!
   output = StringIO() # open("myfile","w")
+  from LS49.sim.channel_accumulator import rank_channel_accumulator
+  accumulator = rank_channel_accumulator()
+  accumulator.begin(SIM)
   for x in range(0,100,2): #len(flux)):
     if flux[x]==0.0:continue
     print("+++++++++++++++++++++++++++++++++++++++ Wavelength",x)
     CH = channel_pixels(ROI,wavlen[x],flux[x],N,UMAT_nm,Amatrix_rot,GF,output)
-    SIM.raw_pixels += CH.raw_pixels * crystal.domains_per_crystal;
-    print(SIM.raw_pixels)
+    accumulator.add(CH.raw_pixels, crystal.domains_per_crystal)
+    if accumulator.mode == "legacy": print(SIM.raw_pixels)
 
     CH.free_all()
+  accumulator.finish()
 
   message = output.getvalue().split()
   miller = (int(message[4]),int(message[5]),int(message[6]))
@@ -60,20 +60,18 @@ class spectra_simulation:
   def __init__(self):
     self.R = get_results()
     self.LF = linear_fit(self.R)
+    # contiguous (events x points) array, so that whole batches of spectra are recast at once
+    self.spectra = np.ascontiguousarray(self.R["spectra"])
     # get some information to help normalize things
-    maxima = []
-    bk_subtracted_sum = []
-    for image in range(len(self.R["energy"])):
-      bk_subtracted_sum.append(np.sum(self.R['spectra'][image]))
-      maxima.append(np.max(self.R['spectra'][image]))
-
-    self.max_of_max = max(maxima)
+    bk_subtracted_sum = np.sum(self.spectra, axis=1)
+    self.max_of_max = np.max(self.spectra)
     average_integrated = np.mean(bk_subtracted_sum)
     print("average_integrated",average_integrated)
     self.bk_subtracted_sum = bk_subtracted_sum
     self.average_integrated = average_integrated
-    self.NS = len(self.R["spectra"][0]) # number of points in each spectrum
-    self.N = len(self.R["spectra"]) # number of events overall
+    self.NS = self.spectra.shape[1] # number of points in each spectrum
+    self.N = self.spectra.shape[0] # number of events overall
+    self._average_expected_energy = None
 
   def plot_input_images(self,nlimit,axis="idx"):  #axis is either channel number (idx) or calibrated energy (energy)
     import matplotlib.pyplot as plt
@@ -129,57 +127,55 @@ class spectra_simulation:
         self.bk_subtracted_sum[image]/self.average_integrated))
       yield offset_energy,self.R['spectra'][image],self.bk_subtracted_sum[image]/self.average_integrated
 
-  def generate_recast_renormalized_images(self, nlimit, energy, total_flux):
+  def recast_renormalized_batch(self, images, energy, total_flux):
+    """Recast any batch of events into 100 1-eV channels centered on energy, in one pass.
+    Returns contiguous numpy arrays: channel wavelengths (100,), channel fluxes
+    (len(images),100) renormalized to total_flux for an average pulse, and the mean
+    wavelength of each event (len(images),).  Binning and summation order are the
+    same as the original per-sample loop, so the fluxes agree with it exactly."""
+    images = np.atleast_1d(np.asarray(images, dtype=np.int64))
+    n_images = len(images)
     spectrum_fitted_energy = self.LF.m * np.array(range(self.NS)) + self.LF.c
     offset = energy - self.get_average_expected_energy()
     offset_energy = spectrum_fitted_energy + offset
-    for image in range(min(nlimit, self.N)):
 
-      from scitbx.array_family import flex
-      y = flex.double(list(self.R['spectra'][image]))
-      ysum = self.bk_subtracted_sum[image]
+    channel = np.trunc(offset_energy - (energy-50)).astype(np.int64) # truncation as in int()
+    in_range = (channel >= 0) & (channel < 100)
+    weights = self.spectra[images][:,in_range].astype(np.float64) * total_flux / self.average_integrated
+    bins = (np.arange(n_images, dtype=np.int64)[:,np.newaxis] * 100 + channel[in_range]).ravel()
+    channel_flux = np.bincount(bins, weights=weights.ravel(), minlength=100*n_images
+                              ).reshape((n_images,100))
 
-      expected_energy = self.LF.m * self.R["expidx"][image] + self.LF.c + offset
-      print(image,"ebeam = %7.2f eV"%(expected_energy),"%5.1f%% of average pulse intensity"%(100.*
-        self.bk_subtracted_sum[image]/self.average_integrated))
-      assert expected_energy > 0.
-      channel_flux = flex.double(100) # 100 energy channels altogether
-      channel_mean_eV = flex.double(range(100)) + energy - 49.5
-      eV_to_angstrom = 12398.425
-      channel_wavelength = eV_to_angstrom / channel_mean_eV
-      for idx in range(len(offset_energy)):
-        i_energy = offset_energy[idx]
-        channel = int(i_energy - (energy-50))
-        if 0 <= channel < 100:
-          channel_flux[channel] += self.R['spectra'][image][idx] * total_flux / self.average_integrated
-      yield channel_wavelength,channel_flux,eV_to_angstrom / expected_energy
+    eV_to_angstrom = 12398.425
+    channel_mean_eV = np.array(range(100), dtype=np.float64) + energy - 49.5
+    channel_wavelength = eV_to_angstrom / channel_mean_eV
+    expected_energy = self.LF.m * np.asarray(self.R["expidx"])[images] + self.LF.c + offset
+    return channel_wavelength, channel_flux, eV_to_angstrom / expected_energy
 
-  def generate_recast_renormalized_image(self, image, energy, total_flux):
-    spectrum_fitted_energy = self.LF.m * np.array(range(self.NS)) + self.LF.c
-    offset = energy - self.get_average_expected_energy()
-    offset_energy = spectrum_fitted_energy + offset
+  def _recast_report(self, image, wavelength_A):
+    print(image,"ebeam = %7.2f eV"%(12398.425/wavelength_A),"%5.1f%% of average pulse intensity"%(100.*
+      self.bk_subtracted_sum[image]/self.average_integrated))
 
+  def generate_recast_renormalized_images(self, nlimit, energy, total_flux):
     from scitbx.array_family import flex
-    y = flex.double(list(self.R['spectra'][image]))
-    ysum = self.bk_subtracted_sum[image]
-
-    expected_energy = self.LF.m * self.R["expidx"][image] + self.LF.c + offset
-    print(image,"ebeam = %7.2f eV"%(expected_energy),"%5.1f%% of average pulse intensity"%(100.*
-        self.bk_subtracted_sum[image]/self.average_integrated))
+    images = range(min(nlimit, self.N))
+    channel_wavelength, channel_flux, mean_wavelength = self.recast_renormalized_batch(
+      images, energy, total_flux)
+    for ii,image in enumerate(images):
+      self._recast_report(image, mean_wavelength[ii])
+      assert mean_wavelength[ii] > 0.
+      yield flex.double(channel_wavelength),flex.double(channel_flux[ii]),float(mean_wavelength[ii])
 
-    channel_flux = flex.double(100) # 100 energy channels altogether
-    channel_mean_eV = flex.double(range(100)) + energy - 49.5
-    eV_to_angstrom = 12398.425
-    channel_wavelength = eV_to_angstrom / channel_mean_eV
-    for idx in range(len(offset_energy)):
-        i_energy = offset_energy[idx]
-        channel = int(i_energy - (energy-50))
-        if 0 <= channel < 100:
-          channel_flux[channel] += self.R['spectra'][image][idx] * total_flux / self.average_integrated
-    yield channel_wavelength,channel_flux,eV_to_angstrom / expected_energy
+  def generate_recast_renormalized_image(self, image, energy, total_flux):
+    from scitbx.array_family import flex
+    channel_wavelength, channel_flux, mean_wavelength = self.recast_renormalized_batch(
+      [image], energy, total_flux)
+    self._recast_report(image, mean_wavelength[0])
+    yield flex.double(channel_wavelength),flex.double(channel_flux[0]),float(mean_wavelength[0])
 
 
   def get_average_expected_energy(self):
+    if self._average_expected_energy is not None: return self._average_expected_energy
     idx = np.array(self.LF.x)
     fitted_energy = self.LF.m * idx + self.LF.c
     #return np.mean(fitted_energy)
@@ -187,7 +183,8 @@ class spectra_simulation:
     idx_c = flex.double(self.LF.x)
     fitted_energy_c = float(self.LF.m) * idx_c + float(self.LF.c)
     print ("numpy",np.mean(fitted_energy), "flex",flex.mean(fitted_energy_c))
-    return flex.mean(fitted_energy_c)
+    self._average_expected_energy = flex.mean(fitted_energy_c)
+    return self._average_expected_energy
 
 if __name__=="__main__":
   SS = spectra_simulation()
@@ -0,0 +1,109 @@
+from __future__ import division, print_function
+import json
+import os
+import numpy as np
+
+"""Precomputed, memory-mapped store of recast spectra.
+
+The batch drivers used to pickle and broadcast the whole spectra_simulation object
+(the spectra209 pickle plus the linear fit) to every rank, after which every rank
+re-binned the spectrum of each image.  build_spectra_store() does the recast once,
+offline, and writes a single file:
+
+  8-byte magic, uint64 header length, JSON header (calibration and layout), then
+  float64 channel fluxes (N_images x 100) and float64 mean wavelengths (N_images)
+
+so the fluxes are those of spectra_simulation bit for bit (stores written with float32
+fluxes, flux_dtype "<f4" in the header, are still read).
+
+spectra_store memory-maps that file, so opening it costs O(1) per rank, nothing needs
+to be broadcast, and the per-image lookup is a row slice.  It has the same
+generate_recast_renormalized_image() interface as spectra_simulation.
+
+Usage: libtbx.python spectra_store.py <output file> [energy] [total_flux]
+"""
+
+MAGIC = b"LS49SPEC"
+ALIGN = 64
+
+def build_spectra_store(filename, energy=7120., total_flux=1e12, chunk=10000, SS=None,
+                        N_images=None):
+  """Recast the first N_images (default all) events of SS into filename"""
+  if SS is None:
+    from LS49.spectra.generate_spectra import spectra_simulation
+    SS = spectra_simulation()
+  N = SS.N if N_images is None else min(N_images, SS.N)
+  mean_wavelength = np.zeros((N,), dtype=np.float64)
+  header = dict(N_images=N, n_channels=100, energy=energy, total_flux=total_flux, flux_dtype="<f8",
+                calibration=dict(m=float(SS.LF.m), c=float(SS.LF.c),
+                                 average_expected_energy=float(SS.get_average_expected_energy()),
+                                 average_integrated=float(SS.average_integrated)))
+  # the channel axis is the same for every image
+  header["channel_wavelength"] = list(SS.recast_renormalized_batch([0], energy, total_flux)[0])
+  header_bytes = json.dumps(header).encode()
+  data_offset = len(MAGIC) + 8 + len(header_bytes)
+  padding = (-data_offset) % ALIGN
+  tmp = "%s.%d.tmp"%(filename, os.getpid())
+  with open(tmp, "wb") as F:
+    F.write(MAGIC)
+    F.write(np.array([len(header_bytes) + padding], dtype="<u8").tobytes())
+    F.write(header_bytes + b" "*padding)
+    for start in range(0, N, chunk):
+      images = range(start, min(N, start+chunk))
+      _, flux, wavelengths = SS.recast_renormalized_batch(images, energy, total_flux)
+      F.write(np.ascontiguousarray(flux, dtype="<f8").tobytes())
+      mean_wavelength[start:start+len(images)] = wavelengths
+    F.write(mean_wavelength.astype("<f8").tobytes())
+  os.rename(tmp, filename)
+  return filename
+
+class spectra_store(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self._open()
+
+  def _open(self):
+    with open(self.filename, "rb") as F:
+      assert F.read(len(MAGIC)) == MAGIC, "not a spectra store: %s"%self.filename
+      header_length = int(np.frombuffer(F.read(8), dtype="<u8")[0])
+      header = json.loads(F.read(header_length).decode())
+    self.N = header["N_images"]
+    self.n_channels = header["n_channels"]
+    self.energy = header["energy"]
+    self.total_flux = header["total_flux"]
+    self.calibration = header["calibration"]
+    self.channel_wavelength = np.array(header["channel_wavelength"], dtype=np.float64)
+    offset = len(MAGIC) + 8 + header_length
+    flux_dtype = np.dtype(str(header.get("flux_dtype", "<f4")))
+    self.flux = np.memmap(self.filename, dtype=flux_dtype, mode="r", offset=offset,
+                          shape=(self.N, self.n_channels))
+    offset += flux_dtype.itemsize * self.N * self.n_channels
+    self.mean_wavelength = np.memmap(self.filename, dtype="<f8", mode="r", offset=offset,
+                                     shape=(self.N,))
+
+  # pickle only the file name, so that a broadcast (if any) carries no payload
+  def __getstate__(self):
+    return dict(filename=self.filename)
+  def __setstate__(self, state):
+    self.filename = state["filename"]
+    self._open()
+
+  def channel_fluxes(self, image):
+    return self.flux[image]
+
+  def generate_recast_renormalized_image(self, image, energy, total_flux):
+    assert energy == self.energy and total_flux == self.total_flux, \
+      "spectra store was built for %.1f eV, %g photons"%(self.energy, self.total_flux)
+    from scitbx.array_family import flex
+    yield (flex.double(self.channel_wavelength),
+           flex.double(self.flux[image].astype(np.float64)),
+           float(self.mean_wavelength[image]))
+
+if __name__=="__main__":
+  import sys
+  filename = sys.argv[1]
+  energy = float(sys.argv[2]) if len(sys.argv)>2 else 7120.
+  total_flux = float(sys.argv[3]) if len(sys.argv)>3 else 1e12
+  build_spectra_store(filename, energy=energy, total_flux=total_flux)
+  S = spectra_store(filename)
+  print("Wrote %d images x %d channels to %s"%(S.N, S.n_channels, filename))
@@ -0,0 +1,75 @@
+from __future__ import division, print_function
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+
+from LS49.utils.async_writer import async_image_writer, default_spool_dir
+
+def spool(writer, directory, name, content):
+  spooled = writer.spool_name(os.path.join(directory, name))
+  with open(spooled, "wb") as F: F.write(content)
+  return spooled
+
+def tst_spool_dir():
+  if os.path.isdir("/dev/shm"): assert default_spool_dir() == "/dev/shm"
+  writer = async_image_writer(depth=1)
+  assert os.path.dirname(writer.spool_name("/some/dir/image_000001.img")) == default_spool_dir()
+  writer.close()
+
+def tst_bounded_queue_and_order():
+  directory = tempfile.mkdtemp()
+  spool_dir = tempfile.mkdtemp()
+  try:
+    writer = async_image_writer(depth=1, spool_dir=spool_dir)
+    written = [] # (name, final paths), in the order of the callbacks
+    started = threading.Event(); release = threading.Event()
+    def on_written(name):
+      def callback(paths):
+        if name == "image_000000.img":
+          started.set()
+          release.wait() # hold the writer thread on the first image
+        written.append((name, paths))
+      return callback
+    names = ["image_%06d.img"%i for i in range(3)]
+    contents = [(b"header %d\n"%i) + os.urandom(1000) for i in range(3)]
+    spooled = [spool(writer, spool_dir, name, content) for name, content in zip(names, contents)]
+    writer.submit(spooled[0], os.path.join(directory, names[0]), on_written(names[0]))
+    started.wait()
+    writer.submit(spooled[1], os.path.join(directory, names[1]), on_written(names[1])) # fills the queue
+    # the queue holds one image, so the third submit blocks until the writer moves on
+    third = threading.Thread(target=writer.submit,
+      args=(spooled[2], os.path.join(directory, names[2]), on_written(names[2])))
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+    release.set()
+    third.join()
+    writer.close()
+    assert writer.n_written == 3 and writer.wait_time > 0.
+    assert [name for name, paths in written] == names
+    for (name, paths), content in zip(written, contents):
+      assert paths == [os.path.join(directory, name + ".gz")]
+      with gzip.open(paths[0], "rb") as G: assert G.read() == content
+    assert os.listdir(spool_dir) == [] # spooled files are removed once written
+  finally:
+    shutil.rmtree(directory); shutil.rmtree(spool_dir)
+
+def tst_failed_write():
+  directory = tempfile.mkdtemp()
+  try:
+    writer = async_image_writer(depth=2, spool_dir=directory)
+    writer.submit(os.path.join(directory, "missing.img"), os.path.join(directory, "image.img"))
+    try: writer.flush()
+    except RuntimeError: pass
+    else: raise AssertionError("expected the failed write to be reported")
+    assert not os.path.exists(os.path.join(directory, "image.img.gz"))
+  finally:
+    shutil.rmtree(directory)
+
+if __name__=="__main__":
+  tst_spool_dir()
+  tst_bounded_queue_and_order()
+  tst_failed_write()
+  print("OK")
@@ -0,0 +1,58 @@
+from __future__ import division, print_function
+from scitbx.array_family import flex
+
+from LS49.sim.background_template import background_templates
+from LS49.sim.step5_pad import add_water_and_air_background
+
+def small_simulator(wavelength_A):
+  from simtbx.nanoBragg import nanoBragg
+  SIM = nanoBragg(detpixels_slowfast=(64,64), pixel_size_mm=0.11, Ncells_abc=(1,1,1),
+                  wavelength_A=wavelength_A, verbose=0)
+  SIM.distance_mm = 141.7
+  return SIM
+
+def direct_background(SIM, bragg):
+  SIM.raw_pixels = bragg.deep_copy()
+  add_water_and_air_background(SIM)
+  return SIM.raw_pixels.deep_copy()
+
+def tst_template_reuse():
+  mt = flex.mersenne_twister(seed=0)
+  templates = background_templates(bin_width_A=0., validate=True)
+  for wavelength_A in [1.74, 1.75, 1.74]: # miss, miss, hit
+    SIM = small_simulator(wavelength_A)
+    bragg = mt.random_double(64*64) * 100.
+    bragg.reshape(flex.grid(SIM.raw_pixels.focus()))
+    direct = direct_background(SIM, bragg)
+    SIM.raw_pixels = bragg.deep_copy()
+    templates.add_background(SIM, add_water_and_air_background, recipe="tst")
+    assert SIM.wavelength_A == wavelength_A
+    assert flex.max(direct - bragg) > 0.
+    scale = flex.max(direct) # summation order differs, so compare relative to the pixel values
+    assert flex.max(flex.abs(SIM.raw_pixels - direct)) < 1.e-10 * scale
+    # validation reran the direct calculation and found the same background
+    assert templates.validation[-1][1] < 1.e-10 * scale
+  assert (templates.hits, templates.misses) == (1, 2)
+  # a different flux scales the template
+  SIM.raw_pixels = bragg.deep_copy()
+  templates.validate = False
+  templates.add_background(SIM, add_water_and_air_background, recipe="tst", flux=2.e12)
+  assert flex.max(flex.abs(SIM.raw_pixels - (2.*direct - bragg))) < 1.e-10 * scale
+
+def tst_hit_restores_state():
+  from LS49.sim.background_template import STATE
+  templates = background_templates(bin_width_A=0.)
+  states = []
+  for i in range(2): # miss, then hit on a fresh simulator
+    SIM = small_simulator(1.74)
+    templates.add_background(SIM, add_water_and_air_background, recipe="tst")
+    states.append([(name, getattr(SIM, name)) for name in STATE] + [("fluence", SIM.fluence)])
+  assert (templates.hits, templates.misses) == (1, 1)
+  for (name, miss), (_, hit) in zip(*states):
+    if name == "Fbg_vs_stol": assert list(hit) == list(miss), name
+    else: assert hit == miss, name
+
+if __name__=="__main__":
+  tst_template_reuse()
+  tst_hit_restores_state()
+  print("OK")
@@ -0,0 +1,54 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from LS49.adse13_187 import case_data
+
+def synthetic_case(N):
+  from dxtbx.model import Crystal
+  from dxtbx.model.beam import BeamFactory
+  from dxtbx.model.detector import DetectorFactory
+  detector = DetectorFactory.simple(sensor="PAD", distance=100., beam_centre=(1.,0.5),
+    fast_direction="+x", slow_direction="-y", pixel_size=(0.1,0.1), image_size=(20,10))
+  beam = BeamFactory.simple(wavelength=1.74)
+  crystal = Crystal((67.2+N,0.,0.), (0.,60.1,0.), (0.,0.,48.5), space_group_symbol="P1")
+  energies = np.arange(7070., 7170., 0.25)
+  weights = np.exp(-0.5*((energies - 7120. - N)/8.)**2) * 1.e3
+  return case_data.case(N, detector, beam, crystal, energies, weights)
+
+def tst_cache_round_trip():
+  from simtbx.nanoBragg import utils
+  from_experiment = case_data.case_from_experiment
+  case_data.case_from_experiment = synthetic_case # no run795 data needed
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, "case_data.cache")
+    case_data.build_case_cache(path, events=[0, 1])
+    os.environ["CASE_DATA_CACHE"] = path
+    case_data._cache[:] = []
+    for N in [0, 1]:
+      direct = synthetic_case(N)
+      cached = case_data.retrieve_case(N)
+      assert cached.downsampled is not None # served from the file
+      assert cached.detector.to_dict() == direct.detector.to_dict()
+      assert cached.beam.to_dict() == direct.beam.to_dict()
+      assert cached.crystal.to_dict() == direct.crystal.to_dict()
+      assert np.all(np.asarray(cached.energies_raw) == direct.energies_raw)
+      assert np.all(np.asarray(cached.weights_raw) == direct.weights_raw)
+      energies, weights = utils.downsample_spectrum(direct.energies_raw, direct.weights_raw,
+                                                    **case_data.DOWNSAMPLE)
+      cached_energies, cached_weights = cached.downsample_spectrum(**case_data.DOWNSAMPLE)
+      assert np.allclose(cached_energies, energies) and np.allclose(cached_weights, weights)
+    # events missing from the file come from the experiment list
+    assert case_data.retrieve_case(2).downsampled is None
+  finally:
+    case_data.case_from_experiment = from_experiment
+    os.environ.pop("CASE_DATA_CACHE")
+    case_data._cache[:] = []
+    shutil.rmtree(directory)
+
+if __name__=="__main__":
+  tst_cache_round_trip()
+  print("OK")
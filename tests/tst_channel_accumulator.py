@@ -0,0 +1,42 @@
+from __future__ import division, print_function
+from scitbx.array_family import flex
+
+from LS49.sim.channel_accumulator import channel_accumulator, max_deviation
+
+class fake_simulator(object):
+  def __init__(self, focus):
+    self.raw_pixels = flex.double(flex.grid(focus), 0.)
+
+def tst_accumulation_modes():
+  focus = (64,48)
+  mt = flex.mersenne_twister(seed=0)
+  channels = []
+  for x in range(100):
+    pixels = mt.random_double(focus[0]*focus[1]) * 1.e3
+    pixels.reshape(flex.grid(focus))
+    channels.append(pixels)
+  factor = 64.e9/125.
+
+  results = {}
+  for mode, validate in [("legacy", True), ("inplace", True), ("float32", True), ("float32", False)]:
+    accumulator = channel_accumulator(mode=mode, validate=validate)
+    accumulator.block = 1000 # float32: several conversion blocks, the last one partial
+    for image in range(2): # buffers are reused from image to image
+      SIM = fake_simulator(focus)
+      accumulator.begin(SIM)
+      for pixels in channels: accumulator.add(pixels, factor)
+      accumulator.finish()
+    results[(mode, validate)] = SIM.raw_pixels
+
+  legacy = results[("legacy", True)]
+  max_abs, max_rel = max_deviation(legacy, results[("inplace", True)])
+  assert max_rel < 1.e-13
+  max_abs, max_rel = max_deviation(legacy, results[("float32", True)])
+  assert max_rel < 1.e-6 # compensated: one float32 rounding of the final sum
+  # without validation the float32 sum is added to the image block by block
+  max_abs, max_rel = max_deviation(results[("float32", True)], results[("float32", False)])
+  assert max_abs == 0.
+
+if __name__=="__main__":
+  tst_accumulation_modes()
+  print("OK")
@@ -0,0 +1,28 @@
+from __future__ import division, print_function
+from scitbx.array_family import flex
+
+from LS49.sim.channel_parallel import channel_pool, split_channels
+
+class fake_channel(object):
+  def __init__(self, x):
+    self.raw_pixels = flex.double(flex.grid((30,20)), float(x+1))
+  def free_all(self): self.raw_pixels = None
+
+def tst_channel_pool():
+  chunks = split_channels(range(100), 7)
+  assert [x for chunk in chunks for x in chunk] == list(range(100))
+  assert max([len(c) for c in chunks]) - min([len(c) for c in chunks]) <= 1
+  expected = 2. * sum(range(1,101))
+  import omptbx
+  threads = omptbx.omp_get_max_threads()
+  for workers in [1, 4]:
+    pool = channel_pool(workers=workers, threads=1)
+    image = pool.sum_channels(fake_channel, range(100), factor=2.)
+    assert image.focus() == (30,20)
+    assert flex.min(image) == flex.max(image) == expected
+    # the worker thread count never leaks into the calling process
+    assert omptbx.omp_get_max_threads() == threads
+
+if __name__=="__main__":
+  tst_channel_pool()
+  print("OK")
@@ -0,0 +1,79 @@
+from __future__ import division, print_function
+import math
+import scitbx
+from scitbx.array_family import flex
+from scitbx.matrix import sqr, col
+
+from LS49.sim import step5_pad
+from LS49.sim.channel_simulator import MultiChannelSession
+
+def small_setup(n_domains=25):
+  from cctbx import crystal, miller
+  symmetry = crystal.symmetry((150.,140.,130.,90.,95.,90.), "P1")
+  millers = miller.build_set(symmetry, anomalous_flag=True, d_min=8.)
+  mt = flex.mersenne_twister(seed=0)
+  amplitudes = millers.array(data=mt.random_double(millers.size()) * 1.e3 + 10.)
+  scitbx.random.set_random_seed(1234)
+  rand_norm = scitbx.random.normal_distribution(mean=0, sigma=0.05 * math.pi/180.)
+  UMAT_nm = flex.mat3_double()
+  for m in scitbx.random.variate(rand_norm)(n_domains):
+    site = col(mt.random_double_point_on_sphere())
+    UMAT_nm.append(site.axis_and_angle_as_r3_rotation_matrix(m, deg=False))
+  orientations = [sqr(mt.random_double_r3_rotation_matrix()) for i in range(2)]
+  Amatrices = [(rotation * sqr(symmetry.unit_cell().orthogonalization_matrix())).transpose()
+               for rotation in orientations]
+  return amplitudes, UMAT_nm, Amatrices
+
+def tst_session_matches_channel_loop():
+  detpixels = (128, 128)
+  N = 5
+  amplitudes, UMAT_nm, Amatrices = small_setup()
+  wavlen = [12398.425/energy for energy in [7100., 7120., 7140.]]
+  flux = [1.e11, 3.e11, 2.e11]
+  session = MultiChannelSession(N, UMAT_nm, detpixels_slowfast=detpixels, algo="NKS")
+  for Amatrix_rot in Amatrices: # the session is reused for the second image
+    reference = flex.double(flex.grid(detpixels))
+    for x in range(len(flux)):
+      CH = step5_pad.channel_pixels(wavlen[x], flux[x], N, UMAT_nm, Amatrix_rot, None, None, 0,
+                                    sfall_channel=amplitudes, detpixels_slowfast=detpixels)
+      reference += CH.raw_pixels
+      CH.free_all()
+    session.begin_image(Amatrix_rot)
+    for x in range(len(flux)):
+      session.add_channel(wavlen[x], flux[x], amplitudes)
+    image = session.end_image()
+    assert image.focus() == reference.focus()
+    scale = flex.max(reference)
+    assert scale > 0.
+    assert flex.max(flex.abs(image - reference)) <= 1.e-10 * scale
+    assert session.image_stats["n_channels"] == len(flux)
+    assert session.image_stats["allocations"] == 0 # the session's buffer is zeroed in place
+  session.free_all()
+
+def tst_session_follows_crystal():
+  from LS49.sim import channel_simulator
+  built = []
+  class fake_session:
+    def __init__(self, N, UMAT_nm, algo):
+      self.freed = False
+      built.append(self)
+    def free_all(self): self.freed = True
+  real_session = channel_simulator.MultiChannelSession
+  channel_simulator.MultiChannelSession = fake_session
+  try:
+    amplitudes, UMAT_nm, Amatrices = small_setup(n_domains=4)
+    first = step5_pad.get_channel_session(5, UMAT_nm)
+    assert step5_pad.get_channel_session(5, UMAT_nm) is first
+    other_N = step5_pad.get_channel_session(6, UMAT_nm)
+    assert first.freed and other_N is not first
+    fewer_blocks = step5_pad.get_channel_session(6, UMAT_nm[:2])
+    assert other_N.freed and fewer_blocks is not other_N and len(built) == 3
+  finally:
+    channel_simulator.MultiChannelSession = real_session
+    step5_pad.channel_session_singleton = None
+    step5_pad.channel_session_key = None
+
+if __name__=="__main__":
+  tst_session_matches_channel_loop()
+  tst_session_follows_crystal()
+  print("OK")
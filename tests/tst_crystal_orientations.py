@@ -22,6 +22,52 @@ def model(create):
       for x in range(len(random_orientations)):
         assert approx_equal(random_orientations[x], ori_ref[x])
 
+def indexed_table():
+  import tempfile, shutil
+  from LS49 import legacy_random_orientations
+  from LS49.sim.random_orientations import build_legacy_table, orientation_table, counter_orientations
+  N_test = 1000
+  legacy = legacy_random_orientations(N_test)
+  tmpdir = tempfile.mkdtemp()
+  try:
+    table = orientation_table(build_legacy_table(os.path.join(tmpdir,"ori.npy"), N_test))
+    assert len(table) == N_test
+    for x in [0, 1, 500, N_test-1]:
+      assert table[x] == tuple(legacy[x]) # bit for bit
+  finally:
+    shutil.rmtree(tmpdir)
+  # counter-based orientations are proper rotations, addressable in any order
+  from scitbx.matrix import sqr
+  C = counter_orientations(100000, seed=0)
+  assert len(C) == 100000
+  for x in [99999, 3, 0]:
+    R = sqr(C[x])
+    assert approx_equal(R.determinant(), 1.)
+    assert approx_equal(R * R.transpose(), sqr((1,0,0,0,1,0,0,0,1)))
+    assert C[x] == counter_orientations(100000, seed=0)[x]
+  assert C[3] != counter_orientations(100000, seed=1)[3]
+  try: C[100000]
+  except IndexError: pass
+  else: raise AssertionError("expected IndexError beyond N_total")
+  from LS49.sim.random_orientations import uniform_deviates_to_matrix
+  assert tuple(uniform_deviates_to_matrix(C.deviates(3))[0]) == C[3]
+
+def driver_selection():
+  from LS49.sim.random_orientations import random_orientations, uses_indexed_orientations
+  saved = dict((key, os.environ.pop(key)) for key in ["ORIENTATION_TABLE", "ORIENTATION_SEED"]
+               if key in os.environ)
+  try:
+    assert not uses_indexed_orientations()
+    os.environ["ORIENTATION_SEED"] = "1"
+    assert uses_indexed_orientations()
+    R = random_orientations(1000)
+    assert len(R) == 1000 and R.seed == 1
+  finally:
+    os.environ.pop("ORIENTATION_SEED", None)
+    os.environ.update(saved)
+
 if __name__=="__main__":
   model(create=False)
+  indexed_table()
+  driver_selection()
   print("OK")
@@ -0,0 +1,75 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from LS49.adse13_187.event_container import event_container
+
+def small_geometry():
+  from dxtbx.model.detector import DetectorFactory
+  from dxtbx.model.beam import BeamFactory
+  detector = DetectorFactory.simple(sensor="PAD", distance=100., beam_centre=(1.,0.5),
+    fast_direction="+x", slow_direction="-y", pixel_size=(0.1,0.1), image_size=(20,10))
+  beam = BeamFactory.simple(wavelength=1.74)
+  return detector.to_dict(), beam.to_dict()
+
+def tst_round_trip():
+  from LS49.adse13_187.FormatHDF5AttributeGeometry import FormatHDF5AttributeGeometry
+  detector, beam = small_geometry()
+  rng = np.random.RandomState(0)
+  events = {} # i_exp -> (frames, energies, weights)
+  events[795] = ([(name, rng.random_sample((1,10,20))) for name in ["ratio", "exascale"]],
+                 np.array([7100., 7101.5, 7103.]), np.array([1., 2., 1.]))
+  events[796] = ([(name, rng.random_sample((1,10,20))) for name in ["exascale", "vintage"]],
+                 np.array([7110., 7111.5, 7113., 7114.5, 7116.]), np.array([1., 3., 5., 3., 1.]))
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "events_00000.h5")
+    for i_exp in [795, 796]:
+      # reopened for each event, as after a restart; the second, longer spectrum
+      # widens the spectrum datasets along axis 1
+      container = event_container(filename, compression="gzip")
+      assert not container.has(i_exp)
+      frames, energies, weights = events[i_exp]
+      container.add_event(i_exp, frames, detector=detector, beam=beam,
+        energies=energies, weights=weights,
+        parameters=dict(Ncells_abc=(30,30,10), spot_scale=float(i_exp)))
+      container.close()
+    container = event_container(filename)
+    assert len(container) == 2 and container.has(795) and container.has(796)
+    assert container.handle["events/spectrum_energies"].shape == (2,5)
+    assert list(container.handle["events/spectrum_energies"][0]) == [7100., 7101.5, 7103., 0., 0.]
+    assert list(container.handle["event_row"][:]) == [0,0,1,1]
+    assert list(container.handle["events/spot_scale"][:]) == [795., 796.]
+    frames, energies, weights = events[795]
+    try: container.add_event(795, frames, detector=detector, beam=beam,
+                             energies=energies, weights=weights)
+    except AssertionError: pass
+    else: raise AssertionError("expected the second copy of event 795 to be refused")
+    assert len(container) == 2 and container.handle["images"].shape[0] == 4
+    container.close()
+
+    F = FormatHDF5AttributeGeometry(filename)
+    assert F.get_num_images() == 4
+    index = 0
+    for i_exp in [795, 796]:
+      frames, energies, weights = events[i_exp]
+      for name, data in frames:
+        assert F.get_event_index(index) == i_exp
+        assert F.get_frame_name(index) == name
+        pixels = F.get_raw_data(index)[0].as_numpy_array()
+        assert np.allclose(pixels, data[0].astype(np.float32))
+        beam_i = F.get_beam(index)
+        mean_energy = (weights*energies).sum() / weights.sum()
+        assert abs(beam_i.get_wavelength() - 12398.419739640716/mean_energy) < 1.e-10
+        if F.HAS_SPECTRUM_BEAM: # only the valid channels of the zero-padded row
+          assert np.allclose(beam_i.get_spectrum_energies().as_numpy_array(), energies)
+          assert np.allclose(beam_i.get_spectrum_weights().as_numpy_array(), weights)
+        index += 1
+  finally:
+    shutil.rmtree(directory)
+
+if __name__=="__main__":
+  tst_round_trip()
+  print("OK")
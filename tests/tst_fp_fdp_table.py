@@ -0,0 +1,59 @@
+from __future__ import division, print_function
+import os
+from libtbx.math_utils import round2
+from libtbx.test_utils import approx_equal
+
+from LS49 import ls49_big_data
+from LS49.sim.fdp_plot import george_sherrell
+
+def legacy_fp_fdp_at_wavelength(GS,angstroms):
+  lookup_energy = round2(12398.425/angstroms,0)
+  lookup_idx = list(GS.energy).index(lookup_energy)
+  return GS.fp[lookup_idx], GS.fdp[lookup_idx]
+
+def tst_indexed_lookup():
+  for filename in ["pf-rd-ox_fftkk.out", "pf-rd-red_fftkk.out"]:
+    GS = george_sherrell(os.path.join(ls49_big_data,"data_sherrell",filename))
+    # the 100 channel wavelengths of the simulation
+    wavelengths = [12398.425/(7070.5 + incr) for incr in range(100)]
+    fp, fdp = GS.fp_fdp_at_wavelengths(wavelengths)
+    for i, wavelength in enumerate(wavelengths):
+      assert (fp[i], fdp[i]) == legacy_fp_fdp_at_wavelength(GS, wavelength)
+    # interpolation reproduces the table at its own energies
+    for idx in range(1, len(GS.energy)-1, 7):
+      assert approx_equal(GS.interpolate(GS.energy[idx]), (GS.fp[idx], GS.fdp[idx]), out=None)
+    GS.interpolation = "spline"
+    for idx in range(1, len(GS.energy)-1, 7):
+      assert approx_equal(GS.interpolate(GS.energy[idx]), (GS.fp[idx], GS.fdp[idx]), out=None)
+
+def tst_batch_matches_scalar():
+  from scitbx.array_family import flex
+  GS = george_sherrell(os.path.join(ls49_big_data,"data_sherrell","pf-rd-red_fftkk.out"))
+  # keep every third row, so most channel energies fall between table rows
+  keep = flex.size_t(range(0, len(GS.energy), 3))
+  GS.energy = GS.energy.select(keep); GS.fp = GS.fp.select(keep); GS.fdp = GS.fdp.select(keep)
+  wavelengths = flex.double([12398.425/(7070.5 + 0.25*incr) for incr in range(400)])
+  for interpolation in ["linear", "spline"]:
+    GS.interpolation = interpolation
+    fp, fdp = GS.fp_fdp_at_wavelengths(wavelengths)
+    for i, wavelength in enumerate(wavelengths):
+      assert approx_equal((fp[i], fdp[i]), GS.fp_fdp_at_wavelength(wavelength), eps=1.e-12, out=None)
+  try: GS.fp_fdp_at_wavelengths([12398.425/(GS.energy[0] - 10.)])
+  except ValueError: pass
+  else: raise AssertionError("expected ValueError outside the table")
+
+def tst_index_follows_replaced_arrays():
+  GS = george_sherrell(os.path.join(ls49_big_data,"data_sherrell","pf-rd-ox_fftkk.out"))
+  wavelengths = [12398.425/(7070.5 + incr) for incr in range(100)]
+  fp, fdp = GS.fp_fdp_at_wavelengths(wavelengths)
+  GS.fp = GS.fp * 2.; GS.fdp = GS.fdp + 1. # same energy grid, new values
+  fp2, fdp2 = GS.fp_fdp_at_wavelengths(wavelengths)
+  for i in range(len(wavelengths)):
+    assert fp2[i] == 2. * fp[i] and fdp2[i] == fdp[i] + 1.
+    assert (fp2[i], fdp2[i]) == GS.fp_fdp_at_wavelength(wavelengths[i])
+
+if __name__=="__main__":
+  tst_indexed_lookup()
+  tst_batch_matches_scalar()
+  tst_index_follows_replaced_arrays()
+  print("OK")
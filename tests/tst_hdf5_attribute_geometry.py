@@ -0,0 +1,91 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+import h5py
+
+def three_panel_geometry():
+  from dxtbx.model import Detector
+  from dxtbx.model.beam import BeamFactory
+  detector = Detector()
+  for ipanel in range(3):
+    panel = detector.add_panel()
+    panel.set_image_size((6, 8))
+    panel.set_pixel_size((0.1, 0.1))
+    panel.set_trusted_range((-1., 1.e6))
+    panel.set_frame((1., 0., 0.), (0., -1., 0.), (1.0*ipanel, 0., -100.))
+  beam = BeamFactory.simple(wavelength=1.74)
+  return detector.to_dict(), beam.to_dict()
+
+def write_synthetic_file(filename, n_images=5):
+  detector, beam = three_panel_geometry()
+  rng = np.random.RandomState(0)
+  images = rng.random_sample((n_images, 3, 8, 6)) * 1.e3
+  energies = np.array([[7100. + 10.*i + j for j in range(4)] for i in range(n_images)])
+  weights = rng.random_sample((n_images, 4)) + 0.1
+  with h5py.File(filename, "w") as handle:
+    dset = handle.create_dataset("images", data=images.astype(np.float32), chunks=(1, 1, 8, 6))
+    dset.attrs["dxtbx_detector_string"] = str(detector)
+    dset.attrs["dxtbx_beam_string"] = str(beam)
+    handle.create_dataset("spectrum_energies", data=energies)
+    handle.create_dataset("spectrum_weights", data=weights)
+  return images.astype(np.float32).astype(np.float64), energies, weights
+
+def tst_panels_regions_read_ahead():
+  from LS49.adse13_187.FormatHDF5AttributeGeometry import FormatHDF5AttributeGeometry
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "synthetic.h5")
+    images, energies, weights = write_synthetic_file(filename)
+    assert FormatHDF5AttributeGeometry.understand(filename)
+    F = FormatHDF5AttributeGeometry(filename)
+    assert F.get_num_images() == 5 and len(F.get_detector()) == 3
+
+    reads = []
+    read_block = F._read_block
+    def counted_read_block(index, panels, region):
+      reads.append((index, panels, region))
+      return read_block(index, panels, region)
+    F._read_block = counted_read_block
+
+    F.set_read_ahead(3)
+    for index in range(5):
+      data = F.get_raw_data(index)
+      assert len(data) == 3
+      for ipanel in range(3):
+        assert list(data[ipanel]) == list(images[index, ipanel].ravel())
+    assert [read[0] for read in reads] == [0, 3] # two HDF5 reads for five images
+
+    # panel subset, in the order asked for, not contiguous in the file
+    for index in [1, 4]:
+      subset = F.get_raw_panels(index, panels=[2, 0])
+      assert list(subset[0]) == list(images[index, 2].ravel())
+      assert list(subset[1]) == list(images[index, 0].ravel())
+    # region of every selected panel
+    region = ((2, 6), (1, 4))
+    for index in [0, 2]:
+      windows = F.get_raw_panels(index, panels=[1, 2], region=region)
+      for window, ipanel in zip(windows, [1, 2]):
+        assert list(window) == list(images[index, ipanel, 2:6, 1:4].ravel())
+    assert reads[-1][1:] == ((1, 2), region)
+
+    F.set_read_ahead(1)
+    del reads[:]
+    for index in [4, 3]:
+      assert list(F.get_raw_panels(index, panels=[1])[0]) == list(images[index, 1].ravel())
+    assert len(reads) == 2
+
+    # spectra: weighted mean energy, kept for the most recently used indices only
+    F.SPECTRUM_CACHE_SIZE = 2
+    for index in [0, 1, 2, 1]:
+      expected = 12398.419739640716 / ((weights[index]*energies[index]).sum() / weights[index].sum())
+      assert abs(F.get_beam(index).get_wavelength() - expected) < 1.e-10
+    assert list(F._spectrum_cache.keys()) == [2, 1]
+    del F
+  finally:
+    shutil.rmtree(directory)
+
+if __name__=="__main__":
+  tst_panels_regions_read_ahead()
+  print("OK")
@@ -0,0 +1,71 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+from scitbx.array_family import flex
+from scitbx.matrix import sqr
+
+from LS49.sim.image_container import image_container
+from LS49.utils.job_ledger import job_ledger, input_hash
+
+class fake_simulator(object):
+  def __init__(self, seed):
+    self.detpixels_fastslow = (20, 10)
+    self.pixel_size_mm = 0.11
+    self.distance_mm = 141.7
+    self.Amatrix = (0.02, 0., 0., 0.001, 0.018, 0., 0., 0.002, 0.025)
+    mt = flex.mersenne_twister(seed=seed)
+    self.raw_pixels = mt.random_double(200) * 1.e3
+    self.raw_pixels.reshape(flex.grid(10, 20))
+
+def tst_round_trip():
+  from LS49.sim.FormatHDF5SimContainer import FormatHDF5SimContainer
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "rank_00000.h5")
+    ledger = job_ledger(os.path.join(directory, "ledger"))
+    images = {} # image_index -> (SIM, rotation, wavelength)
+    for image_index, wavelength_A in [(17, 1.7412), (4, 1.7398)]:
+      # reopened for each image, as after a restart
+      container = image_container(filename, compression="gzip")
+      assert not container.has(image_index)
+      SIM = fake_simulator(image_index)
+      rotation = sqr(flex.mersenne_twister(seed=image_index).random_double_r3_rotation_matrix())
+      stored = container.append(SIM, image_index, rotation, wavelength_A, rank=3, sim_time=1.5)
+      ledger.record(image_index, input_hash(image_index), [stored])
+      images[image_index] = (SIM, rotation, wavelength_A)
+      container.close()
+    container = image_container(filename)
+    assert len(container) == 2 and container.has(17) and container.has(4) and not container.has(5)
+    assert container.row_output(4)[0:2] == (filename, 1)
+    container.close()
+
+    ledger.load()
+    for image_index in [17, 4]:
+      assert ledger.is_complete(image_index, input_hash(image_index), verify=True)
+
+    F = FormatHDF5SimContainer(filename)
+    assert FormatHDF5SimContainer.understand(filename)
+    assert F.get_num_images() == 2
+    for index, image_index in enumerate([17, 4]):
+      SIM, rotation, wavelength_A = images[image_index]
+      assert F.get_image_index(index) == image_index
+      assert np.allclose(F.get_rotation_matrix(index), rotation.elems)
+      assert np.allclose(F.get_direct_space_abc(index), sqr(SIM.Amatrix).inverse().transpose().elems)
+      assert abs(F.get_beam(index).get_wavelength() - wavelength_A) < 1.e-12
+      pixels = F.get_raw_data(index)[0].as_numpy_array()
+      assert np.all(pixels == SIM.raw_pixels.as_numpy_array().astype(np.float32))
+    del F
+
+    # a damaged row fails verification
+    import h5py
+    with h5py.File(filename, "a") as handle: handle["images"][1, 0, 0, 0] += 1.
+    assert ledger.is_complete(17, input_hash(17), verify=True)
+    assert not ledger.is_complete(4, input_hash(4), verify=True)
+  finally:
+    shutil.rmtree(directory)
+
+if __name__=="__main__":
+  tst_round_trip()
+  print("OK")
@@ -0,0 +1,32 @@
+from __future__ import division, print_function
+from LS49.utils.image_scheduler import static_queue, run_local
+
+def sleepy_worker(idx, rank):
+  from time import sleep
+  sleep(0.001 * (idx%7))
+
+def cost(idx):
+  return idx%7
+
+def tst_static():
+  # the static queue reproduces the legacy round-robin parcels
+  for size in [1,3,8]:
+    for rank in range(size):
+      assert list(static_queue(rank, size, 100)) == list(range(rank, 100, size))
+  claimed = []
+  for rank in range(4):
+    claimed += list(static_queue(rank, 4, 103, chunk=5, cost=cost))
+  assert sorted(claimed) == list(range(103))
+
+def tst_dynamic_local():
+  for chunk in [1,4]:
+    report = run_local(sleepy_worker, 57, nproc=3, chunk=chunk, cost=cost)
+    done = []
+    for rank in report: done += report[rank][0]
+    # every image exactly once
+    assert sorted(done) == list(range(57))
+
+if __name__=="__main__":
+  tst_static()
+  tst_dynamic_local()
+  print("OK")
@@ -0,0 +1,21 @@
+from __future__ import division, print_function
+from scitbx.array_family import flex
+
+def tst_forked_channels_reproduce_serial():
+  from LS49.work2_for_aca_lsq.remake_range_intensities_with_complex import \
+    get_intensity_structure, get_intensity_structure_distributed, \
+    intensity_structure_context, Fe_oxidized_model, Fe_reduced_model
+  N = intensity_structure_context()["Fmodel_indices"].size()
+  # any static table will do for the comparison: F(bulk + non-Fe) varying with H and channel
+  mt = flex.mersenne_twister(seed=0)
+  base = flex.complex_double(mt.random_double(N*100), mt.random_double(N*100))
+  base.reshape(flex.grid((N,100)))
+  serial = get_intensity_structure(base, Fe_oxidized_model, Fe_reduced_model)
+  forked = get_intensity_structure_distributed(base, Fe_oxidized_model, Fe_reduced_model,
+                                               comm=None, nproc=2)
+  assert forked.focus() == serial.focus() == (N,500)
+  assert (forked == serial).all_eq(True)
+
+if __name__=="__main__":
+  tst_forked_channels_reproduce_serial()
+  print("OK")
@@ -0,0 +1,52 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+
+from LS49.utils.job_ledger import job_ledger, atomic_output, input_hash
+
+def write_output(path, content):
+  with atomic_output(path) as A:
+    with open(A.tmp, "w") as F: F.write(content)
+  return A.written
+
+def tst_record_and_load():
+  ledger_dir = tempfile.mkdtemp()
+  try:
+    outputs = write_output(os.path.join(ledger_dir, "image_000000.img"), "image 0")
+    assert outputs == [os.path.join(ledger_dir, "image_000000.img")]
+    ledger = job_ledger(ledger_dir, rank=0)
+    ledger.record(0, input_hash("image", 0), outputs)
+    # a fresh ledger (as at a restart) reads the record back
+    ledger = job_ledger(ledger_dir, rank=1)
+    ledger.load()
+    assert ledger.is_complete(0, input_hash("image", 0), verify=True)
+    assert not ledger.is_complete(0, input_hash("image", 1)) # changed input
+    assert not ledger.is_complete(1, input_hash("image", 1)) # never recorded
+    with open(outputs[0], "w") as F: F.write("image 0, overwritten")
+    assert ledger.is_complete(0, input_hash("image", 0))
+    assert not ledger.is_complete(0, input_hash("image", 0), verify=True)
+  finally:
+    shutil.rmtree(ledger_dir)
+
+def tst_torn_line():
+  ledger_dir = tempfile.mkdtemp()
+  try:
+    ledger = job_ledger(ledger_dir, rank=0)
+    ledger.record(0, input_hash(0), [])
+    with open(ledger.path, "a") as F: F.write('{"idx": 1, "inp') # crash in the middle of a write
+    # after the restart, the next record still gets a line of its own
+    ledger = job_ledger(ledger_dir, rank=0)
+    ledger.load()
+    assert sorted(ledger.records) == [0]
+    ledger.record(2, input_hash(2), [])
+    ledger.load()
+    assert sorted(ledger.records) == [0, 2]
+    assert ledger.is_complete(2, input_hash(2)) and not ledger.is_complete(1, input_hash(1))
+  finally:
+    shutil.rmtree(ledger_dir)
+
+if __name__=="__main__":
+  tst_record_and_load()
+  tst_torn_line()
+  print("OK")
@@ -0,0 +1,47 @@
+from __future__ import division, print_function
+from six.moves import cPickle as pickle
+from scitbx.array_family import flex
+
+from LS49.utils.miller_lookup import miller_lookup, miller_table
+
+def tst_miller_lookup():
+  indices = flex.miller_index([(h,k,l) for h in range(-20,21,3) for k in range(-9,10,2)
+                               for l in (-1000,-1,0,7,1000)])
+  reference = {}
+  for iw in range(len(indices)):
+    reference[indices[iw]] = iw
+  lookup = miller_lookup(indices)
+  assert len(lookup) == len(reference)
+  assert list(lookup) == list(reference.keys())
+  queries = list(reference.keys())[::-3] + [(100,100,100), (0,0,1)]
+  rows = lookup.rows(queries)
+  for query, row in zip(queries, rows):
+    assert row == reference.get(query, -1)
+    assert (query in lookup) == (query in reference)
+  assert lookup[queries[0]] == reference[queries[0]]
+  for query in queries: # scalar access agrees with the batch lookup
+    assert lookup.get(query, -1) == reference.get(query, -1)
+  try:
+    lookup[(100,100,100)]
+    raise AssertionError("expected KeyError")
+  except KeyError: pass
+  assert list(miller_lookup.from_dict(reference)) == list(reference.keys())
+  # compact, lossless serialization
+  restored = pickle.loads(pickle.dumps(lookup, pickle.HIGHEST_PROTOCOL))
+  assert list(restored.rows(queries)) == list(rows)
+  assert restored[queries[0]] == reference[queries[0]] and (100,100,100) not in restored
+  assert len(pickle.dumps(lookup, pickle.HIGHEST_PROTOCOL)) < \
+         len(pickle.dumps(reference, pickle.HIGHEST_PROTOCOL)) / 2
+
+def tst_miller_table():
+  indices = flex.miller_index([(1,2,3),(-1,0,4),(5,-6,7)])
+  data = flex.double([10.,20.,30.])
+  table = miller_table(indices, data)
+  assert table[(-1,0,4)] == 20.
+  assert table.get((0,0,0)) is None
+  assert dict(table.items()) == {(1,2,3):10., (-1,0,4):20., (5,-6,7):30.}
+
+if __name__=="__main__":
+  tst_miller_lookup()
+  tst_miller_table()
+  print("OK")
@@ -0,0 +1,58 @@
+from __future__ import division, print_function
+import math
+import scitbx
+import scitbx.random
+from scitbx.array_family import flex
+from scitbx.matrix import col
+from libtbx.test_utils import approx_equal
+
+from LS49.sim.mosaic_domains import mosaic_domain_provider
+
+def legacy_umats(mosaic_spread_deg, N_mosaic_domains):
+  UMAT_nm = flex.mat3_double()
+  mersenne_twister = flex.mersenne_twister(seed=0)
+  scitbx.random.set_random_seed(1234)
+  rand_norm = scitbx.random.normal_distribution(mean=0, sigma=mosaic_spread_deg * math.pi/180.)
+  g = scitbx.random.variate(rand_norm)
+  mosaic_rotation = g(N_mosaic_domains)
+  for m in mosaic_rotation:
+    site = col(mersenne_twister.random_double_point_on_sphere())
+    UMAT_nm.append( site.axis_and_angle_as_r3_rotation_matrix(m,deg=False) )
+  return UMAT_nm
+
+def tst_mosaic_domain_provider():
+  provider = mosaic_domain_provider(max_sets=2)
+  for spread, count in [(0.05,25), (0.05,25), (0.12,25), (0.05,50)]:
+    UMAT_nm = provider.umats(spread, count)
+    reference = legacy_umats(spread, count)
+    assert len(UMAT_nm) == count
+    for x in range(count):
+      assert approx_equal(UMAT_nm[x], reference[x], eps=1.e-14, out=None)
+  assert (provider.draws, provider.rescales, provider.hits) == (2, 1, 1)
+  assert provider.umats(0.05,25) is not provider.umats(0.12,25)
+  assert len(provider.sets) == 2 # least recently used set dropped
+
+def tst_pairs_and_anisotropic_rescale():
+  from scitbx.matrix import sqr
+  provider = mosaic_domain_provider()
+  pairs = provider.umats(0.05, 25, method="normal_pairs")
+  legacy = legacy_umats(0.05, 25)
+  assert len(pairs) == 50
+  for x in range(25):
+    assert approx_equal(pairs[2*x], legacy[x], eps=1.e-14, out=None)
+    assert approx_equal((sqr(pairs[2*x]) * sqr(pairs[2*x+1])).elems, (1,0,0,0,1,0,0,0,1), out=None)
+  # an eta proposal rescales the cached draws and matches a fresh provider
+  provider.umats((0.02,0.03,0.04), 250, method="anisotropic_pairs")
+  rescaled = provider.umats((0.02,0.05,0.04), 250, method="anisotropic_pairs")
+  assert provider.rescales == 1
+  fresh = mosaic_domain_provider().umats((0.02,0.05,0.04), 250, method="anisotropic_pairs")
+  assert len(rescaled) == 500
+  for x in range(500):
+    assert approx_equal(rescaled[x], fresh[x], eps=1.e-14, out=None)
+  flat = provider.umats((0.,0.,0.), 3, method="anisotropic_pairs")
+  assert approx_equal(flat[0], (1,0,0,0,1,0,0,0,1), out=None)
+
+if __name__=="__main__":
+  tst_mosaic_domain_provider()
+  tst_pairs_and_anisotropic_rescale()
+  print("OK")
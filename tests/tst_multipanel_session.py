@@ -0,0 +1,98 @@
+from __future__ import division, print_function
+from time import time
+from scitbx.array_family import flex
+
+from LS49.adse13_187.cyto_batch import multipanel_sim, multipanel_session
+
+class fake_backend(object):
+  """Stands in for simtbx.gpu.  The "device" keeps a copy of the crystal taken at
+  allocate(), so a stale copy shows up in the pixels; calls are counted."""
+  def __init__(self):
+    self.counts = dict(allocate=0, deallocate=0, each_image_allocate=0, each_image_free=0)
+    backend = self
+    class exascale_api(object):
+      def __init__(self, nanoBragg):
+        self.SIM = nanoBragg
+      def allocate(self):
+        backend.counts["allocate"] += 1
+        self.device = (tuple(self.SIM.Amatrix), tuple(self.SIM.Ncells_abc))
+      def deallocate(self):
+        backend.counts["deallocate"] += 1
+        self.device = None
+      def add_energy_channel_mask_allpanel(self, channel_number, gpu_amplitudes, gpu_detector,
+                                           pixel_active_list_ints):
+        Amatrix, Ncells_abc = self.device
+        for address in pixel_active_list_ints:
+          gpu_detector.pixels[address] += sum(Amatrix) * (address + 1) + sum(Ncells_abc)
+    class gpu_detector(object):
+      def __init__(self, deviceId, detector, beam):
+        self.n_pixels = sum(panel.get_image_size()[0] * panel.get_image_size()[1]
+                            for panel in detector)
+      def each_image_allocate(self):
+        backend.counts["each_image_allocate"] += 1
+        self.pixels = flex.double(self.n_pixels)
+      def each_image_free(self):
+        backend.counts["each_image_free"] += 1
+      def scale_in_place(self, factor):
+        self.pixels *= factor
+      def get_whitelist_raw_pixels(self, order):
+        return self.pixels.select(order)
+    self.exascale_api = exascale_api
+    self.gpu_detector = gpu_detector
+
+class fake_amplitudes(object):
+  def get_deviceID(self): return 0
+  def get_nchannels(self): return 1
+
+def event_setup():
+  from dxtbx.model.beam import BeamFactory
+  from dxtbx.model import Crystal
+  from simtbx.nanoBragg.sim_data import SimData
+  detector = SimData.simple_detector(180., 0.1, (32, 32))
+  beam = BeamFactory.simple(1.3)
+  crystals = []
+  for i in range(4):
+    crystals.append(Crystal((79.+i,0,0), (0,79.+i,0), (0,0,38.+0.5*i), space_group_symbol="P43212"))
+  whitelist = flex.int(range(0, 32*32, 7))
+  return detector, beam, crystals, whitelist
+
+def tst_session_matches_multipanel_sim():
+  detector, beam, crystals, whitelist = event_setup()
+  event = dict(DETECTOR=detector, BEAM=beam, Famp=fake_amplitudes(),
+               energies=[9490., 9500., 9510.], fluxes=[1.e11, 2.e11, 1.e11],
+               oversample=1, mos_dom=2, beamsize_mm=0.001, profile="gauss_argchk",
+               spot_scale_override=500., mask_file=whitelist,
+               relevant_whitelist_order=flex.size_t(list(whitelist)))
+  proposals = [(crystal, (10+i, 12, 14), 0.01*(i+1)) for i, crystal in enumerate(crystals)]
+
+  direct = fake_backend()
+  BEG = time()
+  references = []
+  for crystal, Ncells_abc, spread in proposals:
+    references.append(multipanel_sim(CRYSTAL=crystal, cuda=True, Ncells_abc=Ncells_abc,
+      mos_spread=spread, mos_aniso=(spread, spread, spread), include_background=False,
+      skip_numpy=True, backend=direct, **event)[0])
+  TIME_DIRECT = time()-BEG
+
+  reused = fake_backend()
+  BEG = time()
+  session = multipanel_session(backend=reused, **event)
+  for (crystal, Ncells_abc, spread), reference in zip(proposals, references):
+    whitelist_only = session.simulate(CRYSTAL=crystal, Ncells_abc=Ncells_abc,
+      mos_spread=spread, mos_aniso=(spread, spread, spread))[0]
+    assert len(whitelist_only) == len(reference)
+    assert flex.max(flex.abs(whitelist_only - reference)) <= 1.e-10 * flex.max(reference)
+  session.close()
+  TIME_SESSION = time()-BEG
+
+  n = len(proposals)
+  assert direct.counts == dict(allocate=n, deallocate=0, each_image_allocate=n, each_image_free=n)
+  # one detector allocation per event; the exascale_api copy is remade on every later call
+  assert reused.counts == dict(allocate=n, deallocate=n-1, each_image_allocate=1, each_image_free=1)
+  assert session.n_calls == n
+  print("%d simulations, host side: multipanel_sim %.3fs, session %.3fs"%(
+        n, TIME_DIRECT, TIME_SESSION))
+
+if __name__=="__main__":
+  tst_session_matches_multipanel_sim()
+  print("OK")
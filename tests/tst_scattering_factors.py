@@ -0,0 +1,48 @@
+from __future__ import division, print_function
+from cctbx.eltbx import henke
+from cctbx.development import random_structure
+from cctbx import sgtbx
+
+from LS49.sim.scattering_factors import scattering_factor_service, element_groups
+
+def small_structure():
+  return random_structure.xray_structure(
+    space_group_info=sgtbx.space_group_info("P1"),
+    elements=["Fe","S","C","N","O","C","O","Fe","Zn"])
+
+def tst_apply_matches_per_scatterer_loop():
+  service = scattering_factor_service("henke")
+  xrs = small_structure()
+  reference = xrs.deep_copy_scatterers()
+  for wavelength in [1.2, 1.7463, 1.7475, 1.2]:
+    for sc in reference.scatterers(): # the loop gen_fmodel used to run
+      factors = henke.table(sc.element_symbol()).at_angstrom(wavelength)
+      sc.fp = factors.fp(); sc.fdp = factors.fdp()
+    service.apply(xrs, wavelength)
+    for sc, ref in zip(xrs.scatterers(), reference.scatterers()):
+      assert sc.fp == ref.fp and sc.fdp == ref.fdp
+  n_elements = len(element_groups(xrs))
+  assert service.lookups == 3 * n_elements # the repeated wavelength is not looked up again
+  groups = service.groups(xrs)
+  assert service.groups(xrs) is groups # kept for the structure
+  assert service.groups(reference) is not groups
+
+def tst_batched_fp_fdp():
+  service = scattering_factor_service("henke")
+  wavelengths = [12398.425/energy for energy in range(7070, 7170, 10)]
+  fp, fdp = service.fp_fdp("Fe", wavelengths)
+  table = henke.table("Fe")
+  for i, wavelength in enumerate(wavelengths):
+    factors = table.at_angstrom(wavelength)
+    assert fp[i] == factors.fp() and fdp[i] == factors.fdp()
+  lookups = service.lookups
+  fp2, fdp2 = service.fp_fdp("Fe", wavelengths)
+  assert service.lookups == lookups
+  assert list(fp2) == list(fp) and list(fdp2) == list(fdp)
+  fp2[0] = 0. # callers get copies, not the cached arrays
+  assert service.fp_fdp("Fe", wavelengths)[0][0] == fp[0]
+
+if __name__=="__main__":
+  tst_apply_matches_per_scatterer_loop()
+  tst_batched_fp_fdp()
+  print("OK")
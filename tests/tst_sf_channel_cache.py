@@ -0,0 +1,43 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+
+from LS49 import ls49_big_data
+from LS49.sim.fdp_plot import george_sherrell
+
+def tst_round_trip():
+  from LS49.sim.util_fmodel import gen_fmodel
+  from LS49.sim.sf_channel_cache import sf_channel_cache
+  pdb_lines = open(os.path.join(ls49_big_data,"1m2a.pdb"),"r").read()
+  Fe_oxidized_model = george_sherrell(os.path.join(ls49_big_data,"data_sherrell/pf-rd-ox_fftkk.out"))
+  Fe_reduced_model = george_sherrell(os.path.join(ls49_big_data,"data_sherrell/pf-rd-red_fftkk.out"))
+
+  GF = gen_fmodel(resolution=1.7,pdb_text=pdb_lines,algorithm="fft",wavelength=1.74)
+  GF.set_k_sol(0.435)
+  GF.make_P1_primitive()
+
+  cache_dir = tempfile.mkdtemp()
+  try:
+    for wavelength_A in [12398.425/7100.5, 12398.425/7120.5]:
+      cache = sf_channel_cache(cache_dir, pdb_lines, Fe_oxidized_model, Fe_reduced_model)
+      assert cache.get(GF, wavelength_A) is None
+      direct = cache.amplitudes(GF, wavelength_A) # miss, computes and stores
+      assert cache.misses == 1
+      # a fresh cache object (as on a new rank) reads the stored channel
+      cache = sf_channel_cache(cache_dir, pdb_lines, Fe_oxidized_model, Fe_reduced_model)
+      cached = cache.amplitudes(GF, wavelength_A)
+      assert cache.hits == 1 and cache.misses == 0
+      assert cached.space_group() == direct.space_group()
+      assert cached.unit_cell().parameters() == direct.unit_cell().parameters()
+      assert cached.indices() == direct.indices()
+      assert cached.data() == direct.data()
+    # a different anomalous model must not share cache entries
+    cache = sf_channel_cache(cache_dir, pdb_lines, Fe_reduced_model, Fe_reduced_model)
+    assert cache.get(GF, 12398.425/7120.5) is None
+  finally:
+    shutil.rmtree(cache_dir)
+
+if __name__=="__main__":
+  tst_round_trip()
+  print("OK")
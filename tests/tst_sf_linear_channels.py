@@ -0,0 +1,51 @@
+from __future__ import division, print_function
+import os
+
+from LS49 import ls49_big_data
+from LS49.sim.fdp_plot import george_sherrell
+
+def tst_linear_channels(tolerance=1.e-5):
+  from LS49.sim.util_fmodel import gen_fmodel, anomalous_linear_fmodel
+  pdb_lines = open(os.path.join(ls49_big_data,"1m2a.pdb"),"r").read()
+  tables = dict(
+    FE1=george_sherrell(os.path.join(ls49_big_data,"data_sherrell/pf-rd-ox_fftkk.out")),
+    FE2=george_sherrell(os.path.join(ls49_big_data,"data_sherrell/pf-rd-red_fftkk.out")))
+  GF = gen_fmodel(resolution=1.7,pdb_text=pdb_lines,algorithm="fft",wavelength=1.74)
+  GF.set_k_sol(0.435)
+  GF.make_P1_primitive()
+  linear = anomalous_linear_fmodel(GF)
+  assert "FE1" in linear.groups and "FE2" in linear.groups
+  # channels across the spectrum, either side of the Fe K edge
+  for energy in [7070.5, 7110.5, 7120.5, 7130.5, 7169.5]:
+    deviation = linear.validate(12398.425/energy, tables, tolerance=tolerance)
+    print("%.1f eV: relative deviation %.3g"%(energy, deviation))
+
+def tst_bulk_solvent_cache():
+  from LS49.sim.util_fmodel import gen_fmodel
+  pdb_lines = open(os.path.join(ls49_big_data,"1m2a.pdb"),"r").read()
+  GF = gen_fmodel(resolution=1.7,pdb_text=pdb_lines,algorithm="fft",wavelength=1.74)
+  GF.set_k_sol(0.435)
+  GF.make_P1_primitive()
+  os.environ["SF_BULK_SOLVENT_CACHE"] = "1"
+  os.environ["SF_BULK_SOLVENT_CACHE_VALIDATE"] = "1" # each cached channel asserts agreement with the full path
+  try:
+    for energy in [7070.5, 7120.5, 7169.5]:
+      GF.reset_wavelength(12398.425/energy)
+      GF.get_amplitudes()
+    assert GF.bulk_solvent is not None and GF.bulk_solvent[2] is not None
+    GF.set_k_sol(0.35) # a different solvent model is a different key
+    assert GF.bulk_solvent[0] != GF.structure_key()
+    # an overall scale other than 1 (anisotropic b_cart) must be kept out of the cached mask term
+    GF.params2.fmodel.b_cart = [5., -3., -2., 0., 0., 0.]
+    for energy in [7070.5, 7120.5, 7169.5]:
+      GF.reset_wavelength(12398.425/energy)
+      GF.get_amplitudes()
+    assert GF.bulk_solvent[2] is not None # decomposed, not the full-path fallback
+  finally:
+    del os.environ["SF_BULK_SOLVENT_CACHE"]
+    del os.environ["SF_BULK_SOLVENT_CACHE_VALIDATE"]
+
+if __name__=="__main__":
+  tst_linear_channels()
+  tst_bulk_solvent_cache()
+  print("OK")
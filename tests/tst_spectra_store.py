@@ -0,0 +1,35 @@
+from __future__ import division, print_function
+from six.moves import cPickle as pickle
+import os
+import shutil
+import tempfile
+
+from LS49 import ls49_big_data
+from LS49.spectra import generate_spectra
+generate_spectra.big_data = ls49_big_data
+
+def tst_store_reproduces_spectra_simulation():
+  from LS49.spectra.generate_spectra import spectra_simulation
+  from LS49.spectra.spectra_store import build_spectra_store, spectra_store
+  SS = spectra_simulation()
+  root = tempfile.mkdtemp()
+  try:
+    filename = build_spectra_store(os.path.join(root, "spectra.bin"), energy=7120.,
+                                   total_flux=1e12, chunk=3, SS=SS, N_images=7)
+    store = spectra_store(filename)
+    assert store.N == 7
+    reopened = pickle.loads(pickle.dumps(store)) # as broadcast to a rank
+    for image in [0, 2, 3, 6]: # either side of a chunk boundary
+      expected = next(SS.generate_recast_renormalized_image(image=image, energy=7120., total_flux=1e12))
+      for source in [store, reopened]:
+        wavlen, flux, wavelength_A = next(
+          source.generate_recast_renormalized_image(image=image, energy=7120., total_flux=1e12))
+        assert list(wavlen) == list(expected[0])
+        assert list(flux) == list(expected[1]) # float64, no rounding
+        assert wavelength_A == expected[2]
+  finally:
+    shutil.rmtree(root)
+
+if __name__=="__main__":
+  tst_store_reproduces_spectra_simulation()
+  print("OK")
@@ -42,6 +42,14 @@ def tst_iterators():
     assert approx_equal(flux, reference[x][1]), "iterator 2 flux axis"
     assert approx_equal(wavelength_A, reference[x][2],eps=1E-10), "iterator 2 mean wavelength"
 
+  # vectorized recast of the whole batch at once
+  wavlen, flux, wavelength_A = SS.recast_renormalized_batch(range(20),energy=7120.,total_flux=1e12)
+  assert flux.shape == (20,100) and flux.flags.c_contiguous
+  for x in range(20):
+    assert approx_equal(list(wavlen),reference[x][0]), "batch wavelength axis"
+    assert approx_equal(list(flux[x]), reference[x][1]), "batch flux axis"
+    assert approx_equal(wavelength_A[x],reference[x][2],eps=1E-10), "batch mean wavelength"
+
 if __name__=="__main__":
   # create_reference_results() # create the test case
   tst_iterators()
@@ -0,0 +1,62 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+from cctbx.development import random_structure
+from cctbx import sgtbx
+from scitbx.array_family import flex
+
+from LS49.ML_push import new_global_fdp_refinery
+from LS49.ML_push import static_fcalc_store as store_module
+from LS49.ML_push.static_fcalc_store import build_static_fcalc_store, static_fcalc_store, model_key
+
+def small_C2_structures():
+  whole = random_structure.xray_structure(
+    space_group_info=sgtbx.space_group_info("C 1 2 1"),
+    unit_cell=(40., 20., 25., 90., 105., 90.),
+    elements=["Fe","Fe","S","S","O","O","N","C","C","C"], min_distance=1.5)
+  non_Fe = whole.select(flex.bool([sc.scattering_type != "Fe" for sc in whole.scatterers()]))
+  return [whole, non_Fe]
+
+def tst_build_reload_is_complete():
+  del new_global_fdp_refinery._static_fcalc_context[:]
+  new_global_fdp_refinery.static_fcalc_context(C2_structures=small_C2_structures())
+  HKL_lookup, reference = new_global_fdp_refinery.get_static_fcalcs_with_HKL_lookup()
+
+  root = tempfile.mkdtemp()
+  try:
+    path = os.path.join(root, model_key())
+    assert not static_fcalc_store.is_complete(path)
+    store = build_static_fcalc_store(root, comm=None)
+    assert static_fcalc_store.is_complete(path)
+    assert store.focus() == reference.focus()
+    assert store.as_flex().all_eq(reference)
+    assert list(store.HKL_lookup().rows(HKL_lookup.indices())) == list(range(store.n_rows))
+
+    fill_channel = store_module.fill_channel
+    def no_compute(fcalc, incr): raise AssertionError("complete store was recomputed")
+    store_module.fill_channel = no_compute
+    try:
+      reloaded = build_static_fcalc_store(root, comm=None)
+    finally:
+      store_module.fill_channel = fill_channel
+    assert reloaded.meta["key"] == model_key() and reloaded.meta["n_hkl"] == reference.focus()[0]
+    assert reloaded.matrix_copy_block(3, 10, 5, 20).all_eq(reference.matrix_copy_block(3, 10, 5, 20))
+    assert sorted(os.listdir(root)) == [model_key()] # no building directory left behind
+  finally:
+    shutil.rmtree(root)
+    del new_global_fdp_refinery._static_fcalc_context[:]
+
+def tst_key_follows_params():
+  params2 = new_global_fdp_refinery.static_fcalc_parameters()
+  assert model_key(params2) == model_key()
+  params2.fmodel.k_sol += 0.1
+  assert model_key(params2) != model_key()
+  params2 = new_global_fdp_refinery.static_fcalc_parameters()
+  params2.high_resolution = 2.0
+  assert model_key(params2) != model_key()
+
+if __name__=="__main__":
+  tst_build_reload_is_complete()
+  tst_key_follows_params()
+  print("OK")
@@ -0,0 +1,82 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+
+from LS49.sim.structure_registry import structure_registry
+
+pdb_text = """CRYST1   30.000   35.000   40.000  90.00  90.00  90.00 P 1
+ATOM      1  N   GLY A   1       1.000   2.000   3.000  1.00 10.00           N
+ATOM      2  CA  GLY A   1       2.200   2.500   3.100  1.00 10.00           C
+ATOM      3  C   GLY A   1       3.300   1.600   3.500  1.00 10.00           C
+ATOM      4  O   GLY A   1       3.100   0.400   3.700  1.00 10.00           O
+HETATM    5 FE   HEC A   2       6.000   6.000   6.000  1.00 12.00          FE
+END
+"""
+
+def tst_text_staleness(root):
+  path = os.path.join(root, "table.txt")
+  with open(path, "w") as F: F.write("7000 1.0 2.0\n")
+  registry = structure_registry()
+  assert registry.text(path) == "7000 1.0 2.0\n"
+  with open(path, "w") as F: F.write("7000 1.0 2.0\n7001 1.5 2.5\n") # size changes
+  assert registry.text(path) == "7000 1.0 2.0\n7001 1.5 2.5\n"
+  st = os.stat(path)
+  with open(path, "w") as F: F.write("7000 3.0 4.0\n7001 3.5 4.5\n") # same size
+  os.utime(path, (st.st_atime, st.st_mtime + 10.)) # only the mtime tells them apart
+  assert registry.text(path) == "7000 3.0 4.0\n7001 3.5 4.5\n"
+  before = registry.text(path)
+  assert registry.text(path) is before # unchanged file is not re-read
+
+def tst_anomalous_table_copies(root):
+  path = os.path.join(root, "fe.out")
+  with open(path, "w") as F:
+    for i in range(10): F.write("%d %f %f\n"%(7100 + i, -5. - 0.1*i, 3. + 0.2*i))
+  registry = structure_registry()
+  first = registry.anomalous_table(path)
+  assert first.fp_fdp_at_energy(7103.) == (first.fp[3], first.fdp[3])
+  first.fdp[3] = 100.
+  second = registry.anomalous_table(path)
+  assert abs(second.fdp[3] - 3.6) < 1.e-6
+  assert abs(second.fp_fdp_at_energy(7103.)[1] - 3.6) < 1.e-6
+  assert len(registry.tables) == 1 # parsed once
+
+def tst_xray_structure_copies(root):
+  registry = structure_registry()
+  first = registry.xray_structure(pdb_text)
+  first.scatterers()[4].fdp = 3.5
+  first.scatterers()[0].site = (0.5, 0.5, 0.5)
+  second = registry.xray_structure(pdb_text)
+  assert second.scatterers()[4].fdp == 0.
+  assert second.scatterers()[0].site != (0.5, 0.5, 0.5)
+  assert registry.parses == 1
+  selected = registry.xray_structure(pdb_text, selection="Fe only",
+    selector=lambda text: "\n".join([line for line in text.splitlines()
+                                     if not line.startswith("ATOM")]))
+  assert selected.scatterers().size() == 1 and registry.parses == 2
+
+def tst_disk_round_trip(root):
+  cache_dir = os.path.join(root, "registry")
+  writer = structure_registry(cache_dir=cache_dir)
+  written = writer.xray_structure(pdb_text)
+  assert writer.parses == 1
+  assert len([name for name in os.listdir(cache_dir) if name.endswith(".pickle")]) == 1
+  assert len([name for name in os.listdir(cache_dir) if name.endswith(".tmp")]) == 0
+  reader = structure_registry(cache_dir=cache_dir) # a new rank
+  loaded = reader.xray_structure(pdb_text)
+  assert reader.parses == 0
+  assert loaded.scatterers().size() == written.scatterers().size()
+  for a, b in zip(loaded.scatterers(), written.scatterers()):
+    assert a.label == b.label and a.site == b.site and a.u_iso == b.u_iso
+  assert loaded.unit_cell().is_similar_to(written.unit_cell())
+
+if __name__=="__main__":
+  root = tempfile.mkdtemp()
+  try:
+    tst_text_staleness(root)
+    tst_anomalous_table_copies(root)
+    tst_xray_structure_copies(root)
+    tst_disk_round_trip(root)
+  finally:
+    shutil.rmtree(root)
+  print("OK")
@@ -0,0 +1,108 @@
+from __future__ import division, print_function
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+from time import time
+from six.moves import queue
+
+"""Background compression and writing of simulated images.
+
+SIM.to_smv_format_py(..., gz=True) gzips ~9M pixels and writes the result to the
+parallel filesystem inside the compute loop.  With the asynchronous writer the
+compute thread only dumps the uncompressed SMV image to a local spool directory
+(tmpfs if available) and hands the file over; a writer thread compresses it into
+place (atomically, see job_ledger.atomic_output) while the next image is simulated.
+The queue is bounded, so a rank that outpaces its filesystem blocks in submit()
+rather than filling the spool; flush() waits for all pending images.
+
+Enable with ASYNC_IMAGE_WRITER=<queue depth>; ASYNC_IMAGE_SPOOL overrides the spool
+directory.
+"""
+
+def default_spool_dir():
+  if os.path.isdir("/dev/shm"): return "/dev/shm"
+  return tempfile.gettempdir()
+
+class async_image_writer(object):
+  def __init__(self, depth=2, spool_dir=None):
+    self.queue = queue.Queue(maxsize=depth)
+    self.spool_dir = spool_dir or default_spool_dir()
+    self.errors = []
+    self.wait_time = 0. # time the compute thread spent blocked on a full queue
+    self.write_time = 0.
+    self.n_written = 0
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def spool_name(self, fileout):
+    return os.path.join(self.spool_dir, "ls49_%d_%s"%(os.getpid(), os.path.basename(fileout)))
+
+  def submit(self, spooled, fileout, on_written=None):
+    """Take ownership of the uncompressed file spooled; it becomes fileout.gz.
+    on_written(list of final paths) is called from the writer thread."""
+    t0 = time()
+    self.queue.put((spooled, fileout, on_written))
+    self.wait_time += time() - t0
+
+  def _write(self, spooled, fileout, on_written):
+    from LS49.utils.job_ledger import atomic_output
+    t0 = time()
+    with atomic_output(fileout) as output:
+      with open(spooled, "rb") as F:
+        with gzip.open(output.tmp + ".gz", "wb") as G:
+          shutil.copyfileobj(F, G, 1<<24)
+    os.remove(spooled)
+    self.write_time += time() - t0
+    self.n_written += 1
+    if on_written is not None: on_written(output.written)
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None: return
+        self._write(*item)
+      except Exception as e:
+        self.errors.append((item[1], e))
+      finally:
+        self.queue.task_done()
+
+  def flush(self):
+    self.queue.join()
+    if len(self.errors) > 0:
+      fileout, e = self.errors[0]
+      raise RuntimeError("asynchronous write of %s failed: %s (%d failures)"%(fileout, e, len(self.errors)))
+
+  def close(self):
+    if not self.thread.is_alive(): return
+    self.flush()
+    self.queue.put(None)
+    self.thread.join()
+
+_singleton = []
+def image_writer():
+  """Process-level writer when ASYNC_IMAGE_WRITER is exported and nonzero, else None"""
+  depth = int(os.environ.get("ASYNC_IMAGE_WRITER",0))
+  if depth == 0: return None
+  if len(_singleton) == 0:
+    _singleton.append(async_image_writer(depth=depth, spool_dir=os.environ.get("ASYNC_IMAGE_SPOOL")))
+    import atexit
+    atexit.register(_singleton[0].close)
+  return _singleton[0]
+
+def write_smv_image(SIM, fileout, extra, on_written=None):
+  """Equivalent of SIM.to_smv_format_py(fileout,intfile_scale=1,rotmat=True,extra=extra,gz=True),
+  written atomically, through the asynchronous writer when one is enabled"""
+  writer = image_writer()
+  if writer is None:
+    from LS49.utils.job_ledger import atomic_output
+    with atomic_output(fileout) as output:
+      SIM.to_smv_format_py(fileout=output.tmp,intfile_scale=1,rotmat=True,extra=extra,gz=True)
+    if on_written is not None: on_written(output.written)
+    return
+  spooled = writer.spool_name(fileout)
+  SIM.to_smv_format_py(fileout=spooled,intfile_scale=1,rotmat=True,extra=extra,gz=False)
+  writer.submit(spooled, fileout, on_written)
@@ -0,0 +1,64 @@
+from __future__ import division, print_function
+import os
+import sys
+
+"""Forked process pools for rank-local parallelism.
+
+The structure factor and simulation helpers hand large, unpicklable state (structure
+factor generators, flex tables, simulators) to their workers by leaving it in the
+parent's memory and forking.  That only works with the fork start method, so the pool
+here always uses multiprocessing.get_context("fork") rather than the interpreter
+default (spawn on macOS, forkserver on Linux from Python 3.14):
+
+  results = fork_map(worker, items, processes, shared=state)
+
+is [worker(state, item) for item in items], with worker a module-level function.  The
+shared state is not pickled; only the items and the results are.
+
+Forking inside an initialized MPI process is not supported by many MPI stacks
+(registered memory, progress threads and open network endpoints are duplicated into
+the child), and can hang or corrupt the parent's communication.  fork_map therefore
+runs serially when mpi4py is initialized, unless FORK_UNDER_MPI=1 is exported to state
+that the MPI in use tolerates fork (e.g. Open MPI over TCP, MPICH with ch3:sock).
+The serial result is identical.
+"""
+
+def mpi_active():
+  """True if mpi4py has been imported and MPI is initialized in this process"""
+  MPI = sys.modules.get("mpi4py.MPI")
+  if MPI is None: return False
+  try:
+    return bool(MPI.Is_initialized() and not MPI.Is_finalized())
+  except AttributeError:
+    return False
+
+_warned = []
+def fork_allowed():
+  if not mpi_active() or os.environ.get("FORK_UNDER_MPI", "0") == "1": return True
+  if len(_warned) == 0:
+    _warned.append(True)
+    print("fork_pool: MPI is initialized, running the process pool serially (export FORK_UNDER_MPI=1 to fork)")
+  return False
+
+_jobs = []
+def _run(item):
+  worker, shared = _jobs[0]
+  return worker(shared, item)
+
+def fork_map(worker, items, processes, shared=None):
+  """[worker(shared, item) for item in items] over up to processes forked workers"""
+  items = list(items)
+  processes = min(processes, len(items))
+  if processes <= 1 or not fork_allowed():
+    return [worker(shared, item) for item in items]
+  import multiprocessing
+  context = multiprocessing.get_context("fork")
+  _jobs[:] = [(worker, shared)] # inherited by the children at fork
+  try:
+    pool = context.Pool(processes=processes)
+    try:
+      return pool.map(_run, items, chunksize=1)
+    finally:
+      pool.close(); pool.join()
+  finally:
+    _jobs[:] = []
@@ -0,0 +1,128 @@
+from __future__ import division, print_function
+from time import time
+
+"""Image schedulers for the batch simulation drivers.
+
+The drivers historically gave each rank a fixed round-robin parcel of image indices.
+With uneven per-image cost that leaves long tails (see adse13_196/weather.py), so the
+dynamic queues here hand out the next image index (or a small chunk of them) to
+whichever rank asks first.  All queues are iterables of image indices:
+
+  static_queue        legacy round-robin parcel, no communication
+  mpi_queue           shared counter in an MPI one-sided window on rank 0; ranks
+                      fetch-and-add to claim work, so rank 0 also simulates
+  shared_counter_queue
+                      the same protocol on a multiprocessing.Value, for local runs and
+                      for testing without MPI (see run_local)
+
+An optional cost(idx) estimate orders the work largest-first, which shortens the tail.
+Each queue records the time spent waiting for work in self.wait_time.
+"""
+
+def schedule_order(N_total, cost=None):
+  if cost is None: return list(range(N_total))
+  return sorted(range(N_total), key=lambda idx: -cost(idx))
+
+class work_queue_base(object):
+  def __init__(self, N_total, chunk=1, cost=None):
+    self.N_total = N_total
+    self.chunk = chunk
+    self.order = schedule_order(N_total, cost)
+    self.wait_time = 0.
+    self.n_claimed = 0
+
+  def claim(self):
+    """Return the start position of the next unclaimed chunk"""
+    raise NotImplementedError
+
+  def next_chunk(self):
+    t0 = time()
+    position = self.claim()
+    self.wait_time += time() - t0
+    chunk = self.order[position:position+self.chunk]
+    self.n_claimed += len(chunk)
+    return chunk
+
+  def free(self):
+    """Release shared resources; collective for mpi_queue, so every rank calls it"""
+    pass
+
+  def __iter__(self):
+    while True:
+      chunk = self.next_chunk()
+      if len(chunk) == 0: return
+      for idx in chunk:
+        yield idx
+
+class static_queue(work_queue_base):
+  def __init__(self, rank, size, N_total, chunk=1, cost=None):
+    work_queue_base.__init__(self, N_total, chunk=chunk, cost=cost)
+    self.position = rank * chunk
+    self.stride = size * chunk
+  def claim(self):
+    position = self.position
+    self.position += self.stride
+    return position
+
+class mpi_queue(work_queue_base):
+  def __init__(self, comm, MPI, N_total, chunk=1, cost=None):
+    work_queue_base.__init__(self, N_total, chunk=chunk, cost=cost)
+    import numpy as np
+    self.MPI = MPI
+    self.rank = comm.Get_rank()
+    self._counter = np.zeros(1 if self.rank == 0 else 0, dtype=np.int64)
+    self._increment = np.array([chunk], dtype=np.int64)
+    self._result = np.zeros(1, dtype=np.int64)
+    self.win = MPI.Win.Create(self._counter, disp_unit=8, comm=comm)
+    comm.barrier()
+  def claim(self):
+    self.win.Lock(0, self.MPI.LOCK_SHARED)
+    self.win.Fetch_and_op(self._increment, self._result, 0, 0, self.MPI.SUM)
+    self.win.Unlock(0)
+    return int(self._result[0])
+  def free(self):
+    self.win.Free() # collective: an un-freed window at MPI_Finalize is erroneous
+
+class shared_counter_queue(work_queue_base):
+  def __init__(self, counter, N_total, chunk=1, cost=None):
+    work_queue_base.__init__(self, N_total, chunk=chunk, cost=cost)
+    self.counter = counter # a multiprocessing.Value("q")
+  def claim(self):
+    with self.counter.get_lock():
+      position = self.counter.value
+      self.counter.value += self.chunk
+    return position
+
+def make_queue(method, comm, N_total, chunk=1, cost=None, MPI=None):
+  """Queue for a batch driver.  method is "static" or "dynamic"; dynamic falls back to
+  static when only one rank is running or the MPI module has no one-sided support."""
+  rank = comm.Get_rank(); size = comm.Get_size()
+  if method == "dynamic" and size > 1 and hasattr(MPI, "Win"):
+    return mpi_queue(comm, MPI, N_total, chunk=chunk, cost=cost)
+  assert method in ["static", "dynamic"]
+  return static_queue(rank, size, N_total, chunk=chunk, cost=cost)
+
+def _local_worker(worker, counter, N_total, chunk, cost, rank, results):
+  Q = shared_counter_queue(counter, N_total, chunk=chunk, cost=cost)
+  done = []
+  for idx in Q:
+    worker(idx, rank)
+    done.append(idx)
+  results.put((rank, done, Q.wait_time))
+
+def run_local(worker, N_total, nproc, chunk=1, cost=None):
+  """Run worker(idx, rank) over all images with nproc local processes drawing from a
+  shared counter.  Returns {rank: (list of processed indices, seconds waiting)}."""
+  import multiprocessing
+  counter = multiprocessing.Value("q", 0)
+  results = multiprocessing.Queue()
+  processes = [multiprocessing.Process(target=_local_worker,
+               args=(worker, counter, N_total, chunk, cost, rank, results))
+               for rank in range(nproc)]
+  for P in processes: P.start()
+  report = {}
+  for P in processes:
+    rank, done, wait_time = results.get()
+    report[rank] = (done, wait_time)
+  for P in processes: P.join()
+  return report
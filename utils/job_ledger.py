@@ -0,0 +1,127 @@
+from __future__ import division, print_function
+import os
+import json
+import glob
+import hashlib
+
+"""Crash-safe, resumable ledger for batch simulation campaigns.
+
+Restarting a campaign used to rely on write_safe(), a per-file existence check: a
+half-written .img.gz counted as done, and every restart stat'ed every output file.
+Instead, each rank appends one JSON line per finished image to its own file in the
+ledger directory,
+
+  {"idx": 123, "input": <input hash>, "outputs": {<path>: [<sha256>, <bytes>]},
+   "rows": [[<container path>, <row>, <sha256 of the row>]]}
+
+flushed and fsync'ed after the output has been atomically renamed into place (see
+atomic_output), so a ledger entry implies a complete file.  A restart reads the
+ledger once; images missing from it, recorded with a different input hash, or (with
+verify=True) whose outputs no longer match their checksums are simulated again.
+A torn last line from a crash is ignored, and terminated before the next record.
+
+Enable in the batch drivers with JOB_LEDGER=<directory> (JOB_LEDGER_VERIFY=1 to
+re-checksum outputs of images already in the ledger).
+"""
+
+def input_hash(*items):
+  H = hashlib.sha256()
+  for item in items:
+    H.update(str(item).encode())
+    H.update(b"\0")
+  return H.hexdigest()
+
+def file_checksum(path, blocksize=1<<20):
+  H = hashlib.sha256()
+  with open(path, "rb") as F:
+    while True:
+      block = F.read(blocksize)
+      if not block: break
+      H.update(block)
+  return H.hexdigest()
+
+class atomic_output(object):
+  """Context manager giving a temporary name for a writer to use in place of fileout.
+  On success the temporary file (or temporary.gz, for writers that append the suffix
+  themselves) is renamed to fileout (fileout.gz); self.written lists the final paths."""
+  def __init__(self, fileout):
+    self.fileout = fileout
+    dirname, basename = os.path.split(fileout)
+    self.tmp = os.path.join(dirname, ".%s.%d.tmp"%(basename, os.getpid()))
+    self.written = []
+  def __enter__(self):
+    return self
+  def __exit__(self, exc_type, exc_value, traceback):
+    for suffix in ["", ".gz"]:
+      if not os.path.isfile(self.tmp + suffix): continue
+      if exc_type is None:
+        os.rename(self.tmp + suffix, self.fileout + suffix)
+        self.written.append(self.fileout + suffix)
+      else:
+        os.remove(self.tmp + suffix)
+    return False
+
+class job_ledger(object):
+  def __init__(self, ledger_dir, rank=0):
+    self.ledger_dir = ledger_dir
+    if not os.path.isdir(ledger_dir):
+      try: os.makedirs(ledger_dir)
+      except OSError: pass # another rank got there first
+    self.path = os.path.join(ledger_dir, "rank_%05d.jsonl"%rank)
+    self.records = {}
+
+  def load(self):
+    """Read every rank's ledger file; a later record of the same image wins"""
+    records = {}
+    for path in sorted(glob.glob(os.path.join(self.ledger_dir, "rank_*.jsonl"))):
+      with open(path, "r") as F:
+        for line in F:
+          try: record = json.loads(line)
+          except ValueError: continue # torn write at a crash
+          records[record["idx"]] = record
+    self.records = records
+    return records
+
+  def verify(self, record):
+    for path, (checksum, nbytes) in record["outputs"].items():
+      if not os.path.isfile(path) or os.path.getsize(path) != nbytes: return False
+      if file_checksum(path) != checksum: return False
+    if len(record.get("rows", [])) > 0:
+      from LS49.sim.image_container import verify_row
+      for path, row, checksum in record["rows"]:
+        if not verify_row(path, row, record["idx"], checksum): return False
+    return True
+
+  def is_complete(self, idx, input_hash, verify=False):
+    record = self.records.get(idx)
+    if record is None or record["input"] != input_hash: return False
+    if verify and not self.verify(record): return False
+    return True
+
+  def record(self, idx, input_hash, outputs):
+    """outputs: file paths, or (container path, row, checksum) for images stored in an
+    image container (see image_container.row_output)"""
+    record = dict(idx=idx, input=input_hash,
+                  outputs=dict([(path, [file_checksum(path), os.path.getsize(path)])
+                                for path in outputs if not isinstance(path, tuple)]),
+                  rows=[list(row) for row in outputs if isinstance(row, tuple)])
+    with open(self.path, "ab+") as F:
+      # after a crash the file may end in a torn line; terminate it, or this record
+      # would be glued to it and lost at load() as well
+      F.seek(0, os.SEEK_END)
+      if F.tell() > 0:
+        F.seek(-1, os.SEEK_END)
+        if F.read(1) != b"\n": F.write(b"\n")
+      F.write((json.dumps(record) + "\n").encode())
+      F.flush()
+      os.fsync(F.fileno())
+    self.records[idx] = record
+
+def campaign_ledger(comm):
+  """Ledger for this rank if JOB_LEDGER is exported, else None; rank 0 reads and broadcasts"""
+  ledger_dir = os.environ.get("JOB_LEDGER")
+  if ledger_dir is None: return None
+  ledger = job_ledger(ledger_dir, rank=comm.Get_rank())
+  records = ledger.load() if comm.Get_rank() == 0 else None
+  ledger.records = comm.bcast(records, root=0)
+  return ledger
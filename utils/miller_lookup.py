@@ -0,0 +1,142 @@
+from __future__ import division, print_function
+import numpy as np
+
+"""Vectorised Miller index -> table row lookup.
+
+HKL_lookup and the intensity dictionaries were Python dicts keyed by (h,k,l) tuples,
+built and queried one reflection at a time, and pickled into the starting models at
+a few hundred bytes per reflection.  Here each index is packed into one 64-bit key,
+
+  key = (h + 2**20) << 42 | (k + 2**20) << 21 | (l + 2**20)
+
+the keys are sorted once, and a whole list of indices is resolved with one
+numpy.searchsorted.  miller_lookup keeps the dict interface (lookup[hkl] -> row,
+hkl in lookup, iteration in row order) so it drops in for HKL_lookup, and pickles as
+two int arrays; miller_table adds a value per row, for the intensity dictionaries.
+
+  lookup = miller_lookup(fmodel.indices())
+  rows = lookup.rows([spot.simtbx_P1_miller for spot in image])  # -1 where absent
+
+Scalar access (lookup[hkl], get, in) goes through a {key: row} dict built on first use,
+so per-reflection loops cost one dict probe rather than a numpy call each.
+"""
+
+OFFSET = 1 << 20
+MASK = (1 << 21) - 1
+
+def as_index_array(indices):
+  """(N,3) int64 array from a flex.miller_index, a sequence of 3-tuples or an array"""
+  if hasattr(indices, "as_vec3_double"):
+    indices = indices.as_vec3_double().as_double().as_numpy_array()
+  array = np.asarray(indices, dtype=np.int64)
+  return array.reshape(-1,3)
+
+def pack(indices):
+  array = as_index_array(indices) + OFFSET
+  assert array.size == 0 or (array.min() >= 0 and array.max() <= MASK), "Miller index out of range"
+  return (array[:,0] << 42) | (array[:,1] << 21) | array[:,2]
+
+def pack_one(hkl):
+  """pack() of a single index, in plain Python"""
+  h, k, l = [int(i) + OFFSET for i in hkl]
+  assert 0 <= min(h, k, l) and max(h, k, l) <= MASK, "Miller index out of range"
+  return (h << 42) | (k << 21) | l
+
+def unpack(keys):
+  keys = np.asarray(keys, dtype=np.int64)
+  return np.column_stack(((keys >> 42) & MASK, (keys >> 21) & MASK, keys & MASK)) - OFFSET
+
+class miller_lookup(object):
+  def __init__(self, indices=()):
+    self._set_keys(pack(indices))
+
+  def _set_keys(self, keys):
+    self.keys_by_row = keys
+    self.order = np.argsort(keys, kind="mergesort")
+    self.sorted_keys = keys[self.order]
+    assert len(self.sorted_keys) < 2 or (np.diff(self.sorted_keys) > 0).all(), "duplicate Miller index"
+    self._row_of_key = None # scalar-access dict, built on first use
+
+  def _scalar_row(self, hkl):
+    if self._row_of_key is None:
+      self._row_of_key = dict(zip(self.keys_by_row.tolist(), range(len(self.keys_by_row))))
+    return self._row_of_key.get(pack_one(hkl), -1)
+
+  @classmethod
+  def from_dict(cls, HKL_lookup):
+    """From an old-style {hkl: row} dict, as in starting models pickled before"""
+    hkls = [None] * len(HKL_lookup)
+    for hkl, row in HKL_lookup.items(): hkls[row] = hkl
+    return cls(hkls)
+
+  def rows(self, indices, missing=-1):
+    """Table rows of all indices at once, as an int64 array; missing where absent"""
+    keys = pack(indices)
+    position = np.searchsorted(self.sorted_keys, keys)
+    position[position == len(self.sorted_keys)] = 0
+    found = len(self.sorted_keys) > 0
+    result = np.where(self.sorted_keys[position] == keys, self.order[position], missing) \
+             if found else np.full(len(keys), missing, dtype=np.int64)
+    return result
+
+  def __len__(self):
+    return len(self.keys_by_row)
+
+  def __getitem__(self, hkl):
+    row = self._scalar_row(hkl)
+    if row < 0: raise KeyError(hkl)
+    return row
+
+  def get(self, hkl, default=None):
+    row = self._scalar_row(hkl)
+    return default if row < 0 else row
+
+  def __contains__(self, hkl):
+    return self._scalar_row(hkl) >= 0
+
+  def indices(self):
+    """(N,3) array in row order"""
+    return unpack(self.keys_by_row)
+
+  def __iter__(self):
+    for hkl in self.indices().tolist(): yield tuple(hkl)
+
+  def keys(self):
+    return list(self)
+
+  def __getstate__(self):
+    return dict(keys_by_row=self.keys_by_row)
+
+  def __setstate__(self, state):
+    self._set_keys(state["keys_by_row"])
+
+class miller_table(miller_lookup):
+  """miller_lookup with one value per row: a dict {hkl: value} replacement"""
+  def __init__(self, indices=(), data=()):
+    miller_lookup.__init__(self, indices)
+    self.data = data
+    assert len(self.data) == len(self)
+
+  @classmethod
+  def from_array(cls, miller_array):
+    return cls(miller_array.indices(), miller_array.data())
+
+  def __getitem__(self, hkl):
+    return self.data[miller_lookup.__getitem__(self, hkl)]
+
+  def get(self, hkl, default=None):
+    row = miller_lookup.get(self, hkl)
+    return default if row is None else self.data[row]
+
+  def values(self):
+    return list(self.data)
+
+  def items(self):
+    return zip(self, self.data)
+
+  def __getstate__(self):
+    return dict(keys_by_row=self.keys_by_row, data=self.data)
+
+  def __setstate__(self, state):
+    self._set_keys(state["keys_by_row"])
+    self.data = state["data"]
@@ -44,11 +44,9 @@ def reproduce_C2_model(resolution,**kwargs):
   GF.reset_specific_at_wavelength(label_has="FE1",tables=Fe_oxidized_model,newvalue=W2)
   GF.reset_specific_at_wavelength(label_has="FE2",tables=Fe_reduced_model,newvalue=W2)
   sfall = GF.get_amplitudes()
-  sfallf = sfall.data(); sfallidx = sfall.indices()
-  intensities = {}
-  for N in range(len(sfallidx)):
-    intensities[sfallidx[N]]=sfallf[N] * sfallf[N]
-  return intensities
+  sfallf = sfall.data()
+  from LS49.utils.miller_lookup import miller_table
+  return miller_table(sfall.indices(), sfallf * sfallf)
 
 if __name__=="__main__":
 
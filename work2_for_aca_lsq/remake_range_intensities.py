@@ -39,11 +39,8 @@ def remake_intensities_at_energy(energy,FE1_model,FE2_model):
   #    buried irons, FE1, in Fe(III) state (absorption at higher energy, oxidized)
   #    surface iron, FE2, in Fe(II) state (absorption at lower energy, reduced)
 
-  W2i = W2_reduced.indices()
-  intensity_dict = {}
-  for iw in range(len(W2i)):
-    intensity_dict[W2_reduced.indices()[iw]] = W2_reduced.data()[iw]
-  return intensity_dict
+  from LS49.utils.miller_lookup import miller_table
+  return miller_table.from_array(W2_reduced)
 
 if __name__=="__main__":
 
@@ -57,16 +54,18 @@ if __name__=="__main__":
     print ("%d keys in initial"%len(initial))
 
     result = {}
-    for key in initial:
+    keys = initial.keys()
+    for key in keys:
       result[key] = flex.double()
     print (filename)
     for incr in range(100):
       energy = 7070.5 + incr
       more = remake_intensities_at_energy(energy,FE1,FE2)
       print (energy, "with %d keys"%(len(more)))
-      for key in more:
-        if key in initial:
-          result[key].append(more[key])
+      # rows of more for every key of initial, in one lookup
+      for key,row in zip(keys,more.rows(initial.indices())):
+        if row >= 0:
+          result[key].append(more.data[int(row)])
     exit()
     with (open(filename,"wb")) as F:
       pickle.dump(result, F, pickle.HIGHEST_PROTOCOL)
@@ -47,17 +47,9 @@ class gen_fmodel_with_complex(gen_fmodel):
     CS = cls()
     wavelength = 12398.425/float(energy)
     # take a detour to insist on calculating anomalous contribution of every atom
-    scatterers = xray_structure.scatterers()
     print ("from structure",energy)
-
-    for sc in scatterers:
-
-      from cctbx.eltbx import sasaki, henke
-      #expected_sasaki = sasaki.table(sc.element_symbol()).at_angstrom(wavelength)
-      expected_henke = henke.table(sc.element_symbol()).at_angstrom(wavelength)
-      #print (  sc.element_symbol(), expected_henke.fp(),expected_henke.fdp())
-      sc.fp = expected_henke.fp()
-      sc.fdp = expected_henke.fdp()
+    from LS49.sim.scattering_factors import henke_service
+    henke_service.apply(xray_structure, wavelength)
     CS.xray_structure = xray_structure
     CS.energy = energy
     return CS
@@ -155,9 +147,8 @@ class george_sherrell_proxy(object):
   def fp_fdp_at_wavelength(self,angstroms):
     return self.fp, self.fdp
 
-def get_C2_structures():
-  # section 1. C2 models.  a) whole pdb, b) no Fe, c) FE1 only, d) FE2 only
-  pdb_text = local_data.get("pdb_lines")# parsing PDB structure 1M2A
+def C2_texts(pdb_text):
+  # a) whole pdb, b) no Fe, c) FE1 only, d) FE2 only
   tokens = pdb_text.split("\n")
   btokens = []; ctokens = []; dtokens = []
   for token in tokens:
@@ -171,18 +162,18 @@ def get_C2_structures():
       if splits[2]=="FE1": ctokens.append(token); continue
       if splits[2]=="FE2": dtokens.append(token); continue
     ctokens.append(token); dtokens.append(token)
-  pdb_text_b = "\n".join(btokens); print (len(tokens),len(btokens),len(ctokens),len(dtokens))
-  pdb_text_c = "\n".join(ctokens);
-  pdb_text_d = "\n".join(dtokens);
-  from iotbx import pdb
-  C2_structures = []
-  for tag,lines in zip(["pdb_text", "pdb_text_b", "pdb_text_c", "pdb_text_d"],
-                       [pdb_text, pdb_text_b, pdb_text_c, pdb_text_d]):
-    pdb_inp = pdb.input(source_info=None,lines = lines)
-    xray_structure = pdb_inp.xray_structure_simple()
-    xray_structure.show_summary(prefix="%s "%tag)
-    C2_structures.append(xray_structure)
-  return C2_structures
+  print (len(tokens),len(btokens),len(ctokens),len(dtokens))
+  return dict(pdb_text=pdb_text, pdb_text_b="\n".join(btokens),
+              pdb_text_c="\n".join(ctokens), pdb_text_d="\n".join(dtokens))
+
+def get_C2_structures():
+  # section 1. C2 models.  a) whole pdb, b) no Fe, c) FE1 only, d) FE2 only
+  # parsed once per process by the registry; each call gets fresh copies
+  from LS49.sim.structure_registry import registry
+  pdb_text = local_data.get("pdb_lines")# parsing PDB structure 1M2A
+  return [registry.xray_structure(pdb_text, selection=tag,
+                                  selector=lambda text,tag=tag: C2_texts(text)[tag])
+          for tag in ["pdb_text", "pdb_text_b", "pdb_text_c", "pdb_text_d"]]
 
 def test_fmodel_stuff(energy,FE1_model,FE2_model):
   # section 1. C2 models.  a) whole pdb, b) no Fe, c) FE1 only, d) FE2 only
@@ -508,10 +499,12 @@ def get_static_fcalcs():
     # the energy-dependent portion of the calculation that is not dependent on the iron model.
     return result
 
-def get_intensity_structure(base,FE1_model,FE2_model):
-  """Now used stuff learned from test_fmodel_stuff to calculate new data structure for use
-     in the program.
-  """
+_intensity_structure_context = []
+def intensity_structure_context():
+  """Miller set and the FE1-only, FE2-only direct-summation models common to every call of
+  get_intensity_structure.  None of it depends on the Fe models, which are reset per channel,
+  so it is set up once per process."""
+  if len(_intensity_structure_context) > 0: return _intensity_structure_context[0]
   # generate the list of all HKL to be used throughout.
   C2_structures = get_C2_structures()
 
@@ -521,11 +514,6 @@ def get_intensity_structure(base,FE1_model,FE2_model):
   GF_whole7070 = GF_whole7070.as_P1_primitive()
   f_container7070 = GF_whole7070.get_fmodel()
   Fmodel_whole7070 = f_container7070.f_model
-  Fmodel_indices = Fmodel_whole7070.indices() # common structure defines the indices
-  MS = Fmodel_whole7070.set() # avoid having to repeatedly calculate indices
-  CS = Fmodel_whole7070.crystal_symmetry() # same here
-
-  result = flex.double(flex.grid((Fmodel_indices.size(),500)))
 
   GF_FE1 = gen_fmodel_with_complex.from_structure(C2_structures[2],energy
            ).from_parameters(algorithm="direct")
@@ -533,94 +521,124 @@ def get_intensity_structure(base,FE1_model,FE2_model):
   GF_FE2 = gen_fmodel_with_complex.from_structure(C2_structures[3],energy
            ).from_parameters(algorithm="direct")
   GF_FE2 = GF_FE2.as_P1_primitive()
+  _intensity_structure_context.append(dict(
+    Fmodel_indices = Fmodel_whole7070.indices(), # common structure defines the indices
+    MS = Fmodel_whole7070.set(), # avoid having to repeatedly calculate indices
+    CS = Fmodel_whole7070.crystal_symmetry(), # same here
+    d_min = GF_whole7070.params2.high_resolution,
+    GF_FE1 = GF_FE1, GF_FE2 = GF_FE2))
+  return _intensity_structure_context[0]
+
+def intensity_structure_channel(base,FE1_model,FE2_model,incr):
+  """Columns incr, incr+100, ..., incr+400 of the get_intensity_structure table, i.e.
+  I_H and its derivatives wrt fp(FE1), fdp(FE1), fp(FE2), fdp(FE2) for one energy channel"""
+  context = intensity_structure_context()
+  Fmodel_indices = context["Fmodel_indices"]
+  MS = context["MS"]; CS = context["CS"]
+  GF_FE1 = context["GF_FE1"]; GF_FE2 = context["GF_FE2"]
+  columns = []
+  print ("incr is",incr)
+  energy = 7070.5 + incr
 
-  for incr in range(100):
-    print ("incr is",incr)
-    energy = 7070.5 + incr
-
-    GF_FE1.reset_specific_at_energy(label_has="FE1",tables=FE1_model,newvalue=energy)
-    # not sure if I need this, takes a lot of time # f_container = GF_FE1.get_fmodel()
-    # not sure if I need this, takes a lot of time # Fcalc_FE1 = f_container.fmodel.f_calc()
+  GF_FE1.reset_specific_at_energy(label_has="FE1",tables=FE1_model,newvalue=energy)
+  # not sure if I need this, takes a lot of time # f_container = GF_FE1.get_fmodel()
+  # not sure if I need this, takes a lot of time # Fcalc_FE1 = f_container.fmodel.f_calc()
 
-    GF_FE2.reset_specific_at_energy(label_has="FE2",tables=FE2_model,newvalue=energy)
-    # not sure if I need this, takes a lot of time # f_container = GF_FE2.get_fmodel()
-    # not sure if I need this, takes a lot of time # Fcalc_FE2 = f_container.fmodel.f_calc()
+  GF_FE2.reset_specific_at_energy(label_has="FE2",tables=FE2_model,newvalue=energy)
+  # not sure if I need this, takes a lot of time # f_container = GF_FE2.get_fmodel()
+  # not sure if I need this, takes a lot of time # Fcalc_FE2 = f_container.fmodel.f_calc()
 
-    ALGO = structure_factors.from_scatterers(crystal_symmetry=CS,
-                                             d_min=GF_whole7070.params2.high_resolution)
-    #hack cctbx/xray/structure_factors/structure_factors_direct.h
-    """
+  ALGO = structure_factors.from_scatterers(crystal_symmetry=CS,
+                                           d_min=context["d_min"])
+  #hack cctbx/xray/structure_factors/structure_factors_direct.h
+  """
 /*#if !defined(CCTBX_XRAY_STRUCTURE_FACTORS_DIRECT_NO_PRAGMA_OMP)
 #if !defined(__DECCXX_VER) || (defined(_OPENMP) && _OPENMP > 199819)
-        #pragma omp parallel for schedule(static)
+      #pragma omp parallel for schedule(static)
 #endif
 #endif
 */
-        #pragma omp parallel for
-    """
-    from_scatterers_direct_fe1 = ALGO(xray_structure=GF_FE1.xray_structure,
-                                      miller_set=MS,algorithm="direct")
-    Fcalc_FE1_dir = from_scatterers_direct_fe1.f_calc().data()
-    from_scatterers_direct_fe2 = ALGO(xray_structure=GF_FE2.xray_structure,
-                                      miller_set=MS,algorithm="direct")
-    Fcalc_FE2_dir = from_scatterers_direct_fe2.f_calc().data()
-
-    # Get total Fcalc at energy:
-    F_bulk_non_Fe = base.matrix_copy_block(i_row=0,i_column=incr,
-                    n_rows=Fmodel_indices.size(),n_columns=1)
-    Fcalc_FE1_dir.reshape(flex.grid((Fmodel_indices.size(),1)))
-    Fcalc_FE2_dir.reshape(flex.grid((Fmodel_indices.size(),1)))
-    Fcalc_total = F_bulk_non_Fe + Fcalc_FE1_dir + Fcalc_FE2_dir
-
-    result.matrix_paste_block_in_place(flex.norm(Fcalc_total),0,incr) # gives I = F * F
-
-    gradient_flags=xray.structure_factors.gradient_flags(
-      site=False,
-      u_iso=False,
-      u_aniso=False,
-      occupancy=False,
-      fp=True,
-      fdp=True)
-    xray.set_scatterer_grad_flags(scatterers = GF_FE1.xray_structure.scatterers(),
-                                site       = gradient_flags.site,
-                                u_iso      = gradient_flags.u_iso,
-                                u_aniso    = gradient_flags.u_aniso,
-                                occupancy  = gradient_flags.occupancy,
-                                fp         = gradient_flags.fp,
-                                fdp        = gradient_flags.fdp)
-    xray.set_scatterer_grad_flags(scatterers = GF_FE2.xray_structure.scatterers(),
-                                site       = gradient_flags.site,
-                                u_iso      = gradient_flags.u_iso,
-                                u_aniso    = gradient_flags.u_aniso,
-                                occupancy  = gradient_flags.occupancy,
-                                fp         = gradient_flags.fp,
-                                fdp        = gradient_flags.fdp)
+      #pragma omp parallel for
+  """
+  from_scatterers_direct_fe1 = ALGO(xray_structure=GF_FE1.xray_structure,
+                                    miller_set=MS,algorithm="direct")
+  Fcalc_FE1_dir = from_scatterers_direct_fe1.f_calc().data()
+  from_scatterers_direct_fe2 = ALGO(xray_structure=GF_FE2.xray_structure,
+                                    miller_set=MS,algorithm="direct")
+  Fcalc_FE2_dir = from_scatterers_direct_fe2.f_calc().data()
 
-    #hack cctbx/xray/structure_factors/each_hkl_gradients_direct.h
-    #pragma omp parallel for (line 226)
-    sf1 = xray.ext.each_hkl_gradients_direct(
-    MS.unit_cell(), MS.space_group(), MS.indices(), GF_FE1.xray_structure.scatterers(), None,
-    GF_FE1.xray_structure.scattering_type_registry(), GF_FE1.xray_structure.site_symmetry_table(),
-    0)
-    sf2 = xray.ext.each_hkl_gradients_direct(
-    MS.unit_cell(), MS.space_group(), MS.indices(), GF_FE2.xray_structure.scatterers(), None,
-    GF_FE2.xray_structure.scattering_type_registry(), GF_FE2.xray_structure.site_symmetry_table(),
-    0)
+  # Get total Fcalc at energy:
+  F_bulk_non_Fe = base.matrix_copy_block(i_row=0,i_column=incr,
+                  n_rows=Fmodel_indices.size(),n_columns=1)
+  Fcalc_FE1_dir.reshape(flex.grid((Fmodel_indices.size(),1)))
+  Fcalc_FE2_dir.reshape(flex.grid((Fmodel_indices.size(),1)))
+  Fcalc_total = F_bulk_non_Fe + Fcalc_FE1_dir + Fcalc_FE2_dir
 
-    sf1.d_fcalc_d_fp().reshape(flex.grid((Fmodel_indices.size(),1)))
-    sf1.d_fcalc_d_fdp().reshape(flex.grid((Fmodel_indices.size(),1)))
-    sf2.d_fcalc_d_fp().reshape(flex.grid((Fmodel_indices.size(),1)))
-    sf2.d_fcalc_d_fdp().reshape(flex.grid((Fmodel_indices.size(),1)))
-    parts = Fcalc_total.parts()
-    A = parts[0]
-    B = parts[1]
-    for offset,vec2 in zip([100,200,300,400],
-      [sf1.d_fcalc_d_fp(),sf1.d_fcalc_d_fdp(),sf2.d_fcalc_d_fp(),sf2.d_fcalc_d_fdp()]):
-      vparts = vec2.parts()
-      vA = vparts[0]
-      vB = vparts[1]
-      partial_I_partial_q = 2. * (A * vA + B * vB)
-      result.matrix_paste_block_in_place(partial_I_partial_q,0,incr + offset)
+  columns.append(flex.norm(Fcalc_total)) # gives I = F * F
+
+  gradient_flags=xray.structure_factors.gradient_flags(
+    site=False,
+    u_iso=False,
+    u_aniso=False,
+    occupancy=False,
+    fp=True,
+    fdp=True)
+  xray.set_scatterer_grad_flags(scatterers = GF_FE1.xray_structure.scatterers(),
+                              site       = gradient_flags.site,
+                              u_iso      = gradient_flags.u_iso,
+                              u_aniso    = gradient_flags.u_aniso,
+                              occupancy  = gradient_flags.occupancy,
+                              fp         = gradient_flags.fp,
+                              fdp        = gradient_flags.fdp)
+  xray.set_scatterer_grad_flags(scatterers = GF_FE2.xray_structure.scatterers(),
+                              site       = gradient_flags.site,
+                              u_iso      = gradient_flags.u_iso,
+                              u_aniso    = gradient_flags.u_aniso,
+                              occupancy  = gradient_flags.occupancy,
+                              fp         = gradient_flags.fp,
+                              fdp        = gradient_flags.fdp)
+
+  #hack cctbx/xray/structure_factors/each_hkl_gradients_direct.h
+  #pragma omp parallel for (line 226)
+  sf1 = xray.ext.each_hkl_gradients_direct(
+  MS.unit_cell(), MS.space_group(), MS.indices(), GF_FE1.xray_structure.scatterers(), None,
+  GF_FE1.xray_structure.scattering_type_registry(), GF_FE1.xray_structure.site_symmetry_table(),
+  0)
+  sf2 = xray.ext.each_hkl_gradients_direct(
+  MS.unit_cell(), MS.space_group(), MS.indices(), GF_FE2.xray_structure.scatterers(), None,
+  GF_FE2.xray_structure.scattering_type_registry(), GF_FE2.xray_structure.site_symmetry_table(),
+  0)
+
+  sf1.d_fcalc_d_fp().reshape(flex.grid((Fmodel_indices.size(),1)))
+  sf1.d_fcalc_d_fdp().reshape(flex.grid((Fmodel_indices.size(),1)))
+  sf2.d_fcalc_d_fp().reshape(flex.grid((Fmodel_indices.size(),1)))
+  sf2.d_fcalc_d_fdp().reshape(flex.grid((Fmodel_indices.size(),1)))
+  parts = Fcalc_total.parts()
+  A = parts[0]
+  B = parts[1]
+  for vec2 in [sf1.d_fcalc_d_fp(),sf1.d_fcalc_d_fdp(),sf2.d_fcalc_d_fp(),sf2.d_fcalc_d_fdp()]:
+    vparts = vec2.parts()
+    vA = vparts[0]
+    vB = vparts[1]
+    partial_I_partial_q = 2. * (A * vA + B * vB)
+    columns.append(partial_I_partial_q)
+
+  return columns
+
+def paste_intensity_structure_channels(result,channels):
+  for incr,columns in channels:
+    for offset,column in zip([0,100,200,300,400],columns):
+      column.reshape(flex.grid((column.size(),1))) # grid may be lost in pickling
+      result.matrix_paste_block_in_place(column,0,incr + offset)
+
+def get_intensity_structure(base,FE1_model,FE2_model):
+  """Now used stuff learned from test_fmodel_stuff to calculate new data structure for use
+     in the program.
+  """
+  Fmodel_indices = intensity_structure_context()["Fmodel_indices"]
+  result = flex.double(flex.grid((Fmodel_indices.size(),500)))
+  paste_intensity_structure_channels(result,
+    [(incr,intensity_structure_channel(base,FE1_model,FE2_model,incr)) for incr in range(100)])
 
   # result holds a table of structure factor intensities.  Rows are Miller indices H.
   # First 100 columns are I_H(energy, 100 channels). The next four groups of 100 columns
@@ -629,6 +647,44 @@ def get_intensity_structure(base,FE1_model,FE2_model):
   # the energy-dependent portion of the calculation that is dependent on the iron model.
   return result
 
+def _intensity_structure_worker(models,incr):
+  # runs in a forked process: the context comes with the parent's memory
+  base,FE1_model,FE2_model = models
+  return incr,intensity_structure_channel(base,FE1_model,FE2_model,incr)
+
+def get_intensity_structure_distributed(base,FE1_model,FE2_model,comm=None,nproc=1):
+  """Same table as get_intensity_structure, with the 100 energy channels dealt round-robin
+  to the ranks of comm (every rank must call this) and, within a rank, to nproc forked
+  processes (utils/fork_pool: serial inside an MPI rank unless FORK_UNDER_MPI=1).
+  Each channel is computed exactly as in the serial version, so the assembled table
+  is identical.  Returns the table on every rank, and prints the time each rank spent
+  computing and waiting at the allgather."""
+  import time
+  start = time.time()
+  rank = 0 if comm is None else comm.Get_rank()
+  size = 1 if comm is None else comm.Get_size()
+  Fmodel_indices = intensity_structure_context()["Fmodel_indices"]
+  my_channels = list(range(rank,100,size))
+  from LS49.utils.fork_pool import fork_map
+  channels = fork_map(_intensity_structure_worker,my_channels,nproc,
+                      shared=(base,FE1_model,FE2_model))
+  compute_time = time.time() - start
+  if comm is not None:
+    gathered = comm.allgather(channels)
+    channels = [channel for rank_channels in gathered for channel in rank_channels]
+  wait_time = time.time() - start - compute_time
+  result = flex.double(flex.grid((Fmodel_indices.size(),500)))
+  paste_intensity_structure_channels(result,channels)
+  assert len(channels) == 100
+  timing = (rank,len(my_channels),compute_time,wait_time)
+  timings = [timing] if comm is None else comm.allgather(timing)
+  if rank == 0:
+    print("intensity structure over %d ranks: compute %.2f-%.2fs, "
+          "wait at allgather max %.2fs, total %.2fs"%(
+      size, min([t[2] for t in timings]), max([t[2] for t in timings]),
+      max([t[3] for t in timings]), time.time() - start))
+  return result
+
 class special_proxy(george_sherrell_proxy):
     def __init__(self,switch): self.switch=switch
     def fp_fdp_at_wavelength(self,angstroms):
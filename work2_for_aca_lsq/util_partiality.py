@@ -25,7 +25,11 @@ with (open("confirm_sfall_P1_7122_amplitudes.pickle","rb")) as F:
 def channel_pixels(ROI,wavelength_A,flux,N,UMAT_nm,Amatrix_rot,fmodel_generator,output):
   local_data = data()
   energy_dependent_fmodel=False
-  if energy_dependent_fmodel:
+  from LS49.sim.sf_channel_cache import channel_cache
+  sf_cache = channel_cache(local_data)
+  if energy_dependent_fmodel and sf_cache is not None:
+    sfall_channel = sf_cache.amplitudes(fmodel_generator, wavelength_A)
+  elif energy_dependent_fmodel:
     fmodel_generator.reset_wavelength(wavelength_A)
     fmodel_generator.reset_specific_at_wavelength(
                    label_has="FE1",tables=local_data.get("Fe_oxidized_model"),newvalue=wavelength_A)
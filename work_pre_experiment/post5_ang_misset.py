@@ -12,22 +12,33 @@ import os
 #json_glob = "/net/dials/raid1/sauter/LS49_XXXGENERALIZEXXXinteg_betarestr/idx*.img_integrated_experiments.json"
 json_glob = os.environ["JSON_GLOB"]
 #image_glob = "/global/cscratch1/sd/nksauter/proj-h0918/HASWELL1/step6_MPIbatch_0%05d.img.gz"
-image_glob = os.environ["IMAGE_GLOB"]
+image_glob = os.environ.get("IMAGE_GLOB")
+# alternatively, read DIRECT_SPACE_ABC from the per-rank HDF5 containers, LS49/sim/image_container.py
+image_container = os.environ.get("IMAGE_CONTAINER")
+containers = None
 global format_class
 
+def get_direct_space_abc(serial_no, format_class=None):
+  if image_container is not None:
+    global containers
+    if containers is None:
+      from LS49.sim.image_container import container_directory
+      containers = container_directory(image_container)
+    return containers.direct_space_abc(serial_no), format_class
+  image_file = image_glob%serial_no
+  if format_class is None:
+    format_class = Registry.find(image_file)
+  i = format_class(image_file)
+  Z = i.get_smv_header(image_file)
+  ABC = Z[1]["DIRECT_SPACE_ABC"]
+  return tuple([float(a) for a in ABC.split(",")]), format_class
+
 def get_items(rotmat_dictionary):
   file_list = glob.glob(json_glob)
   format_class = None
   for item in file_list:
     serial_no = int(item[-37:-32])
-    image_file = image_glob%serial_no
-    #print image_file
-    if format_class is None:
-      format_class = Registry.find(image_file)
-    i = format_class(image_file)
-    Z = i.get_smv_header(image_file)
-    ABC = Z[1]["DIRECT_SPACE_ABC"]
-    abc = tuple([float(a) for a in ABC.split(",")])
+    abc, format_class = get_direct_space_abc(serial_no, format_class)
 
     from dxtbx.model.experiment_list import ExperimentListFactory
     EC = ExperimentListFactory.from_json_file(item,check_format=False)[0].crystal
@@ -38,16 +49,8 @@ def get_items(rotmat_dictionary):
       continue
 
 def get_item(key):
-    format_class = None
-    image_file = image_glob%key
     json_file = json_glob%key
-    print (image_file)
-    if format_class is None:
-      format_class = Registry.find(image_file)
-    i = format_class(image_file)
-    Z = i.get_smv_header(image_file)
-    ABC = Z[1]["DIRECT_SPACE_ABC"]
-    abc = tuple([float(a) for a in ABC.split(",")])
+    abc, format_class = get_direct_space_abc(key)
 
     from dxtbx.model.experiment_list import ExperimentListFactory
     EC = ExperimentListFactory.from_json_file(json_file,check_format=False)[0].crystal